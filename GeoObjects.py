@@ -1,5 +1,18 @@
+import re
+import json
+import asyncio
+import os
 import math
 import copy
+import zlib
+import base64
+import hashlib
+import tempfile
+import functools
+import itertools
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 
 
 # Copy all data from objSource to objDest.
@@ -140,9 +153,7 @@ class Matrix4:
     elif len(args) == 4:
       self.m = [[float(y) for y in x] for x in args[:4]]
     elif len(args) == 16:
-      self.m = []
-      for i in range(4):
-        self.m[i] = [float(x) for x in args[i:i+4]]
+      self.m = [[float(x) for x in args[4*i:4*i+4]] for i in range(4)]
     else:
       raise ValueError("Matrix4.__init__ take 1 or 4 arguments")
 
@@ -162,7 +173,7 @@ class Matrix4:
 
   def matMul(self, other):
     return Matrix4( [[sum([a*b for a,b, in zip(row,column)])
-                      for row in other.m] for column in zip(*(self.m))])
+                      for column in zip(*(other.m))] for row in self.m])
 
   def scalarMul(self, other):
     return Matrix4( [[float(other)*a for a in row] for row in self.m])
@@ -225,8 +236,8 @@ def rotateAA( axis, angle):
   vtemp = vec3( axis)
   u = norm( vtemp)
   ux,uy,uz = u.v
-  c = math.sin(angle)
-  s = math.cos(angle)
+  c = math.cos(angle)
+  s = math.sin(angle)
   rx = [c + ux*ux*(1-c), ux*uy*(1-c) - uz*s, ux*uz*(1-c) + uy*s, 0]
   ry = [uy*ux*(1-c) + uz*s, c + uy*uy*(1-c), uy*uz*(1-c) - ux*s, 0]
   rz = [uz*ux*(1-c) - uy*s, uz*uy*(1-c) + ux*s, c + uz*uz*(1-c), 0]
@@ -243,9 +254,117 @@ def new3jsFace3( *args):
     i0,i1,i2 = args[:3]
   return "new THREE.Face3({},{},{})".format(i0,i1,i2)
 
+# Versioned geometry
+#
+# Assigning one of the geometry attributes of a GeoVertObj gives it a
+# new version, and assigning any other attribute a different value a
+# new style version. The arrays it holds are read only views, so they
+# change only by assignment or inside edit. Methods marked versioned
+# cache their result with the version it was computed at, so bounds,
+# stats, normals and encoded buffers of an unchanged object are not
+# computed again. The script is not cached, only the encoded parts it
+# is put together from, which a new style reuses. The versions are
+# drawn from one counter, so no two states of any objects share one.
+# An array written through a reference the caller kept must be
+# followed by a call to changed, and clearCache frees the memory the
+# cache holds.
+geometryAttributes = frozenset( ["vertices", "faces", "normals", "colors",
+                                 "scalars", "edges", "points", "positions",
+                                 "scales", "orientations", "values"])
+
+_versions = itertools.count(1)
+
+def readOnly( value):
+  """A read only view of an array, other values as they are"""
+  if isinstance( value, np.ndarray) and value.flags.writeable:
+    value = value.view()
+    value.flags.writeable = False
+  return value
+
+def sameValue( a, b):
+  """Whether assigning b over a leaves the style as it was"""
+  if a is b:
+    return True
+  return (type(a) is type(b) and
+          isinstance( a, (str, int, float, bool, tuple)) and a == b)
+
+def versioned( method, versions=("version",)):
+  """Cache the result of a GeoVertObj method, by its arguments, until
+  the geometry changes"""
+  @functools.wraps( method)
+  def cachedMethod( self, *args):
+    return self.cached( method.__name__, lambda: method( self, *args),
+                        versions, args)
+  return cachedMethod
+
+def styleVersioned( method):
+  """Cache the result of a GeoVertObj method, by its arguments, until
+  the geometry or the style changes"""
+  return versioned( method, ("version", "styleVersion"))
+
 class GeoVertObj:
   """A base class for GeoObj base on vertices"""
 
+  version = 0
+  styleVersion = 0
+
+  def __setattr__(self, name, value):
+    if name in geometryAttributes:
+      value = readOnly( value)
+      object.__setattr__( self, "version", next(_versions))
+    elif not name.startswith( "_") and name not in ("version",
+                                                    "styleVersion"):
+      if not sameValue( self.__dict__.get( name, self), value):
+        object.__setattr__( self, "styleVersion", next(_versions))
+    object.__setattr__( self, name, value)
+
+  def changed(self):
+    """Give the geometry a new version, after its arrays were written
+    in place"""
+    self.version = next(_versions)
+
+  @contextlib.contextmanager
+  def edit(self, name):
+    """A writable view of the array attribute name, for writing in
+    place; the geometry gets a new version when the block ends"""
+    view = getattr( self, name).view()
+    view.flags.writeable = True
+    try:
+      yield view
+    finally:
+      self.changed()
+
+  def clearCache(self):
+    """Drop the cached bounds, stats, normals and encoded buffers, to
+    be computed again when they are next needed"""
+    self.__dict__.pop( "_cache", None)
+
+  def cached(self, name, compute, versions, key=()):
+    """The value compute gives, cached under name for key and the
+    attributes named in versions. The versions are read after compute,
+    which may set the style."""
+    cache = self.__dict__.get( "_cache")
+    if cache is None:
+      cache = self._cache = {}
+    entry = cache.get( name)
+    current = tuple( getattr( self, v) for v in versions) + tuple(key)
+    if entry is not None and entry[0] == current:
+      return entry[1]
+    value = compute()
+    current = tuple( getattr( self, v) for v in versions) + tuple(key)
+    cache[name] = (current, value)
+    return value
+
+  def encoded(self, name, dtype, index=None, indexName=None):
+    """encodeArray of the array attribute name, taken at index if it is
+    given, cached until the geometry changes. indexName tells indices
+    apart in the cache."""
+    return self.cached( "encoded " + name,
+                        lambda: encodeArray( getattr( self, name), dtype,
+                                             index),
+                        ("version",), (np.dtype(dtype).str, indexName))
+
+  @versioned
   def boundingBox(self):
     """The bounding box given as two Vector3's that hold the minimum
     and maximum x, y, and z coordinates."""
@@ -258,13 +377,672 @@ class GeoVertObj:
 
 def totalBoundingBox( bb):
   """Give the total bounding box for a list of bounding boxes"""
-  vtmin, vtmax = bb[0];
+  # The boxes may be cached, so the total is built in new vectors.
+  vtmin, vtmax = Vector3( list(bb[0][0].v)), Vector3( list(bb[0][1].v))
   for vmin, vmax in bb[1:]:
     for i in range(3):
       vtmin.v[i] = min( vtmin.v[i], vmin.v[i])
       vtmax.v[i] = max( vtmax.v[i], vmax.v[i])
   return (vtmin, vtmax)
 
+# Array helpers
+#
+# Large geometry is held in numpy arrays and shipped to the browser
+# as base64 encoded typed arrays that decodeBuffer in fullScript turns
+# back into Float32Array, Uint32Array, etc.
+_jsArrayTypes = {
+  "<f4" : "Float32Array",
+  "<u4" : "Uint32Array",
+  "<u2" : "Uint16Array",
+  "<i2" : "Int16Array",
+  "|u1" : "Uint8Array"
+}
+
+# Number of rows (vertices, faces, ...) handled at once by the
+# vectorized loops, so temporaries stay bounded for huge objects.
+chunkSize = 1 << 20
+
+def chunks( n, size=None):
+  """Slices that cover range(n) in pieces of at most size"""
+  size = size or chunkSize
+  for i in range(0, n, size):
+    yield slice( i, min(i+size, n))
+
+# Out of core sources
+#
+# Besides arrays and lists, the arrays of an object may come from a
+# source that is larger than memory: a memory mapped array, which is
+# used as it is, whatever its dtype, an array like dataset such as an
+# h5py or zarr one, or an iterator over blocks of rows, or a function
+# that returns one. The last two are read once, a chunk at a time,
+# into a temporary file that is then memory mapped. Everything that
+# reads the arrays does so in chunks of chunkSize rows, so chunkSize
+# bounds the memory used beyond the output.
+
+def isSource( x):
+  """Whether x is an out of core source rather than an array or a
+  list of rows"""
+  if isinstance( x, np.memmap):
+    return True
+  if isinstance( x, (np.ndarray, list, tuple)):
+    return False
+  return (callable( x) or hasattr( x, "__next__") or
+          (hasattr( x, "shape") and hasattr( x, "__getitem__")))
+
+def spoolArray( blocks, width, dtype):
+  """Write the row blocks to a temporary file, and map it as an
+  (N,width) array of dtype, or (N,) if width is None"""
+  dtype = np.dtype( dtype)
+  f = tempfile.TemporaryFile()
+  n = 0
+  for block in blocks:
+    block = np.ascontiguousarray( block, dtype=dtype)
+    f.write( memoryview( block).cast('B'))
+    n += block.size
+  f.flush()
+  shape = (n,) if width is None else (n//width, width)
+  if n == 0:
+    return np.empty( shape, dtype=dtype)
+  return np.memmap( f, dtype=dtype, mode="r+", shape=shape)
+
+def sourceArray( source, width, dtype):
+  """The rows of the out of core source as an array that is read
+  lazily, (N,width), or (N,) if width is None"""
+  shape = (-1,) if width is None else (-1, width)
+  if isinstance( source, np.memmap):
+    return source.reshape( shape)
+  if callable( source):
+    blocks = source()
+  elif hasattr( source, "__next__"):
+    blocks = source
+  else:
+    blocks = (source[sl] for sl in chunks( len(source)))
+  return spoolArray( blocks, width, dtype)
+
+def vertexArray( verts):
+  """An (N,3) float32 array from an array, a list of Vector3's, or
+  an out of core source"""
+  if isSource( verts):
+    return sourceArray( verts, 3, np.float32)
+  if isinstance( verts, np.ndarray):
+    return np.asarray( verts, dtype=np.float32).reshape(-1,3)
+  return np.array( [list(vec3(v)) for v in verts],
+                   dtype=np.float32).reshape(-1,3)
+
+def indexArray( idx, width):
+  """An (M,width) uint32 array of vertex indices"""
+  if isSource( idx):
+    return sourceArray( idx, width, np.uint32)
+  if isinstance( idx, np.ndarray):
+    return np.asarray( idx, dtype=np.uint32).reshape(-1,width)
+  return np.array( [[int(x) for x in i[:width]] for i in idx],
+                   dtype=np.uint32).reshape(-1,width)
+
+def indexDtype( nVertices):
+  """The smallest index type that addresses nVertices"""
+  return np.dtype("<u2") if nVertices < (1 << 16) else np.dtype("<u4")
+
+# Parallel generation
+#
+# generateGeometry makes the arrays of a GeometryJob a chunk at a time,
+# in worker processes when workers > 1. The vertices and faces of
+# every chunk are counted first, the faces as an upper bound, and the
+# outputs are allocated up front as files in shared memory that the
+# workers map and write their chunks into at their own offsets. The
+# job reaches a worker once, as the argument of the pool's
+# initializer, which a forked worker inherits rather than unpickles,
+# and a chunk returns only the number of faces it wrote, so no array is
+# pickled either way. A chunk indexes its faces from its own first
+# vertex; the final pass adds the offsets of the chunks while it moves
+# their faces down over the room that chunks making fewer faces left.
+
+def sharedDirectory( nbytes):
+  """The directory of files in shared memory, if it has room for
+  nbytes, or None for the default temporary directory"""
+  shm = "/dev/shm"
+  if os.path.isdir( shm):
+    st = os.statvfs( shm)
+    if st.f_bavail*st.f_frsize > 2*nbytes:
+      return shm
+  return None
+
+class GeometryJob:
+  """Geometry made in chunks by generateGeometry.
+
+  vertexAttributes lists the (name, dtype, width) of the vertex arrays.
+  A job gives chunks, a list of small descriptions of its chunks,
+  sizes( chunk), the number of vertices of a chunk and the most faces
+  it makes, and fill( chunk, arrays), which writes the chunk into the
+  views of its rows in arrays, by the names of the vertex arrays and
+  "faces", and returns the number of faces it wrote. A job is sent to
+  the worker processes, so it must pickle."""
+
+  vertexAttributes = [("vertices", np.float32, 3), ("normals", np.float32, 3)]
+
+_generationJob = None
+
+def setGenerationJob( job):
+  global _generationJob
+  _generationJob = job
+
+def fillChunk( paths, views, chunk):
+  """Fill chunk of the job of this worker into the views of the shared
+  outputs at paths"""
+  arrays = {}
+  for name, dtype, width, rows, start, count in views:
+    arrays[name] = np.memmap( paths[name], dtype=dtype, mode="r+",
+                              shape=(rows, width))[start:start+count]
+  return _generationJob.fill( chunk, arrays)
+
+def generateGeometry( job, workers=1):
+  """The arrays of job, by the names of its vertex arrays and "faces",
+  made by workers processes. With more than one worker the arrays are
+  memory mapped from shared memory."""
+  sizes = [job.sizes( chunk) for chunk in job.chunks]
+  starts = np.zeros( (len(sizes)+1, 2), dtype=np.int64)
+  starts[1:] = np.cumsum( np.array( sizes, dtype=np.int64).reshape(-1,2),
+                          axis=0)
+  outputs = [(name, dtype, width, 0) for name, dtype, width
+             in job.vertexAttributes] + [("faces", np.uint32, 3, 1)]
+  def views( i):
+    """(name, dtype, width, rows, start, count) of the views of chunk i"""
+    return [(name, dtype, width, int(starts[-1,k]), int(starts[i,k]),
+             sizes[i][k]) for name, dtype, width, k in outputs]
+  full = {}
+  if workers <= 1 or len(job.chunks) <= 1:
+    for name, dtype, width, k in outputs:
+      full[name] = np.empty( (starts[-1,k], width), dtype=dtype)
+    written = [job.fill( chunk, dict(
+                 (name, full[name][start:start+count])
+                 for name, dtype, width, rows, start, count in views(i)))
+               for i, chunk in enumerate(job.chunks)]
+  else:
+    nbytes = sum( int(starts[-1,k])*width*np.dtype(dtype).itemsize
+                  for name, dtype, width, k in outputs)
+    directory = sharedDirectory( nbytes)
+    paths = {}
+    try:
+      for name, dtype, width, k in outputs:
+        rows = int(starts[-1,k])
+        fd, paths[name] = tempfile.mkstemp( prefix="pyplot3d-", dir=directory)
+        os.ftruncate( fd, max( rows*width*np.dtype(dtype).itemsize, 1))
+        os.close( fd)
+        full[name] = np.memmap( paths[name], dtype=dtype, mode="r+",
+                                shape=(rows, width)) if rows else \
+                     np.empty( (0, width), dtype=dtype)
+      with ProcessPoolExecutor( workers, initializer=setGenerationJob,
+                                initargs=(job,)) as pool:
+        futures = [pool.submit( fillChunk, paths, views(i), chunk)
+                   for i, chunk in enumerate(job.chunks)]
+        written = [f.result() for f in futures]
+    finally:
+      # The mappings outlive the names.
+      for path in paths.values():
+        os.remove( path)
+  faces = full["faces"]
+  end = 0
+  for i, count in enumerate(written):
+    for sl in chunks( count):
+      faces[end+sl.start:end+sl.stop] = (
+        faces[starts[i,1]+sl.start:starts[i,1]+sl.stop] +
+        np.uint32(starts[i,0]))
+    end += count
+  full["faces"] = faces[:end]
+  return full
+
+def jsArrayType( dtype):
+  """The name of the JavaScript typed array that matches dtype"""
+  return _jsArrayTypes[np.dtype(dtype).str]
+
+def encodeArray( arr, dtype, index=None):
+  """JavaScript expression that rebuilds arr, or its rows at index,
+  as a typed array. The rows are converted and encoded a chunk at a
+  time, a multiple of three of them so the base64 pieces join up."""
+  dtype = np.dtype( dtype)
+  n = len(arr) if index is None else len(index)
+  parts = []
+  for sl in chunks( n, 3*max( 1, chunkSize//3)):
+    rows = arr[sl] if index is None else arr[index[sl]]
+    parts.append( base64.b64encode( np.ascontiguousarray( rows, dtype=dtype)
+                                  ).decode('ascii'))
+  return 'decodeBuffer("{}", {})'.format( "".join( parts),
+                                          jsArrayType( dtype))
+
+def geometryKey( *parts):
+  """The key under which the page shares the geometry built from the
+  script strings parts between plots"""
+  h = hashlib.sha1()
+  for part in parts:
+    for i in range(0, len(part), chunkSize):
+      h.update( part[i:i+chunkSize].encode('ascii'))
+  return h.hexdigest()
+
+# Compressed payloads
+#
+# With the compress keyword of render, every array the scene script
+# decodes is pulled out of the script into one zlib stream, sent as
+# base64, that the page inflates with DecompressionStream before it
+# builds the scene. The bytes of each array are split into planes, all
+# the first bytes of its items, then all the second, and so on, as the
+# high bytes of floats and indices vary much less than the low ones.
+# Arrays that appear more than once are sent once. A scene served by
+# the kernel's SceneServer fetches the same arrays as a binary buffer,
+# which is only deflated when compress is given.
+_decodePattern = re.compile( r'decodeBuffer\( ?"([A-Za-z0-9+/=]*)", (\w+)\)')
+
+_jsItemSizes = {
+  "Float32Array" : 4,
+  "Uint32Array" : 4,
+  "Uint16Array" : 2,
+  "Int16Array" : 2,
+  "Uint8Array" : 1
+}
+
+def packArrays( script, level=None):
+  """The script reading its arrays from the inflated list in place of
+  decoding them, the bytes of the arrays and their layout, a list of
+  [offset, bytes, item size] for every array. With a zlib level the
+  bytes are split into planes and deflated, otherwise the arrays are
+  laid end to end at offsets that are multiples of 4."""
+  index = {}
+  parts = []
+  layout = []
+  offset = 0
+  def extract( match):
+    nonlocal offset
+    data, jsType = match.group(1), match.group(2)
+    if data not in index:
+      raw = np.frombuffer( base64.b64decode( data), dtype=np.uint8)
+      size = _jsItemSizes[jsType]
+      if level is None:
+        pad = -offset % 4
+        parts.append( bytes(pad) + raw.tobytes())
+        offset += pad
+      else:
+        parts.append( raw.reshape(-1, size).T.tobytes())
+      layout.append( [offset, len(raw), size])
+      offset += len(raw)
+      index[data] = len(layout)-1
+    return "new {}( inflated[{}])".format( jsType, index[data])
+  script = _decodePattern.sub( extract, script)
+  data = b"".join( parts)
+  if level is not None:
+    data = zlib.compress( data, level)
+  return script, data, layout
+
+def compressArrays( script, level=6):
+  """The script reading its arrays from the inflated list in place of
+  decoding them, the base64 zlib payload and its layout, as for
+  packArrays"""
+  script, payload, layout = packArrays( script, level)
+  return script, base64.b64encode( payload).decode('ascii'), layout
+
+def arrayBoundingBox( positions):
+  """The bounding box of an (N,3) array as two Vector3's"""
+  vmin = np.full( 3, np.inf)
+  vmax = np.full( 3, -np.inf)
+  for sl in chunks( len(positions)):
+    # Reducing the rows of x, y and z is much faster than reducing
+    # down the columns of an (N,3) block.
+    block = np.ascontiguousarray( positions[sl].T)
+    vmin = np.minimum( vmin, block.min(axis=1))
+    vmax = np.maximum( vmax, block.max(axis=1))
+  return (Vector3(vmin), Vector3(vmax))
+
+def vertexNormals( vertices, faces):
+  """Area weighted unit vertex normals of a triangle mesh as an (N,3)
+  float32 array"""
+  acc = np.zeros( (len(vertices), 3))
+  for sl in chunks( len(faces)):
+    f = faces[sl]
+    tri = vertices[f].astype(np.float64)
+    fn = np.cross( tri[:,1]-tri[:,0], tri[:,2]-tri[:,0])
+    for i in range(3):
+      acc[:,i] += np.bincount( f.reshape(-1), np.repeat( fn[:,i], 3),
+                               minlength=len(vertices))
+  length = np.linalg.norm( acc, axis=1, keepdims=True)
+  return (acc/np.where( length > 0., length, 1.)).astype(np.float32)
+
+# Named colormaps
+#
+# Each colormap is a list of evenly spaced RGB stops that are linearly
+# interpolated into a lookup table.
+colormaps = {
+  "viridis" : [[68,1,84],[71,44,122],[59,81,139],[44,113,142],
+               [33,144,141],[39,173,129],[92,200,99],[170,220,50],
+               [253,231,37]],
+  "gray" : [[0,0,0],[255,255,255]],
+  "hot" : [[0,0,0],[230,0,0],[255,210,0],[255,255,255]],
+  "coolwarm" : [[59,76,192],[221,221,221],[180,4,38]],
+  "jet" : [[0,0,131],[0,60,170],[5,255,255],[255,255,0],[250,0,0],
+           [128,0,0]]
+}
+
+def colormapTable( name, n=256):
+  """An (n,3) uint8 lookup table for the named colormap"""
+  stops = np.array( colormaps[name], dtype=np.float64)
+  xs = np.linspace( 0., 1., len(stops))
+  t = np.linspace( 0., 1., n)
+  lut = [np.interp( t, xs, stops[:,i]) for i in range(3)]
+  return np.rint( np.stack( lut, axis=1)).astype(np.uint8)
+
+def colormapColors( values, name, vmin, vmax):
+  """Map values onto (N,3) uint8 colors using the named colormap"""
+  lut = colormapTable( name)
+  scale = (len(lut)-1)/(vmax-vmin) if vmax > vmin else 0.
+  t = (np.asarray(values, dtype=np.float64)-vmin)*scale
+  t = np.nan_to_num( t, nan=0.)
+  idx = np.clip( t, 0, len(lut)-1).astype(np.intp)
+  return lut[idx]
+
+# Per vertex scalars
+#
+# TriangleSet, Line and Point take an (N,) array of scalars, one per
+# vertex, that color the vertices through colormap over colorRange,
+# which defaults to the range of the finite scalars. The colors are
+# sent as uint8, three bytes a vertex. With liveColors the scalars are
+# sent instead, as uint16 steps over their range, along with the
+# lookup table, and the page maps them itself, so that setColorRange
+# can change the range of a plot that is already drawn without
+# sending the geometry again.
+_cmDefaultDict = {
+  "scalars" : None,
+  "colormap" : "viridis",
+  "colorRange" : None,
+  "liveColors" : False
+}
+
+def setScalarAttributes( obj, kwargs):
+  """Set the scalar coloring attributes of obj from kwargs"""
+  for attr in _cmDefaultDict:
+    if attr in kwargs:
+      setattr( obj, attr, kwargs[attr])
+    else:
+      setattr( obj, attr, _cmDefaultDict[attr])
+  if isSource( obj.scalars):
+    obj.scalars = sourceArray( obj.scalars, None, np.float32)
+  elif obj.scalars is not None:
+    obj.scalars = np.asarray( obj.scalars, dtype=np.float32).reshape(-1)
+  obj.colormapId = str( uuid())
+
+def finiteRange( values):
+  """The minimum and maximum of the finite values, or None"""
+  lo, hi = np.inf, -np.inf
+  for sl in chunks( len(values)):
+    v = values[sl]
+    v = v[np.isfinite( v)]
+    if len(v):
+      lo = min( lo, float( v.min()))
+      hi = max( hi, float( v.max()))
+  return (lo, hi) if lo <= hi else None
+
+def scalarRange( obj):
+  """The range the scalars of obj are colored over"""
+  if obj.colorRange is not None:
+    return (float( obj.colorRange[0]), float( obj.colorRange[1]))
+  return finiteRange( obj.scalars) or (0., 1.)
+
+class ScalarColors:
+  """The (N,3) uint8 colors of the scalars of obj, mapped as they are
+  indexed, so they can be encoded a chunk at a time"""
+
+  def __init__(self, obj):
+    self.scalars = obj.scalars
+    self.colormap = obj.colormap
+    self.range = scalarRange( obj)
+
+  def __len__(self):
+    return len(self.scalars)
+
+  def __getitem__(self, index):
+    return colormapColors( self.scalars[index], self.colormap, *self.range)
+
+def vertexColors( obj):
+  """The (N,3) uint8 vertex colors of obj, from its scalars if it has
+  them, or None"""
+  if obj.scalars is None:
+    return getattr( obj, "colors", None)
+  mapped = ScalarColors( obj)
+  colors = np.empty( (len(mapped), 3), dtype=np.uint8)
+  for sl in chunks( len(mapped)):
+    colors[sl] = mapped[sl]
+  return colors
+
+def scalarSteps( scalars):
+  """The scalars as uint16 steps over their finite range, and that
+  range. Values that are not finite are sent as the bottom step."""
+  lo, hi = finiteRange( scalars) or (0., 0.)
+  scale = 65535./(hi-lo) if hi > lo else 0.
+  steps = np.empty( len(scalars), dtype=np.uint16)
+  for sl in chunks( len(scalars)):
+    t = np.nan_to_num( (scalars[sl].astype(np.float64)-lo)*scale, nan=0.)
+    steps[sl] = np.rint( np.clip( t, 0., 65535.))
+  return steps, lo, hi
+
+colorMapScript = """\
+  pyplot3d.colorMap( "{ID}", {LUT}, [{MIN}, {MAX}], requestRender);
+"""
+
+liveColorScript = """\
+    geometry.addAttribute( 'color', pyplot3d.scalarColors( "{ID}",
+      {STEPS}, {LO}, {HI}));
+"""
+
+def colorAttributes( obj, index=None):
+  """The color map script and the color attribute script of obj, whose
+  vertex colors are taken at index when it is given. Both are empty
+  without vertex colors."""
+  if obj.scalars is not None and obj.liveColors:
+    steps, lo, hi = scalarSteps( obj.scalars)
+    vmin, vmax = scalarRange( obj)
+    return (colorMapScript.format(
+              ID = obj.colormapId,
+              LUT = encodeArray( colormapTable( obj.colormap), "|u1"),
+              MIN = vmin,
+              MAX = vmax),
+            liveColorScript.format(
+              ID = obj.colormapId,
+              STEPS = encodeArray( steps, "<u2", index),
+              LO = lo,
+              HI = hi))
+  if obj.scalars is not None:
+    colors = ScalarColors( obj)
+  else:
+    colors = getattr( obj, "colors", None)
+  if colors is None:
+    return ("", "")
+  return ("", TriangleSet.tsColor.format(
+                COLORS = encodeArray( colors, "|u1", index)))
+
+def setColorRange( geoObj, vmin, vmax):
+  """Set the color range of geoObj, and return the script that recolors
+  it on every plot of the page that draws it with liveColors"""
+  geoObj.colorRange = (vmin, vmax)
+  return ('<script>\nif (window.pyplot3d) {{\n'
+          '  pyplot3d.setColorRange( "{}", {}, {});\n}}\n</script>\n'.format(
+            geoObj.colormapId, float(vmin), float(vmax)))
+
+# Depth ordering
+#
+# Transparent triangles and sprites blend correctly only when they are
+# drawn back to front. Rather than sorting them on the page as the
+# camera moves, the faces or points are sorted once here along each of
+# depthDirections, the axes and the diagonals of a cube, and the orders
+# are sent with the geometry. Before a frame is drawn the page finds
+# the direction nearest that from the camera to the object, or its
+# opposite, and only when that changes does it gather the index, or
+# the vertices of a point cloud, in that order or its reverse. The
+# cost of a frame is then independent of the number of primitives.
+depthDirections = np.array(
+  [d for d in itertools.product( (-1, 0, 1), repeat=3)
+   if d > (0, 0, 0)], dtype=np.float64)
+depthDirections /= np.linalg.norm( depthDirections, axis=1, keepdims=True)
+
+def depthOrders( centers):
+  """The orders of the (N,3) centers sorted along each of the
+  depthDirections, as an (M,N) uint16 or uint32 array"""
+  n = len(centers)
+  orders = np.empty( (len(depthDirections), n), dtype=indexDtype( n))
+  keys = np.empty( n, dtype=np.float32)
+  for k, d in enumerate(depthDirections):
+    for sl in chunks( n):
+      keys[sl] = centers[sl].dot( d.astype(np.float32))
+    orders[k] = np.argsort( keys, kind="stable")
+  return orders
+
+# Follows a scene template, so picks up from its indent.
+depthScript = """pyplot3d.depthSorted( {OBJECT}, [
+    {ORDERS}
+  ], {DIRECTIONS}, [{CENTER}], {ITEM});
+  """
+
+def renderDepthOrder( obj, name, orders, item):
+  """The script that draws the object name of the page back to front
+  by the orders of obj, item being the number of vertices to a
+  primitive in its unindexed buffers"""
+  vmin, vmax = obj.boundingBox()
+  return depthScript.format(
+    OBJECT = name,
+    ORDERS = ",\n    ".join( obj.cached( "encoded depth " + str(k),
+                               lambda k=k: encodeArray( orders[k],
+                                                        orders.dtype),
+                               ("version",))
+                             for k in range(len(orders))),
+    DIRECTIONS = json.dumps( [round( float(x), 6)
+                              for x in depthDirections.reshape(-1)]),
+    CENTER = 0.5*(vmin+vmax),
+    ITEM = item)
+
+phongMaterial = """\
+  var material = new THREE.MeshPhongMaterial( {{
+    color : {COLOR},
+    ambient : {AMBIENT},
+    specular : {SPECULAR},
+    emissive : {EMISSIVE},
+    shininess : {SHININESS},
+    transparent : {TRANSPARENT},
+    opacity : {OPACITY},
+    side: THREE.DoubleSide,
+    vertexColors : {VERTEX_COLORS},
+    wireframe : false,
+    fog : true,
+  }});"""
+
+def renderMaterial( obj, vertexColors):
+  """The MeshPhongMaterial for an object with the TriangleSet style
+  attributes"""
+  if obj.opacity < 1.:
+    obj.transparent = True
+  else:
+    obj.transparent = False
+  return phongMaterial.format(
+      COLOR = "0xffffff" if vertexColors else obj.color,
+      AMBIENT = obj.ambient,
+      SPECULAR = obj.specular,
+      EMISSIVE = obj.emissive,
+      SHININESS = "{}".format(obj.shininess),
+      TRANSPARENT = ("false","true")[obj.transparent],
+      OPACITY = "{}".format(obj.opacity),
+      VERTEX_COLORS = ("THREE.NoColors", "THREE.VertexColors")[vertexColors])
+
+# Plane slicing
+#
+# TriangleSet.slice cuts the faces with the planes normal.x = offset.
+# The heights normal.x of the vertices are computed once per normal,
+# along with an interval index of the faces: the range of heights is
+# cut into bins, and every face is listed in the bins its own range of
+# heights overlaps, so a plane only tests the faces of its bin. All the
+# planes are tested at once, against the pairs of a face and a plane.
+# A vertex is above a plane if its height is greater than the offset,
+# so a face that is cut has exactly two edges with ends on both sides.
+# The point on an edge is computed from the edge's vertices in order,
+# and is named by them, so the faces sharing an edge agree on it and
+# the segments join up into polylines through those names.
+sliceBinFaces = 64
+
+class SliceIndex:
+  """The heights of the vertices along a unit normal, and the faces
+  bucketed by the range of heights they span"""
+
+  def __init__(self, vertices, faces, normal):
+    self.normal = np.asarray( vec3( normal).v, dtype=np.float64)
+    self.normal /= np.linalg.norm( self.normal)
+    self.heights = np.empty( len(vertices))
+    for sl in chunks( len(vertices)):
+      self.heights[sl] = vertices[sl].astype(np.float64).dot( self.normal)
+    nf = len(faces)
+    fmin = np.empty( nf)
+    fmax = np.empty( nf)
+    for sl in chunks( nf):
+      h = self.heights[faces[sl]]
+      fmin[sl] = h.min(axis=1)
+      fmax[sl] = h.max(axis=1)
+    self.lo = float( fmin.min()) if nf else 0.
+    hi = float( fmax.max()) if nf else 0.
+    # Bins narrower than the faces would list most faces many times.
+    span = float( (fmax-fmin).mean()) if nf else 0.
+    self.bins = max( 1, min( nf//sliceBinFaces,
+                             int( (hi-self.lo)/span) if span > 0. else 1))
+    self.width = (hi-self.lo)/self.bins if hi > self.lo else 1.
+    b0 = self.binOf( fmin)
+    span = self.binOf( fmax) - b0 + 1
+    del fmin, fmax
+    first = np.cumsum( span) - span
+    bins = np.repeat( b0, span) + (np.arange( int(span.sum())) -
+                                   np.repeat( first, span))
+    order = np.argsort( bins, kind="stable")
+    self.faceIds = np.repeat( np.arange( nf, dtype=np.int64), span)[order]
+    self.starts = np.concatenate( ([0], np.cumsum(
+                    np.bincount( bins, minlength=self.bins))))
+
+  def binOf(self, heights):
+    return np.clip( ((heights-self.lo)/self.width).astype(np.intp),
+                    0, self.bins-1)
+
+  def candidates(self, offsets):
+    """The faces that may be cut by the planes at offsets, and the
+    index of their plane"""
+    b = self.binOf( offsets)
+    counts = self.starts[b+1] - self.starts[b]
+    first = np.repeat( self.starts[b] - (np.cumsum( counts) - counts),
+                       counts)
+    faces = self.faceIds[first + np.arange( int(counts.sum()))]
+    return faces, np.repeat( np.arange( len(offsets)), counts)
+
+def stitchSegments( a, b, nodes):
+  """The polylines through the segments from node a[k] to node b[k],
+  as (node list, closed) pairs. Chains are followed from their open
+  ends first, then the loops that are left."""
+  ends = np.concatenate( (a, b))
+  order = np.argsort( ends, kind="stable")
+  segs = (order % len(a)).tolist()
+  starts = np.concatenate( ([0], np.cumsum(
+             np.bincount( ends, minlength=nodes)))).tolist()
+  degree = np.bincount( ends, minlength=nodes)
+  other = np.concatenate( (b, a))[order].tolist()
+  used = [False]*len(a)
+  nxt = list(starts[:-1])
+  lines = []
+  def unused( node):
+    """The next unused segment end at node, or None"""
+    k = nxt[node]
+    while k < starts[node+1] and used[segs[k]]:
+      k += 1
+    nxt[node] = k
+    return k if k < starts[node+1] else None
+  for start in np.concatenate( (np.flatnonzero( degree % 2),
+                                np.flatnonzero( degree))).tolist():
+    while unused( start) is not None:
+      line = [start]
+      k = unused( start)
+      while k is not None:
+        used[segs[k]] = True
+        line.append( other[k])
+        k = unused( line[-1])
+      closed = len(line) > 3 and line[-1] == start
+      lines.append( (line[:-1] if closed else line, closed))
+  return lines
+
 _tsDefaultDict = {
   "color" : "0xcccccc",
   "ambient" : "0xffffff",
@@ -277,94 +1055,803 @@ _tsDefaultDict = {
 
 class TriangleSet(GeoVertObj):
   """A list of vertices, and a list of faces contructed from the
-  vertices"""
+  vertices
+
+  The vertices are held as an (N,3) float32 array and the faces as an
+  (M,3) uint32 array. Optional per vertex normals (N,3) and uint8
+  colors (N,3) may be passed with the normals and colors keywords, or
+  per vertex scalars with the scalars keyword."""
 
   def __init__(self, *args, **kwargs):
     if len(args) == 1:
-      self.vertices = [vec3(x) for x in args[0][1]]
-      self.faces = [[int(x) for x in face[:3]] for face in args[0][2]]
+      self.vertices = vertexArray( args[0][1])
+      self.faces = indexArray( args[0][2], 3)
     elif len(args) == 2:
-      self.vertices = [vec3(x) for x in args[0]]
-      self.faces = [[int(x) for x in face[:3]] for face in args[1]]
+      self.vertices = vertexArray( args[0])
+      self.faces = indexArray( args[1], 3)
+    self.normals = kwargs.get("normals")
+    self.colors = kwargs.get("colors")
+    if isSource( self.normals):
+      self.normals = sourceArray( self.normals, 3, np.float32)
+    if isSource( self.colors):
+      self.colors = sourceArray( self.colors, 3, np.uint8)
     for attr in _tsDefaultDict:
       if attr in kwargs:
         setattr( self, attr, kwargs[attr])
       else:
         setattr( self, attr, _tsDefaultDict[attr])
+    setScalarAttributes( self, kwargs)
+
+  @versioned
+  def boundingBox(self):
+    """The bounding box given as two Vector3's that hold the minimum
+    and maximum x, y, and z coordinates."""
+    return arrayBoundingBox( self.vertices)
+
+  @versioned
+  def smoothNormals(self):
+    """The (N,3) vertex normals, those given or the area weighted
+    normals of the faces"""
+    if self.normals is not None:
+      return self.normals
+    return vertexNormals( self.vertices, self.faces)
+
+  def sliceIndex(self, normal):
+    """The SliceIndex of the faces along normal, cached until the
+    geometry changes"""
+    return self.cached( "slice index",
+                        lambda: SliceIndex( self.vertices, self.faces, normal),
+                        ("version",), tuple( vec3( normal).v))
+
+  def sliceSegments(self, normal, offsets):
+    """The segments where the planes normal.x = offset cut the faces,
+    as the (K,2) names of their ends, the edges (i,j) with i < j their
+    ends are on, or (i,i) for a vertex i on the plane, the (K,) planes
+    they lie in, and the points of the names, a dict from (plane, i, j)
+    rows to an (N,3) array"""
+    index = self.sliceIndex( normal)
+    offsets = np.asarray( offsets, dtype=np.float64).reshape(-1)
+    faces, planes = index.candidates( offsets)
+    tri = self.faces[faces].astype(np.int64)
+    above = index.heights[tri] > offsets[planes][:,None]
+    cut = above.any(axis=1) & ~above.all(axis=1)
+    tri, above, planes = tri[cut], above[cut], planes[cut]
+    # The two cut edges of every face, of (0,1), (1,2) and (2,0).
+    edgeCut = above != np.roll( above, -1, axis=1)
+    first = np.argmax( edgeCut, axis=1)
+    second = 2 - np.argmax( edgeCut[:,::-1], axis=1)
+    rows = np.arange( len(tri))
+    ends = []
+    for e in (first, second):
+      i, j = tri[rows, e], tri[rows, (e+1) % 3]
+      # A cut at the end that is not above is that vertex, named so
+      # by every face around it.
+      low = np.where( above[rows, e], j, i)
+      on = index.heights[low] == offsets[planes]
+      ends.append( np.stack( (planes, np.where( on, low, np.minimum( i, j)),
+                              np.where( on, low, np.maximum( i, j))),
+                             axis=1))
+    # A face that touches the plane at a vertex cuts it in no segment.
+    keep = (ends[0] != ends[1]).any(axis=1)
+    names, inverse = np.unique( np.concatenate( (ends[0][keep],
+                                                 ends[1][keep])), axis=0,
+                                return_inverse=True)
+    segments = np.sort( inverse.reshape(2,-1).T, axis=1)
+    # An edge in the plane is cut by both its faces if they are above.
+    segments = np.unique( segments, axis=0)
+    p, i, j = names[:,0], names[:,1], names[:,2]
+    hi, hj = index.heights[i], index.heights[j]
+    t = np.divide( offsets[p]-hi, hj-hi, out=np.zeros( len(names)),
+                   where=(i != j))[:,None]
+    vi = self.vertices[i].astype(np.float64)
+    points = vi + t*(self.vertices[j].astype(np.float64) - vi)
+    return (segments, names, points.astype(np.float32))
+
+  def slice(self, normal, offsets, **kwargs):
+    """The cross sections of the mesh by the planes normal.x = offset,
+    for the offsets, as a list of Lines with the style of kwargs, by
+    plane. A cross section that closes is a closed Line."""
+    segments, names, points = self.sliceSegments( normal, offsets)
+    lines = []
+    for nodes, closed in stitchSegments( segments[:,0], segments[:,1],
+                                         len(names)):
+      lines.append( (names[nodes[0],0], nodes, closed))
+    lines.sort( key=lambda line: line[0])
+    return [Line( points[nodes], closed=closed, **kwargs)
+            for plane, nodes, closed in lines]
+
+  @versioned
+  def faceCenters(self):
+    """The (M,3) float32 centers of the faces"""
+    centers = np.empty( (len(self.faces), 3), dtype=np.float32)
+    for sl in chunks( len(self.faces)):
+      centers[sl] = self.vertices[self.faces[sl]].mean(axis=1)
+    return centers
+
+  @versioned
+  def depthOrders(self):
+    """The orders of the faces along the depthDirections"""
+    return depthOrders( self.faceCenters())
 
   def faceCenter(self, face):
     """The geometric center of face"""
-    v0, v1, v2 = [self.vertices[i] for i in face]
-    return (v0+v1+v2)/3
+    return Vector3( self.vertices[list(face)].mean(axis=0))
 
   def faceArea(self, face):
     """The area of the face"""
-    v0, v1, v2 = [self.vertices[i] for i in face]
-    e1 = v1-v0
-    e2 = v2-v0
-    return 0.5*mag(cross(e1,e2))
+    v0, v1, v2 = self.vertices[list(face)].astype(np.float64)
+    return 0.5*float( np.linalg.norm( np.cross( v1-v0, v2-v0)))
 
+  @versioned
   def stats(self):
     """Returns and ordered pair that give the sum of the area weighted
     centers of the faces, and the total area."""
-    fc = [self.faceCenter(face) for face in self.faces]
-    fa = [self.faceArea(face) for face in self.faces]
-    num = sum([x*y for x, y in zip(fc, fa)])
-    denom = sum(fa)
-    return (num, denom)
+    num = np.zeros(3)
+    denom = 0.
+    for sl in chunks( len(self.faces)):
+      tri = self.vertices[self.faces[sl]].astype(np.float64)
+      area = 0.5*np.linalg.norm( np.cross( tri[:,1]-tri[:,0],
+                                           tri[:,2]-tri[:,0]), axis=1)
+      num += (tri.sum(axis=1)/3.*area[:,None]).sum(axis=0)
+      denom += float( area.sum())
+    return (Vector3(num), denom)
 
   tsScene = """\
-  var material = new THREE.MeshPhongMaterial( {{
-    color : {COLOR},
-    ambient : {AMBIENT},
-    specular : {SPECULAR},
-    emissive : {EMISSIVE},
-    shininess : {SHININESS},
-    transparent : {TRANSPARENT},
-    opacity : {OPACITY},
-    side: THREE.DoubleSide,
-    wireframe : false,
-    fog : true,
+  {MATERIAL}
+{COLOR_MAP}
+  var geometry = pyplot3d.geometry( "{KEY}", function() {{
+    var geometry = new THREE.BufferGeometry();
+    geometry.addAttribute( 'position', new THREE.BufferAttribute(
+      {POSITIONS}, 3));
+    {ATTRIBUTES}
+    return geometry;
   }});
-  var geometry = new THREE.Geometry();
-  geometry.vertices.push(
-    {VERTEX_LIST}
-  );
-  geometry.faces.push(
-    {FACE_LIST}
-  );
-  geometry.computeFaceNormals();
-  {SMOOTH}
   var mesh = new THREE.Mesh( geometry, material);
   scene.add( mesh);
   """
 
-  def render(self):
-    vertStr = [new3jsVector3(v) for v in self.vertices]
-    vertStr = ",\n  ".join(vertStr)
-    faceStr = [new3jsFace3(f) for f in self.faces]
-    faceStr = ",\n  ".join(faceStr)
-    if self.opacity < 1.:
-      self.transparent = True
-    else:
-      self.transparent = False
+  tsIndex = """\
+    geometry.addAttribute( 'index', new THREE.BufferAttribute(
+      {INDICES}, 1));
+  """
+
+  # An index that draws the vertices in order, which the depth order
+  # of transparent flat shaded faces permutes.
+  tsFlatIndex = """\
+    var index = new {TYPE}( {COUNT});
+    for (var i = 0; i < index.length; i++) {{
+      index[i] = i;
+    }}
+    geometry.addAttribute( 'index', new THREE.BufferAttribute( index, 1));
+  """
+
+  tsNormal = """\
+    geometry.addAttribute( 'normal', new THREE.BufferAttribute(
+      {NORMALS}, 3));
+  """
+
+  tsColor = """\
+    geometry.addAttribute( 'color', new THREE.BufferAttribute(
+      unitColors( {COLORS}), 3));
+  """
+
+  def render(self, shared=True):
+    """The script that adds the mesh to the scene. Unless shared is
+    False, plots on the page with the same geometry draw it from the
+    same buffers, so it must not be modified in place. Transparent
+    faces are drawn back to front by reordering the index, of a
+    geometry the mesh does not share."""
+    depthSorted = self.opacity < 1. and len(self.faces) > 0
+    shared = shared and not depthSorted
+    # Smooth shading shares the vertices between faces, flat shading
+    # gives every face its own copy so that the normals are not
+    # averaged across the edges.
     if self.smooth:
-      smoothStr = "geometry.computeVertexNormals();"
+      attrStr = self.tsIndex.format(
+          INDICES = self.encoded( "faces", indexDtype( len(self.vertices))))
+      normals = self.normals
+      mapStr, colorStr = colorAttributes( self)
+      posStr = self.encoded( "vertices", "<f4")
     else:
-      smoothStr = ""
-    return (self.tsScene.format(
-              COLOR = self.color,
-              AMBIENT = self.ambient,
-              SPECULAR = self.specular,
-              EMISSIVE = self.emissive,
-              SHININESS = "{}".format(self.shininess),
-              TRANSPARENT = ("false","true")[self.transparent],
-              OPACITY = "{}".format(self.opacity),
-              VERTEX_LIST = vertStr,
-              FACE_LIST = faceStr,
-              SMOOTH = smoothStr
+      flat = self.faces.reshape(-1)
+      posStr = self.encoded( "vertices", "<f4", flat, "flat")
+      attrStr = ""
+      if depthSorted:
+        attrStr = self.tsFlatIndex.format(
+            TYPE = jsArrayType( indexDtype( len(flat))),
+            COUNT = len(flat))
+      normals = None
+      mapStr, colorStr = colorAttributes( self, flat)
+    if normals is not None:
+      attrStr = attrStr + self.tsNormal.format(
+          NORMALS = self.encoded( "normals", "<f4"))
+    else:
+      attrStr = attrStr + "    geometry.computeVertexNormals();\n"
+    attrStr = attrStr + colorStr
+    sceneStr = self.tsScene.format(
+        MATERIAL = renderMaterial( self, colorStr != ""),
+        COLOR_MAP = mapStr,
+        KEY = geometryKey( posStr, attrStr) if shared else "",
+        POSITIONS = posStr,
+        ATTRIBUTES = attrStr)
+    if depthSorted:
+      sceneStr = sceneStr + renderDepthOrder( self, "mesh",
+                                              self.depthOrders(), 3)
+    return sceneStr
+
+_sDefaultDict = {
+  "chunkRows" : None,
+  "workers" : 1
+}
+
+class Surface(TriangleSet):
+  """A surface z = f(x, y) sampled on a grid.
+
+  x and y are either 1-D axes or 2-D grids, and z is either a 2-D grid
+  or a vectorized callable f(X, Y). The grid is processed a block of
+  rows at a time, so z may be a memory mapped array, or a function
+  that is only ever evaluated on a few rows at once. Triangles with a
+  corner that is not finite are left out. If colormap names one of
+  the colormaps the vertices are colored by z, as the scalars of a
+  TriangleSet. With workers > 1 the blocks are made by that many
+  processes, which needs z to pickle if it is a function."""
+
+  def __init__(self, x, y, z, **kwargs):
+    x = np.asarray( x)
+    y = np.asarray( y)
+    if callable( z):
+      ny = y.shape[0]
+      nx = x.shape[-1]
+    else:
+      ny, nx = np.shape(z)
+    for attr in _sDefaultDict:
+      if attr in kwargs:
+        setattr( self, attr, kwargs.pop(attr))
+      else:
+        setattr( self, attr, _sDefaultDict[attr])
+    rows = self.chunkRows or max( 1, chunkSize//nx)
+    arrays = generateGeometry( SurfaceRows( x, y, z, ny, nx, rows),
+                               self.workers)
+    positions = arrays["vertices"]
+    normals = arrays["normals"]
+    # Vertices that are not finite are never drawn, but they still
+    # take part in the bounding sphere three.js uses for culling.
+    vmin = None
+    for sl in chunks( len(positions)):
+      block = positions[sl]
+      bad = ~np.isfinite( block)
+      if bad.any():
+        if vmin is None:
+          vmin = finiteMinimum( positions)
+        block[bad] = np.broadcast_to( vmin, block.shape)[bad]
+    if kwargs.get("colormap"):
+      kwargs.setdefault( "scalars", positions[:,2])
+    TriangleSet.__init__( self, positions, arrays["faces"],
+                          normals = normals, **kwargs)
+
+  @staticmethod
+  def gridRows( x, y, z, r0, r1):
+    """The grid points of rows r0 to r1 as a (rows,nx,3) array"""
+    if callable( z):
+      nx = x.shape[-1]
+    else:
+      nx = np.shape(z)[1]
+    shape = (r1-r0, nx)
+    X = np.broadcast_to( x if x.ndim == 1 else x[r0:r1], shape)
+    Y = np.broadcast_to( y[r0:r1,None] if y.ndim == 1 else y[r0:r1], shape)
+    if callable( z):
+      Z = np.broadcast_to( z( X, Y), shape)
+    else:
+      Z = z[r0:r1]
+    return np.stack( (X, Y, Z), axis=2).astype(np.float64)
+
+  @staticmethod
+  def gridNormals( block):
+    """Unit normals of a (rows,nx,3) block of grid points"""
+    rows, nx = block.shape[:2]
+    du = np.gradient( block, axis=1) if nx > 1 else np.zeros_like(block)
+    dv = np.gradient( block, axis=0) if rows > 1 else np.zeros_like(block)
+    n = np.nan_to_num( np.cross( du, dv))
+    length = np.linalg.norm( n, axis=2, keepdims=True)
+    n = np.where( length > 0., n/np.where(length > 0., length, 1.),
+                  np.array([0.,0.,1.]))
+    return n
+
+  @staticmethod
+  def gridFaces( finite, r0, r1, nx):
+    """The triangles of cell rows r0 to r1, where finite[i] flags the
+    usable points of grid row r0+i"""
+    if r1 <= r0 or nx < 2:
+      return np.empty( (0,3), dtype=np.uint32)
+    i, j = np.mgrid[r0:r1, 0:nx-1]
+    a = i*nx + j
+    b = a + 1
+    c = b + nx
+    d = a + nx
+    fa = finite[:r1-r0,:-1]
+    fb = finite[:r1-r0,1:]
+    fc = finite[1:r1-r0+1,1:]
+    fd = finite[1:r1-r0+1,:-1]
+    t0 = np.stack( (a, b, c), axis=2)[fa & fb & fc]
+    t1 = np.stack( (a, c, d), axis=2)[fa & fc & fd]
+    return np.concatenate( (t0, t1)).astype(np.uint32)
+
+def finiteMinimum( positions):
+  """The minimum x, y and z of the (N,3) positions that are finite"""
+  vmin = np.full( 3, np.inf)
+  for sl in chunks( len(positions)):
+    block = positions[sl]
+    finite = np.isfinite( block).all(axis=1)
+    if finite.any():
+      vmin = np.minimum( vmin, block[finite].min(axis=0))
+  return vmin
+
+class SurfaceRows(GeometryJob):
+  """The vertices, normals and faces of the grid of a Surface, a block
+  of rows a chunk"""
+
+  def __init__(self, x, y, z, ny, nx, rows):
+    self.x, self.y, self.z = x, y, z
+    self.ny, self.nx = ny, nx
+    self.chunks = [(r0, min( r0+rows, ny)) for r0 in range(0, ny, rows)]
+
+  def sizes(self, chunk):
+    r0, r1 = chunk
+    return ((r1-r0)*self.nx,
+            2*max( min( r1, self.ny-1)-r0, 0)*max( self.nx-1, 0))
+
+  def fill(self, chunk, arrays):
+    r0, r1 = chunk
+    ny, nx = self.ny, self.nx
+    # One extra row on each side gives central differences for the
+    # normals and the top row of cells.
+    h0 = max( r0-1, 0)
+    h1 = min( r1+1, ny)
+    block = Surface.gridRows( self.x, self.y, self.z, h0, h1)
+    arrays["vertices"][:] = block[r0-h0:r1-h0].reshape(-1,3)
+    arrays["normals"][:] = Surface.gridNormals( block)[r0-h0:r1-h0].reshape(-1,3)
+    cells = Surface.gridFaces( np.isfinite(block).all(axis=2)[r0-h0:],
+                               0, min(r1, ny-1)-r0, nx)
+    arrays["faces"][:len(cells)] = cells
+    return len(cells)
+
+# Instanced primitives
+#
+# A primitive is a small tessellated template, shared by every copy and
+# cached per level of detail, plus per instance arrays of position,
+# scale, orientation and color. three.js r68 has no instanced arrays,
+# so instanceGeometry in fullScript expands the copies into a single
+# BufferGeometry in the browser, which is drawn with one draw call.
+_templates = {}
+
+def sphereTemplate( lod):
+  """A unit icosphere subdivided lod times, as (vertices, normals,
+  faces)"""
+  if ("sphere", lod) not in _templates:
+    t = (1.+math.sqrt(5.))/2.
+    verts = [[-1,t,0],[1,t,0],[-1,-t,0],[1,-t,0],
+             [0,-1,t],[0,1,t],[0,-1,-t],[0,1,-t],
+             [t,0,-1],[t,0,1],[-t,0,-1],[-t,0,1]]
+    faces = [[0,11,5],[0,5,1],[0,1,7],[0,7,10],[0,10,11],
+             [1,5,9],[5,11,4],[11,10,2],[10,7,6],[7,1,8],
+             [3,9,4],[3,4,2],[3,2,6],[3,6,8],[3,8,9],
+             [4,9,5],[2,4,11],[6,2,10],[8,6,7],[9,8,1]]
+    for i in range(lod):
+      mid = {}
+      def midpoint( a, b):
+        key = (min(a,b), max(a,b))
+        if key not in mid:
+          mid[key] = len(verts)
+          verts.append( listAdd( verts[a], verts[b]))
+        return mid[key]
+      newFaces = []
+      for a, b, c in faces:
+        ab, bc, ca = midpoint(a,b), midpoint(b,c), midpoint(c,a)
+        newFaces += [[a,ab,ca],[b,bc,ab],[c,ca,bc],[ab,bc,ca]]
+      faces = newFaces
+    verts = np.array( verts, dtype=np.float64)
+    verts /= np.linalg.norm( verts, axis=1, keepdims=True)
+    _templates[("sphere", lod)] = (verts.astype(np.float32),
+                                   verts.astype(np.float32),
+                                   np.array(faces, dtype=np.uint32))
+  return _templates[("sphere", lod)]
+
+def cylinderTemplate( lod):
+  """A unit radius cylinder from z = 0 to z = 1 with 6*2**lod sides
+  and capped ends, as (vertices, normals, faces)"""
+  if ("cylinder", lod) not in _templates:
+    n = 6*2**lod
+    th = 2.*np.pi*np.arange(n)/n
+    ring = np.stack( (np.cos(th), np.sin(th), np.zeros(n)), axis=1)
+    up = np.array([0.,0.,1.])
+    side = np.concatenate( (ring, ring+up))
+    caps = np.concatenate( (ring, [np.zeros(3)], ring+up, [up]))
+    verts = np.concatenate( (side, caps))
+    normals = np.concatenate( (ring, ring, np.tile(-up, (n+1,1)),
+                               np.tile(up, (n+1,1))))
+    i = np.arange(n)
+    j = (i+1) % n
+    faces = np.concatenate((
+      np.stack( (i, j, j+n), axis=1),
+      np.stack( (i, j+n, i+n), axis=1),
+      2*n + np.stack( (np.full(n, n), j, i), axis=1),
+      3*n+1 + np.stack( (np.full(n, n), i, j), axis=1)))
+    _templates[("cylinder", lod)] = (verts.astype(np.float32),
+                                     normals.astype(np.float32),
+                                     faces.astype(np.uint32))
+  return _templates[("cylinder", lod)]
+
+def boxTemplate( lod):
+  """A unit cube centered on the origin with flat faces, as
+  (vertices, normals, faces)"""
+  if ("box", 0) not in _templates:
+    verts = []
+    normals = []
+    faces = []
+    for ax in range(3):
+      u, w = [a for a in range(3) if a != ax]
+      for side in (-1., 1.):
+        n = len(verts)
+        for a, b in ((-1,-1),(1,-1),(1,1),(-1,1)):
+          v = [0.,0.,0.]
+          v[ax], v[u], v[w] = 0.5*side, 0.5*a, 0.5*b
+          verts.append( v)
+          normals.append( [float(side*(k == ax)) for k in range(3)])
+        if side*(1 if (w-u) % 3 == 1 else -1) > 0:
+          faces += [[n,n+1,n+2],[n,n+2,n+3]]
+        else:
+          faces += [[n,n+2,n+1],[n,n+3,n+2]]
+    _templates[("box", 0)] = (np.array(verts, dtype=np.float32),
+                              np.array(normals, dtype=np.float32),
+                              np.array(faces, dtype=np.uint32))
+  return _templates[("box", 0)]
+
+def quaternionMatrices( q):
+  """(N,3,3) rotation matrices of (N,4) unit quaternions x, y, z, w"""
+  x, y, z, w = [q[:,i].astype(np.float64) for i in range(4)]
+  return np.stack((
+    np.stack( (1-2*(y*y+z*z), 2*(x*y-z*w), 2*(x*z+y*w)), axis=1),
+    np.stack( (2*(x*y+z*w), 1-2*(x*x+z*z), 2*(y*z-x*w)), axis=1),
+    np.stack( (2*(x*z-y*w), 2*(y*z+x*w), 1-2*(x*x+y*y)), axis=1)),
+    axis=1)
+
+def zToDirection( d):
+  """(N,4) quaternions that turn the z axis onto the directions d"""
+  d = np.asarray( d, dtype=np.float64).reshape(-1,3)
+  length = np.linalg.norm( d, axis=1, keepdims=True)
+  d = d/np.where( length > 0., length, 1.)
+  q = np.stack( (-d[:,1], d[:,0], np.zeros(len(d)), 1.+d[:,2]), axis=1)
+  # Turning z onto -z has no unique axis, so use the x axis.
+  q[q[:,3] < 1e-12] = [1.,0.,0.,0.]
+  q /= np.linalg.norm( q, axis=1, keepdims=True)
+  return q.astype(np.float32)
+
+_inDefaultDict = dict( _tsDefaultDict, lod=2)
+
+class Instances(GeoVertObj):
+  """Many copies of a template triangle set.
+
+  positions is an (N,3) array of the template origin of each copy,
+  scales an (N,3) array (or a scalar, or an (N,) array for uniform
+  scaling), orientations an optional (N,4) array of unit quaternions,
+  and colors an optional (N,3) uint8 array."""
+
+  template = staticmethod( sphereTemplate)
+
+  def __init__(self, positions, scales=1., orientations=None,
+               colors=None, **kwargs):
+    self.positions = vertexArray( positions)
+    n = len(self.positions)
+    scales = np.asarray( scales, dtype=np.float32)
+    if scales.ndim < 2:
+      scales = scales.reshape(-1,1)
+    self.scales = np.ascontiguousarray(
+        np.broadcast_to( scales, (n,3)), dtype=np.float32)
+    self.orientations = None if orientations is None else \
+        np.asarray( orientations, dtype=np.float32).reshape(-1,4)
+    self.colors = None if colors is None else \
+        np.asarray( colors, dtype=np.uint8).reshape(-1,3)
+    for attr in _inDefaultDict:
+      if attr in kwargs:
+        setattr( self, attr, kwargs[attr])
+      else:
+        setattr( self, attr, _inDefaultDict[attr])
+
+  def instanceBoxes(self, sl):
+    """Centers and half widths of the bounding boxes of instances sl"""
+    verts = self.template( self.lod)[0]
+    tmin = verts.min(axis=0).astype(np.float64)
+    tmax = verts.max(axis=0).astype(np.float64)
+    center = 0.5*(tmin+tmax)*self.scales[sl]
+    half = 0.5*(tmax-tmin)*np.abs(self.scales[sl])
+    if self.orientations is not None:
+      rot = quaternionMatrices( self.orientations[sl])
+      center = np.einsum( 'nij,nj->ni', rot, center)
+      half = np.einsum( 'nij,nj->ni', np.abs(rot), half)
+    return (self.positions[sl] + center, half)
+
+  @styleVersioned
+  def boundingBox(self):
+    """The bounding box given as two Vector3's that hold the minimum
+    and maximum x, y, and z coordinates."""
+    vmin = np.full( 3, np.inf)
+    vmax = np.full( 3, -np.inf)
+    for sl in chunks( len(self.positions)):
+      center, half = self.instanceBoxes( sl)
+      vmin = np.minimum( vmin, (center-half).min(axis=0))
+      vmax = np.maximum( vmax, (center+half).max(axis=0))
+    return (Vector3(vmin), Vector3(vmax))
+
+  @styleVersioned
+  def stats(self):
+    """Returns and ordered pair that give the sum of the area weighted
+    centers of the instances, and the total area."""
+    verts, normals, faces = self.template( self.lod)
+    tri = verts[faces].astype(np.float64)
+    area = 0.5*np.linalg.norm( np.cross( tri[:,1]-tri[:,0],
+                                         tri[:,2]-tri[:,0]), axis=1).sum()
+    num = np.zeros(3)
+    denom = 0.
+    for sl in chunks( len(self.positions)):
+      center, half = self.instanceBoxes( sl)
+      a = area*np.abs( np.prod( self.scales[sl].astype(np.float64),
+                                axis=1))**(2./3.)
+      num += (center*a[:,None]).sum(axis=0)
+      denom += float( a.sum())
+    return (Vector3(num), denom)
+
+  inScene = """\
+  {MATERIAL}
+  var geometry = pyplot3d.geometry( "{KEY}", function() {{
+    return instanceGeometry( {ARRAYS});
+  }});
+  var mesh = new THREE.Mesh( geometry, material);
+  scene.add( mesh);
+  """
+
+  def render(self, shared=True):
+    """The script that adds the instances to the scene, see
+    TriangleSet.render for shared"""
+    verts, normals, faces = self.template( self.lod)
+    arrays = [encodeArray( verts, "<f4"),
+              encodeArray( normals, "<f4"),
+              encodeArray( faces, "<u4"),
+              self.encoded( "positions", "<f4"),
+              self.encoded( "scales", "<f4"),
+              "null" if self.orientations is None else
+              self.encoded( "orientations", "<f4"),
+              "null" if self.colors is None else
+              self.encoded( "colors", "|u1")]
+    return (self.inScene.format(
+              MATERIAL = renderMaterial( self, self.colors is not None),
+              KEY = geometryKey( *arrays) if shared else "",
+              ARRAYS = ",\n    ".join( arrays)
             ))
 
+  def triangleSet(self, workers=1, **kwargs):
+    """The copies as one TriangleSet with the style of the instances,
+    made by workers processes, for what cannot draw instances"""
+    arrays = generateGeometry( InstanceCopies( self), workers)
+    style = dict( (attr, getattr( self, attr)) for attr in _tsDefaultDict)
+    style.update( kwargs)
+    return TriangleSet( arrays["vertices"], arrays["faces"],
+                        normals=arrays["normals"],
+                        colors=arrays.get("colors"), **style)
+
+class InstanceCopies(GeometryJob):
+  """The copies of the template of Instances as one triangle set, a
+  block of instances a chunk"""
+
+  def __init__(self, instances):
+    self.template = instances.template( instances.lod)
+    self.positions = instances.positions
+    self.scales = instances.scales
+    self.orientations = instances.orientations
+    self.colors = instances.colors
+    if self.colors is not None:
+      self.vertexAttributes = self.vertexAttributes + [
+        ("colors", np.uint8, 3)]
+    n = len(self.positions)
+    step = max( 1, chunkSize//len(self.template[0]))
+    self.chunks = [(i, min( i+step, n)) for i in range(0, n, step)]
+
+  def sizes(self, chunk):
+    verts, normals, faces = self.template
+    return ((chunk[1]-chunk[0])*len(verts), (chunk[1]-chunk[0])*len(faces))
+
+  def fill(self, chunk, arrays):
+    a, b = chunk
+    verts, normals, faces = self.template
+    s = self.scales[a:b,None,:].astype(np.float64)
+    v = verts[None]*s
+    n = normals[None]/np.where( s != 0., s, 1.)
+    if self.orientations is not None:
+      rot = quaternionMatrices( self.orientations[a:b])
+      v = np.einsum( 'nij,nvj->nvi', rot, v)
+      n = np.einsum( 'nij,nvj->nvi', rot, n)
+    n /= np.maximum( np.linalg.norm( n, axis=2, keepdims=True), 1e-30)
+    v += self.positions[a:b,None,:]
+    arrays["vertices"][:] = v.reshape(-1,3)
+    arrays["normals"][:] = n.reshape(-1,3)
+    if self.colors is not None:
+      arrays["colors"][:] = np.repeat( self.colors[a:b], len(verts), axis=0)
+    arrays["faces"][:] = (faces[None] + len(verts)*np.arange(
+      b-a, dtype=np.uint32)[:,None,None]).reshape(-1,3)
+    return (b-a)*len(faces)
+
+class Sphere(Instances):
+  """Spheres at centers with the given radius, a scalar or one per
+  sphere"""
+
+  template = staticmethod( sphereTemplate)
+
+  def __init__(self, centers, radius=1., **kwargs):
+    Instances.__init__( self, centers, radius, **kwargs)
+
+class Cylinder(Instances):
+  """Cylinders from the points start to the points end with the given
+  radius, a scalar or one per cylinder"""
+
+  template = staticmethod( cylinderTemplate)
+
+  def __init__(self, start, end, radius=1., **kwargs):
+    start = vertexArray( start)
+    axis = vertexArray( end) - start
+    length = np.linalg.norm( axis, axis=1)
+    radius = np.broadcast_to( np.asarray(radius, dtype=np.float32),
+                              length.shape)
+    scales = np.stack( (radius, radius, length), axis=1)
+    Instances.__init__( self, start, scales,
+                        orientations = zToDirection( axis), **kwargs)
+
+class Box(Instances):
+  """Boxes at centers with the given size, a scalar, one per box, or
+  an (N,3) array of widths, and optional (N,4) quaternion
+  orientations"""
+
+  template = staticmethod( boxTemplate)
+
+  def __init__(self, centers, size=1., **kwargs):
+    Instances.__init__( self, centers, size, **kwargs)
+
+# Polyline simplification
+#
+# Both methods work on every interval or point of a line at once. The
+# coordinates are split into x, y and z arrays so the arithmetic runs
+# over contiguous memory.
+
+def lineDistances( xyz, a, b, count, idx):
+  """Squared distances of the points idx, taken count at a time, from
+  the lines through the points a and b, or from a where b is a"""
+  ab = [c[b] - c[a] for c in xyz]
+  l2 = ab[0]*ab[0] + ab[1]*ab[1] + ab[2]*ab[2]
+  ap = [c[idx] - np.repeat( c[a], count) for c in xyz]
+  ab = [np.repeat( c, count) for c in ab]
+  d2 = np.zeros( len(ap[0]), dtype=ap[0].dtype)
+  for i, j in ((1, 2), (2, 0), (0, 1)):
+    c = ap[i]*ab[j]
+    c -= ap[j]*ab[i]
+    c *= c
+    d2 += c
+  inv = np.zeros( len(l2), dtype=d2.dtype)
+  np.divide( 1., l2, out=inv, where=l2 > 0.)
+  d2 *= np.repeat( inv, count)
+  if not (l2 > 0.).all():
+    same = np.repeat( l2 == 0., count)
+    d2[same] = sum( [c[same]*c[same] for c in ap])
+  return d2
+
+def rdpRefine( xyz, keep, tolerance):
+  """Split the intervals between the points marked in keep at their
+  farthest point until every point is within tolerance"""
+  n = len(keep)
+  kept = np.flatnonzero( keep)
+  a, b = kept[:-1], kept[1:]
+  while len(a):
+    # An interval covers its first point, which is at distance 0, so
+    # intervals that tile the line cover the points 0 to n-2.
+    count = b - a
+    m = count > 1
+    a, b, count = a[m], b[m], count[m]
+    if len(a) == 0:
+      break
+    starts = np.cumsum( count) - count
+    if int(count.sum()) == n-1:
+      idx = slice( 0, n-1)
+      pos = np.arange( n-1)
+    else:
+      pos = np.arange( int(count.sum())) + np.repeat( a - starts, count)
+      idx = pos
+    d2 = lineDistances( xyz, a, b, count, idx)
+    dmax = np.maximum.reduceat( d2, starts)
+    split = dmax > tolerance*tolerance
+    far = np.minimum.reduceat( np.where( d2 == np.repeat( dmax, count),
+                                         pos, n), starts)[split]
+    keep[far] = True
+    # The intervals stay in order along the line, which the pass over
+    # all the points above relies on.
+    a = np.concatenate( (a[split], far))
+    b = np.concatenate( (far, b[split]))
+    order = np.argsort( a, kind="stable")
+    a, b = a[order], b[order]
+  return keep
+
+def rdpMask( xyz, tolerance, stride=32):
+  """The points Ramer-Douglas-Peucker keeps for a line within
+  tolerance. Long lines are first simplified from every stride'th
+  point, and the result refined with all the points, which avoids
+  passing over all of them at every level of the recursion."""
+  n = len(xyz[0])
+  keep = np.zeros( n, dtype=bool)
+  keep[0] = keep[-1] = True
+  if n > 64*stride:
+    coarse = np.append( np.arange(0, n-1, stride), n-1)
+    keep[coarse[rdpMask( [c[coarse] for c in xyz], tolerance, stride)]] = True
+  return rdpRefine( xyz, keep, tolerance)
+
+def triangleAreas( p):
+  """Twice the area, squared, of the triangle of every inner point of
+  the line p with its neighbors, and infinity at the ends"""
+  # The cross product of the two sides from a point is that of the
+  # segments before and after it.
+  d = [np.diff( c) for c in p]
+  u = [c[:-1] for c in d]
+  v = [c[1:] for c in d]
+  area = np.full( len(p[0]), np.inf, dtype=d[0].dtype)
+  inner = area[1:-1]
+  inner[:] = 0.
+  w = np.empty_like( inner)
+  t = np.empty_like( inner)
+  for a, b in ((1, 2), (2, 0), (0, 1)):
+    np.multiply( u[a], v[b], out=w)
+    w -= np.multiply( u[b], v[a], out=t)
+    w *= w
+    inner += w
+  return area
+
+def visvalingamMask( xyz, tolerance, rounds=16):
+  """The points Visvalingam-Whyatt keeps for a line, removing points
+  whose triangle with their neighbors has an area below tolerance
+  squared. Rather than one point at a time, every round removes all
+  such points that have a smaller area than both neighbors. After
+  rounds rounds, or a round that removes less than an eighth of the
+  points below the limit, a last pass removes every other point of
+  each run of them. The cost is then at most rounds+1 passes over the
+  line, but where each removal uncovers the next, as on a zig-zag of
+  growing amplitude, some points below the limit are kept."""
+  n = len(xyz[0])
+  limit = 4.*tolerance**4
+  active = np.arange( n)
+  p = list(xyz)
+  for r in range(rounds+1):
+    if len(active) <= 2:
+      break
+    area = triangleAreas( p)
+    below = area[1:-1] < limit
+    count = np.count_nonzero( below)
+    if count == 0:
+      break
+    # Points removed together are never neighbors, as a point's area
+    # is below the one on its left and not above the one on its right.
+    remove = below & (area[1:-1] < area[:-2]) & (area[1:-1] <= area[2:])
+    last = r == rounds or 8*np.count_nonzero( remove) < count
+    if last:
+      i = np.arange( len(below))
+      runStart = np.maximum.accumulate(
+        np.where( below & ~np.r_[False, below[:-1]], i, 0))
+      remove = below & ((i - runStart) % 2 == 0)
+    keep = np.ones( len(active), dtype=bool)
+    keep[1:-1] = ~remove
+    # Gathering by index is faster than by a mask of scattered points.
+    kept = np.flatnonzero( keep)
+    active = active.take( kept)
+    p = [c.take( kept) for c in p]
+    if last:
+      break
+  mask = np.zeros( n, dtype=bool)
+  mask[active] = True
+  return mask
+
 _lDefaultDict = {
   "lineColor" : '0x000000',
   "lineWidth" : 2.,
@@ -372,58 +1859,129 @@ _lDefaultDict = {
 }
 
 class Line(GeoVertObj):
-  """An ordered list of vertices with a line drawn between them."""
+  """An ordered list of vertices with a line drawn between them.
+
+  The vertices are held as an (N,3) float32 array, and may be given as
+  one array or list, or as one argument per vertex. Per vertex scalars
+  color the line in place of lineColor."""
 
   def __init__(self, *args, **kwargs):
     if len(args) == 1:
-      self.vertices = [vec3(x) for x in args[0][:]]
+      self.vertices = vertexArray( args[0])
     else:
-      self.vertices = [vec3(x) for x in args[:]]
+      self.vertices = vertexArray( args)
     for attr in _lDefaultDict:
       if attr in kwargs:
         setattr( self, attr, kwargs[attr])
       else:
         setattr( self, attr, _lDefaultDict[attr])
+    setScalarAttributes( self, kwargs)
     if self.closed:
-      self.vertices = self.vertices + [self.vertices[0]]
+      self.vertices = np.concatenate( (self.vertices, self.vertices[:1]))
+      if self.scalars is not None:
+        self.scalars = np.concatenate( (self.scalars, self.scalars[:1]))
 
+  @versioned
+  def boundingBox(self):
+    """The bounding box given as two Vector3's that hold the minimum
+    and maximum x, y, and z coordinates."""
+    return arrayBoundingBox( self.vertices)
 
   def lineCenter(self, lineIndex):
-    v0, v1 = self.vertices[lineIndex:lineIndex+2]
-    return 0.5*(v0+v1)
+    v0, v1 = self.vertices[lineIndex:lineIndex+2].astype(np.float64)
+    return Vector3( 0.5*(v0+v1))
 
   def lineLength(self, lineIndex):
-    v0, v1 = self.vertices[lineIndex:lineIndex+2]
-    return mag(v0-v1)
+    v0, v1 = self.vertices[lineIndex:lineIndex+2].astype(np.float64)
+    return float( np.linalg.norm( v0-v1))
 
+  @versioned
   def stats(self):
-    lc = [self.lineCenter(i) for i in range(0,len(self.vertices)-1)]
-    ll = [self.lineLength(i) for i in range(0,len(self.vertices)-1)]
-    num = sum([x*y for x,y in zip(lc,ll)])
-    denom = sum(ll)
-    return (num, denom)
+    """Returns and ordered pair that give the sum of the length
+    weighted centers of the segments, and the total length."""
+    num = np.zeros(3)
+    denom = 0.
+    n = len(self.vertices)
+    for sl in chunks( max( n-1, 0)):
+      v = np.ascontiguousarray( self.vertices[sl.start:sl.stop+1].T,
+                                dtype=np.float64)
+      length = np.sqrt( ((v[:,1:]-v[:,:-1])**2).sum(axis=0))
+      num += 0.5*((v[:,1:]+v[:,:-1])*length).sum(axis=1)
+      denom += float( length.sum())
+    return (Vector3(num), denom)
+
+  def pixelTolerance(self, pixels, kwargs):
+    """The size of pixels pixels where the line comes nearest to the
+    camera that render, with the keywords kwargs, fits to it"""
+    renderD = sceneParameters( [self], kwargs)
+    vmin, vmax = self.boundingBox()
+    eye = np.array( renderD["cameraPosition"].v)
+    gap = np.maximum( np.maximum( np.array(vmin.v) - eye, eye - vmax.v), 0.)
+    dist = max( float( np.linalg.norm( gap)), renderD["cameraFrontPlane"])
+    height = kwargs.get( "height", 400)
+    return pixels*2.*dist*math.tan( 0.5*renderD["cameraFOV"])/height
+
+  def simplify(self, tolerance=None, method="rdp", pixels=1., **kwargs):
+    """A copy of the line through a subset of its vertices.
+
+    method "rdp" (Ramer-Douglas-Peucker) keeps every vertex within
+    tolerance of the simplified line, "visvalingam" drops the vertices
+    whose triangle with their neighbors has an area below tolerance
+    squared. Without a tolerance, it is the size of pixels pixels of a
+    canvas height pixels high, where the line is nearest the camera
+    that render, given the same keywords, fits to it."""
+    if tolerance is None:
+      tolerance = self.pixelTolerance( pixels, kwargs)
+    line = copy.copy( self)
+    # The copy is drawn, cached and recolored on its own.
+    line.clearCache()
+    line.colormapId = str( uuid())
+    if len(self.vertices) < 3:
+      return line
+    xyz = [np.ascontiguousarray( self.vertices[:,i]) for i in range(3)]
+    if method == "rdp":
+      keep = rdpMask( xyz, tolerance)
+    elif method == "visvalingam":
+      keep = visvalingamMask( xyz, tolerance)
+    else:
+      raise ValueError( "unknown simplification method " + repr(method))
+    kept = np.flatnonzero( keep)
+    line.vertices = self.vertices.take( kept, axis=0)
+    if self.scalars is not None:
+      line.scalars = self.scalars.take( kept)
+    return line
 
   lScene = """\
   var material = new THREE.LineBasicMaterial({{
     color : {LINE_COLOR},
     linewidth : {LINE_WIDTH},
+    vertexColors : {VERTEX_COLORS},
     fog : true
   }});
-  var geometry = new THREE.Geometry();
-  geometry.vertices.push(
-    {VERTEX_LIST}
-  );
+{COLOR_MAP}
+  var geometry = pyplot3d.geometry( "{KEY}", function() {{
+    var geometry = new THREE.BufferGeometry();
+    geometry.addAttribute( 'position', new THREE.BufferAttribute(
+      {POSITIONS}, 3));
+    {ATTRIBUTES}
+    return geometry;
+  }});
   var line = new THREE.Line( geometry, material);
   scene.add( line);
   """
 
-  def render(self):
-    vertStr = [new3jsVector3(v) for v in self.vertices]
-    vertStr = ",\n  ".join(vertStr)
+  def render(self, shared=True):
+    posStr = self.encoded( "vertices", "<f4")
+    mapStr, colorStr = colorAttributes( self)
     return (self.lScene.format(
-              LINE_COLOR = self.lineColor,
+              LINE_COLOR = "0xffffff" if colorStr else self.lineColor,
               LINE_WIDTH = "{}".format(self.lineWidth),
-              VERTEX_LIST = vertStr
+              VERTEX_COLORS = ("THREE.NoColors",
+                               "THREE.VertexColors")[colorStr != ""],
+              COLOR_MAP = mapStr,
+              KEY = geometryKey( posStr, colorStr) if shared else "",
+              POSITIONS = posStr,
+              ATTRIBUTES = colorStr
             ))
 
 _pDefaultDict = {
@@ -431,25 +1989,50 @@ _pDefaultDict = {
   "pointEdgeWidth" : 1.,
   "pointEdgeColor" : False,
   "pointSize" : 1.,
-  "pointStyle" : 'circle'
+  "pointStyle" : 'circle',
+  "depthSort" : False
 }
 
 class Point(GeoVertObj):
+  """Sprites of pointStyle drawn at the vertices. Per vertex scalars
+  color the sprites in place of pointColor. With depthSort the sprites
+  are drawn back to front, see depthOrders.
+
+  The vertices are held as an (N,3) float32 array, given as one
+  argument per vertex, or as a single (N,3) array or out of core
+  source."""
+
   def __init__(self, *args, **kwargs):
-    self.vertices = [vec3(x) for x in args[:]]
+    if len(args) == 1 and (isSource( args[0]) or np.ndim( args[0]) == 2):
+      self.vertices = vertexArray( args[0])
+    else:
+      self.vertices = vertexArray( args)
     for attr in _pDefaultDict:
       if attr in kwargs:
         setattr( self, attr, kwargs[attr])
       else:
         setattr( self, attr, _pDefaultDict[attr])
+    setScalarAttributes( self, kwargs)
     if self.pointStyle == 'x' or self.pointStyle == '+':
       self.pointColor = False
       if not self.pointEdgeColor:
         self.pointEdgeColor = 'rgb(0,0,0)'
 
+  @versioned
+  def boundingBox(self):
+    """The bounding box given as two Vector3's that hold the minimum
+    and maximum x, y, and z coordinates."""
+    return arrayBoundingBox( self.vertices)
+
+  @versioned
   def stats(self):
-    num = sum(self.vertices)
-    return (num, len(self.vertices))
+    """Returns and ordered pair that give the sum of the vertices, and
+    their number."""
+    num = np.zeros(3)
+    for sl in chunks( len(self.vertices)):
+      num += np.ascontiguousarray( self.vertices[sl].T,
+                                   dtype=np.float64).sum(axis=1)
+    return (Vector3(num), len(self.vertices))
 
   pCanv = """\
     var canv = document.createElement('canvas');
@@ -550,33 +2133,62 @@ class Point(GeoVertObj):
     transparent: true,
     size: canvSize,
     sizeAttenuation: false,
+    vertexColors: {VERTEX_COLORS},
     fog: true
   }});
   material.alphaTest = 0.05;
-  var geometry = new THREE.Geometry();
-  geometry.vertices.push(
-    {VERTEX_LIST}
-  )
+{COLOR_MAP}
+  var geometry = pyplot3d.geometry( "{KEY}", function() {{
+    var geometry = new THREE.BufferGeometry();
+    geometry.addAttribute( 'position', new THREE.BufferAttribute(
+      {POSITIONS}, 3));
+    {ATTRIBUTES}
+    return geometry;
+  }});
   var point = new THREE.PointCloud(geometry, material);
-  point.sortParticles = true;
   scene.add( point);
   """
 
-  def render(self):
+  def renderCanvas(self):
+    """The script that draws the point sprite onto canv. The vertex
+    colors of scalars multiply the sprite, so it is filled white."""
     canvStr = self.pCanv.format(POINT_SIZE = self.pointSize,
                                 EDGE_WIDTH = self.pointEdgeWidth)
     canvStr = canvStr + self.pointStyles[self.pointStyle]
     if self.pointColor:
       canvStr = canvStr + self.pointFill.format(
-          POINT_COLOR = self.pointColor)
+          POINT_COLOR = self.pointColor if self.scalars is None
+                        else 'rgb(255,255,255)')
     if self.pointEdgeColor:
       canvStr = canvStr + self.pointStroke.format(
           EDGE_WIDTH = self.pointEdgeWidth,
           EDGE_COLOR = self.pointEdgeColor)
-    vertStr = [new3jsVector3(v) for v in self.vertices]
-    vertStr = ",\n  ".join(vertStr)
+    return canvStr
+
+  @versioned
+  def depthOrders(self):
+    """The orders of the points along the depthDirections"""
+    return depthOrders( self.vertices)
+
+  def render(self, shared=True):
+    canvStr = self.renderCanvas()
+    posStr = self.encoded( "vertices", "<f4")
+    mapStr, colorStr = colorAttributes( self)
+    # With depthSort the sprites blend back to front, unless the page
+    # maps live colors, in the order the points were sent. The
+    # vertices are reordered, so the geometry is not shared.
+    depthSorted = self.depthSort and len(self.vertices) > 0 and not mapStr
+    shared = shared and not depthSorted
     sceneStr = self.pScene.format(
-        VERTEX_LIST = vertStr)
+        VERTEX_COLORS = ("THREE.NoColors",
+                         "THREE.VertexColors")[colorStr != ""],
+        COLOR_MAP = mapStr,
+        KEY = geometryKey( posStr, colorStr) if shared else "",
+        POSITIONS = posStr,
+        ATTRIBUTES = colorStr)
+    if depthSorted:
+      sceneStr = sceneStr + renderDepthOrder( self, "point",
+                                              self.depthOrders(), 1)
     return (canvStr + sceneStr)
   # pMaterial = """\
   # var texture = new THREE.Texture(canv);
@@ -701,7 +2313,6 @@ class Text(GeoVertObj):
     new THREE.Vector3({POSITION})
   )
   var point = new THREE.PointCloud(geometry, material);
-  point.sortParticles = true;
   scene.add( point);
   """
 
@@ -723,6 +2334,354 @@ class Text(GeoVertObj):
         POSITION = self.vertices[0])
     return (canvStr + sceneStr)
 
+# Shared vertex sets
+#
+# A GeoSet holds one vertex array, with its normals and colors, and
+# index arrays of the points, edges and faces drawn from it. The page
+# uploads the vertex buffers once and draws the faces as a mesh, the
+# edges as line pieces and the points as sprites, each through its own
+# index, so a shape whose outline, faces and corners share vertices
+# sends and stores them once. Faces are shaded with the vertex
+# normals, so faces meeting at a crease need vertices of their own.
+_gsDefaultDict = dict( _tsDefaultDict)
+del _gsDefaultDict["smooth"]
+_gsDefaultDict.update( (attr, _lDefaultDict[attr])
+                       for attr in ("lineColor", "lineWidth"))
+_gsDefaultDict.update( _pDefaultDict)
+del _gsDefaultDict["depthSort"]
+
+class GeoSet(GeoVertObj):
+  """Points, edges and faces that index one set of vertices.
+
+  The vertices are held as an (N,3) float32 array, points as an (P,)
+  array of the vertices drawn as sprites, edges as an (E,2) array of
+  the vertex pairs joined by lines and faces as an (F,3) array of
+  triangles, all uint32 and any of them may be None. The normals,
+  colors and scalars keywords are those of TriangleSet, and the
+  style keywords those of TriangleSet, Line and Point."""
+
+  def __init__(self, vertices, points=None, edges=None, faces=None,
+               **kwargs):
+    self.vertices = vertexArray( vertices)
+    self.points = None if points is None else \
+        np.unique( np.asarray( points, dtype=np.uint32).reshape(-1))
+    self.edges = None if edges is None else indexArray( edges, 2)
+    self.faces = None if faces is None else indexArray( faces, 3)
+    self.normals = kwargs.get("normals")
+    self.colors = kwargs.get("colors")
+    if isSource( self.normals):
+      self.normals = sourceArray( self.normals, 3, np.float32)
+    if isSource( self.colors):
+      self.colors = sourceArray( self.colors, 3, np.uint8)
+    for attr in _gsDefaultDict:
+      if attr in kwargs:
+        setattr( self, attr, kwargs[attr])
+      else:
+        setattr( self, attr, _gsDefaultDict[attr])
+    setScalarAttributes( self, kwargs)
+    if self.pointStyle == 'x' or self.pointStyle == '+':
+      self.pointColor = False
+      if not self.pointEdgeColor:
+        self.pointEdgeColor = 'rgb(0,0,0)'
+
+  @versioned
+  def boundingBox(self):
+    """The bounding box given as two Vector3's that hold the minimum
+    and maximum x, y, and z coordinates."""
+    return arrayBoundingBox( self.vertices)
+
+  @versioned
+  def smoothNormals(self):
+    """The (N,3) vertex normals, those given or the area weighted
+    normals of the faces"""
+    if self.normals is not None or self.faces is None:
+      return self.normals
+    return vertexNormals( self.vertices, self.faces)
+
+  @versioned
+  def stats(self, dw=1.):
+    """The area weighted centers of the faces, with the lengths of the
+    edges weighted by dw and the points by dw squared, as sceneStats
+    does for separate objects"""
+    num = np.zeros(3)
+    denom = 0.
+    v = self.vertices
+    if self.faces is not None:
+      for sl in chunks( len(self.faces)):
+        tri = v[self.faces[sl]].astype(np.float64)
+        area = 0.5*np.linalg.norm( np.cross( tri[:,1]-tri[:,0],
+                                             tri[:,2]-tri[:,0]), axis=1)
+        num += (tri.sum(axis=1)/3.*area[:,None]).sum(axis=0)
+        denom += float( area.sum())
+    if self.edges is not None:
+      for sl in chunks( len(self.edges)):
+        seg = v[self.edges[sl]].astype(np.float64)
+        length = np.linalg.norm( seg[:,1]-seg[:,0], axis=1)*dw
+        num += (seg.sum(axis=1)/2.*length[:,None]).sum(axis=0)
+        denom += float( length.sum())
+    if self.points is not None:
+      num += v[self.points].astype(np.float64).sum(axis=0)*(dw*dw)
+      denom += len(self.points)*(dw*dw)
+    return (Vector3(num), denom)
+
+  # The sprite is drawn as Point draws it.
+  pCanv = Point.pCanv
+  pointStyles = Point.pointStyles
+  pointFill = Point.pointFill
+  pointStroke = Point.pointStroke
+  renderCanvas = Point.renderCanvas
+
+  gsScene = """\
+  {MATERIAL}
+  var lineMaterial = new THREE.LineBasicMaterial({{
+    color : {LINE_COLOR},
+    linewidth : {LINE_WIDTH},
+    vertexColors : {VERTEX_COLORS},
+    fog : true
+  }});
+{COLOR_MAP}
+  var set = pyplot3d.geometry( "{KEY}", function() {{
+    var geometry = new THREE.BufferGeometry();
+    geometry.addAttribute( 'position', new THREE.BufferAttribute(
+      {POSITIONS}, 3));
+    {ATTRIBUTES}
+    return pyplot3d.geometrySet( geometry.attributes, {FACES}, {EDGES},
+                                 {POINTS});
+  }});
+  if (set.faces) {{
+    scene.add( new THREE.Mesh( set.faces, material));
+  }}
+  if (set.edges) {{
+    scene.add( new THREE.Line( set.edges, lineMaterial, THREE.LinePieces));
+  }}
+  """
+
+  gsPoints = """\
+  var texture = new THREE.Texture(canv);
+  texture.needsUpdate = true;
+  var pointMaterial = new THREE.PointCloudMaterial({{
+    map: texture,
+    transparent: true,
+    size: canvSize,
+    sizeAttenuation: false,
+    vertexColors: {VERTEX_COLORS},
+    fog: true
+  }});
+  pointMaterial.alphaTest = 0.05;
+  scene.add( new THREE.PointCloud( set.points, pointMaterial));
+  """
+
+  def vertexOrder(self):
+    """The order the vertices are sent in, with the points first so
+    that the page draws them as the leading vertices of the buffer,
+    or None if they are sent as they are"""
+    n = len(self.vertices)
+    if self.points is None:
+      return None
+    leading = np.array_equal( self.points, np.arange( len(self.points)))
+    if self.faces is None and self.edges is None:
+      # Only the points are drawn, so only they are sent.
+      return None if leading and len(self.points) == n else self.points
+    if leading:
+      return None
+    rest = np.ones( n, dtype=bool)
+    rest[self.points] = False
+    return np.concatenate( (self.points, np.flatnonzero( rest)))
+
+  def render(self, shared=True):
+    """The script that adds the faces, edges and points to the scene,
+    see TriangleSet.render for shared"""
+    order = self.vertexOrder()
+    faces, edges = self.faces, self.edges
+    if order is not None:
+      rank = np.empty( len(self.vertices), dtype=np.int64)
+      rank[order] = np.arange( len(order))
+      faces = None if faces is None else rank[faces]
+      edges = None if edges is None else rank[edges]
+    dtype = indexDtype( len(self.vertices))
+    def indexStr( idx):
+      if idx is None or len(idx) == 0:
+        return "null"
+      return "new THREE.BufferAttribute( {}, 1)".format(
+               encodeArray( idx, dtype))
+    posStr = self.encoded( "vertices", "<f4", order, "order")
+    mapStr, colorStr = colorAttributes( self, order)
+    attrStr = colorStr
+    if self.normals is not None and self.faces is not None:
+      attrStr = TriangleSet.tsNormal.format(
+          NORMALS = self.encoded( "normals", "<f4", order, "order")) + attrStr
+    facesStr = self.cached( "encoded faces", lambda: indexStr( faces),
+                            ("version",))
+    edgesStr = self.cached( "encoded edges", lambda: indexStr( edges),
+                            ("version",))
+    pointsStr = "null" if self.points is None else str( len(self.points))
+    vertexColors = ("THREE.NoColors", "THREE.VertexColors")[colorStr != ""]
+    sceneStr = self.gsScene.format(
+        MATERIAL = renderMaterial( self, colorStr != ""),
+        LINE_COLOR = "0xffffff" if colorStr else self.lineColor,
+        LINE_WIDTH = "{}".format(self.lineWidth),
+        VERTEX_COLORS = vertexColors,
+        COLOR_MAP = mapStr,
+        KEY = geometryKey( posStr, attrStr, facesStr, edgesStr, pointsStr)
+              if shared else "",
+        POSITIONS = posStr,
+        ATTRIBUTES = attrStr,
+        FACES = facesStr,
+        EDGES = edgesStr,
+        POINTS = pointsStr)
+    if self.points is None:
+      return sceneStr
+    return (sceneStr + self.renderCanvas() +
+            self.gsPoints.format( VERTEX_COLORS = vertexColors))
+
+# Scene graph groups
+#
+# A Group holds child objects, and other groups, in its own coordinates
+# and a Matrix4 that places them in its parent's. The page draws the
+# children in a THREE.Object3D with that matrix, so the vertices are
+# never transformed in Python or sent more than once: a child that
+# appears several times in a group tree is rendered into one function
+# that every occurrence calls, and its geometry is built once.
+
+def matrixArray( matrix):
+  """A Matrix4 as a (4,4) float64 array"""
+  return np.array( matrix.m, dtype=np.float64).reshape(4,4)
+
+def transformPoints( points, matrix):
+  """(N,3) points mapped by the (4,4) array matrix"""
+  points = np.asarray( points, dtype=np.float64)
+  return points.dot( matrix[:3,:3].T) + matrix[:3,3]
+
+def transformNormals( normals, matrix):
+  """(N,3) unit normals mapped by the (4,4) array matrix"""
+  n = np.asarray( normals, dtype=np.float64).dot(
+        np.linalg.inv( matrix[:3,:3]))
+  length = np.linalg.norm( n, axis=1, keepdims=True)
+  return n/np.where( length > 0., length, 1.)
+
+def transformBox( box, matrix):
+  """The bounding box of the box (vmin, vmax) mapped by the (4,4)
+  array matrix"""
+  vmin, vmax = np.array( box[0].v), np.array( box[1].v)
+  c = np.arange(8)
+  corners = np.where( np.stack( (c & 1, c & 2, c & 4), axis=1) > 0,
+                      vmax, vmin)
+  p = transformPoints( corners, matrix)
+  return (Vector3( p.min(axis=0)), Vector3( p.max(axis=0)))
+
+def groupLeaves( geoObjs, matrix=None):
+  """The objects that are not groups in the trees of geoObjs, as
+  (geoObj, matrix) pairs where matrix maps geoObj to the world"""
+  if matrix is None:
+    matrix = np.eye(4)
+  for geoObj in geoObjs:
+    if isinstance( geoObj, Group):
+      for leaf in groupLeaves( geoObj.children,
+                               matrix.dot( matrixArray( geoObj.matrix))):
+        yield leaf
+    else:
+      yield (geoObj, matrix)
+
+def sceneStats( geoObj, dw):
+  """The stats of geoObj, with the lengths of lines weighted by dw and
+  the counts of points and text by dw squared, so they are comparable
+  with areas"""
+  if isinstance( geoObj, (Group, GeoSet)):
+    return geoObj.stats( dw)
+  num, denom = geoObj.stats()
+  if isinstance( geoObj, Line):
+    num, denom = num*dw, denom*dw
+  if isinstance( geoObj, Point) or isinstance( geoObj, Text):
+    num, denom = num*(dw*dw), denom*(dw*dw)
+  return (num, denom)
+
+class Group:
+  """Child objects drawn through matrix, a Matrix4 that maps their
+  coordinates into those of the group's parent"""
+
+  def __init__(self, *children, **kwargs):
+    self.children = list(children)
+    matrix = kwargs.get("matrix")
+    if matrix is None:
+      matrix = scale(1.)
+    elif not isinstance( matrix, Matrix4):
+      matrix = Matrix4( matrix)
+    self.matrix = matrix
+
+  def add(self, *children):
+    """Add children to the group"""
+    self.children.extend( children)
+    return self
+
+  def boundingBox(self):
+    """The bounding box of the transformed bounding boxes of the
+    children"""
+    m = matrixArray( self.matrix)
+    if not self.children:
+      return transformBox( (Vector3(0,0,0), Vector3(0,0,0)), m)
+    boxes = [transformBox( child.boundingBox(), m)
+             for child in self.children]
+    return totalBoundingBox( boxes)
+
+  def stats(self, dw=1.):
+    """The sum of the children's stats, with their weighted centers
+    transformed. dw weighs lines and points against areas as in
+    sceneStats."""
+    m = matrixArray( self.matrix)
+    num = np.zeros(3)
+    denom = 0.
+    for child in self.children:
+      objNum, objDenom = sceneStats( child, dw)
+      if isinstance( objNum, Vector3):
+        num += m[:3,:3].dot( objNum.v)
+      num += m[:3,3]*objDenom
+      denom += objDenom
+    return (Vector3(num), denom)
+
+  gFunction = """\
+  var {NAME} = function( scene) {{
+  {SCRIPT}
+  }};
+  """
+
+  gNode = """\
+  (function( parent) {{
+    var scene = new THREE.Object3D();
+    scene.matrixAutoUpdate = false;
+    scene.matrix.set( {ELEMENTS});
+  {CHILDREN}
+    parent.add( scene);
+  }})( scene);
+  """
+
+  def renderNode(self, functions):
+    """The script that adds the group to scene, calling the functions
+    of its children, which are added to functions, by id of child,
+    as they are first met"""
+    childStr = ""
+    for child in self.children:
+      if isinstance( child, Group):
+        childStr = childStr + child.renderNode( functions)
+        continue
+      if id(child) not in functions:
+        name = "child{}".format( len(functions))
+        functions[id(child)] = (name, self.gFunction.format(
+                                  NAME = name, SCRIPT = renderObject( child)))
+      childStr = childStr + "  {}( scene);\n".format(
+                   functions[id(child)][0])
+    return self.gNode.format(
+             ELEMENTS = ", ".join( ["{}".format(x) for row in self.matrix.m
+                                    for x in row]),
+             CHILDREN = childStr)
+
+  def render(self):
+    """The script that adds the group tree to the scene"""
+    functions = {}
+    nodeStr = self.renderNode( functions)
+    return ("  (function() {\n" +
+            "".join( [f for name, f in functions.values()]) +
+            nodeStr + "  })();\n")
+
 
 defaultLighting = """\
   var light = new THREE.DirectionalLight( 0x882222 );
@@ -753,13 +2712,489 @@ htmlWrapper = """\
 </html>
 """
 
+# One WebGL context for the whole page
+#
+# Browsers keep only about 16 WebGL contexts alive, so the plots do not
+# get one each. The first plot on the page creates window.pyplot3d,
+# whose offscreen renderer draws every plot's scene into the corner of
+# its canvas, and copies the image into the plot's 2D canvas. Geometry
+# built under the same key is built once and drawn by every plot that
+# asks for it from the same GPU buffers. Every plot loads three.js
+# again, so the page keeps using the copy the renderer was made with.
+pageScript = """\
+if (!window.pyplot3d) {
+  window.pyplot3d = {
+    THREE : THREE,
+    renderer : new THREE.WebGLRenderer({
+      alpha : true,
+      antialias : true,
+      preserveDrawingBuffer : true,
+      devicePixelRatio : 1
+    }),
+    width : 0,
+    height : 0,
+
+    // The geometries by key, each with the plots that draw it and the
+    // color attributes of colorMaps filled into it. A plot is known by
+    // its canvas and holds its share until the canvas leaves the
+    // document, then the geometries no plot holds are disposed.
+    // Geometries without a key belong to one plot.
+    geometries : {},
+    plots : [],
+    canvases : new WeakMap(),
+    plot : null,
+    entry : null,
+    serial : 0,
+
+    geometry : function( key, build) {
+      if (!key) {
+        key = ' ' + this.serial++;
+      }
+      var entry = this.geometries[key];
+      if (!entry) {
+        entry = this.geometries[key] = { key : key, value : null,
+                                         plots : [], targets : [] };
+        var outer = this.entry;
+        this.entry = entry;
+        try {
+          entry.value = build();
+        } catch (e) {
+          delete this.geometries[key];
+          throw e;
+        } finally {
+          this.entry = outer;
+        }
+      }
+      this.own( entry);
+      return entry.value;
+    },
+
+    // Run f, which builds the scene of the plot on canvas, or part of
+    // it, so the plot holds what it asks for.
+    building : function( canvas, f) {
+      var outer = this.plot;
+      this.plot = canvas;
+      try {
+        f();
+      } finally {
+        this.plot = outer;
+      }
+    },
+
+    plotOf : function( canvas) {
+      var plot = this.canvases.get( canvas);
+      if (!plot) {
+        plot = { canvas : canvas, entries : [], redraws : [],
+                 released : false };
+        this.canvases.set( canvas, plot);
+      }
+      return plot;
+    },
+
+    own : function( entry) {
+      if (!this.plot) {
+        return;
+      }
+      var plot = this.plotOf( this.plot);
+      if (entry.plots.indexOf( plot) < 0) {
+        entry.plots.push( plot);
+        plot.entries.push( entry);
+        this.watch( plot);
+      }
+    },
+
+    watch : function( plot) {
+      if (this.plots.indexOf( plot) < 0) {
+        this.plots.push( plot);
+      }
+      if (!this.observer && window.MutationObserver) {
+        var self = this;
+        this.observer = new MutationObserver( function() {
+          self.collect();
+        });
+        this.observer.observe( document.body,
+                               { childList : true, subtree : true });
+      }
+    },
+
+    collect : function() {
+      var gone = this.plots.filter( function( plot) {
+        return !document.body.contains( plot.canvas);
+      });
+      for (var i = 0; i < gone.length; i++) {
+        this.release( gone[i]);
+      }
+    },
+
+    // Drop the plot's share of its geometries, and dispose those no
+    // other plot holds, with their color attributes. The plot's
+    // redraws leave its color maps, and maps left empty are dropped.
+    release : function( plot) {
+      this.plots.splice( this.plots.indexOf( plot), 1);
+      plot.released = true;
+      var maps = [];
+      for (var i = 0; i < plot.entries.length; i++) {
+        var entry = plot.entries[i];
+        entry.plots.splice( entry.plots.indexOf( plot), 1);
+        if (entry.plots.length > 0) {
+          continue;
+        }
+        if (this.geometries[entry.key] === entry) {
+          delete this.geometries[entry.key];
+        }
+        for (var j = 0; j < entry.targets.length; j++) {
+          var target = entry.targets[j], targets = target.map.targets;
+          targets.splice( targets.indexOf( target), 1);
+          maps.push( target.map);
+        }
+        this.dispose( entry.value);
+      }
+      for (var i = 0; i < plot.redraws.length; i++) {
+        var redraw = plot.redraws[i], redraws = redraw.map.redraws;
+        redraws.splice( redraws.indexOf( redraw), 1);
+        maps.push( redraw.map);
+      }
+      for (var i = 0; i < maps.length; i++) {
+        var map = maps[i];
+        if (map.targets.length === 0 && map.redraws.length === 0 &&
+            this.colorMaps[map.id] === map) {
+          delete this.colorMaps[map.id];
+        }
+      }
+    },
+
+    // A plot drawn again after it was released, as when a notebook
+    // puts a cell it took out back in the document, takes its share
+    // back. The renderer uploads the disposed geometries again when
+    // their objects are added anew.
+    restore : function( plot, scene) {
+      plot.released = false;
+      this.watch( plot);
+      for (var i = 0; i < plot.entries.length; i++) {
+        var entry = plot.entries[i];
+        if (entry.plots.length === 0) {
+          if (!(entry.key in this.geometries)) {
+            this.geometries[entry.key] = entry;
+          }
+          for (var j = 0; j < entry.targets.length; j++) {
+            var target = entry.targets[j];
+            target.map = this.reinstate( target.map);
+            target.map.targets.push( target);
+            this.fillColors( target.map, target);
+          }
+        }
+        entry.plots.push( plot);
+      }
+      for (var i = 0; i < plot.redraws.length; i++) {
+        var redraw = plot.redraws[i];
+        redraw.map = this.reinstate( redraw.map);
+        if (redraw.map.redraws.indexOf( redraw) < 0) {
+          redraw.map.redraws.push( redraw);
+        }
+      }
+      var objects = [];
+      scene.traverse( function( object) {
+        if (object.geometry) {
+          objects.push( object);
+        }
+      });
+      for (var i = 0; i < objects.length; i++) {
+        var parent = objects[i].parent;
+        parent.remove( objects[i]);
+        parent.add( objects[i]);
+      }
+    },
+
+    // Free the buffers of a geometry, texture, or the geometries of a
+    // geometrySet. The renderer frees those it made itself on dispose,
+    // sharedGeometry's buffers are deleted here.
+    dispose : function( value) {
+      if (!value) {
+        return;
+      }
+      if (value.sharedBuffers) {
+        var gl = this.renderer.context;
+        for (var name in value.attributes) {
+          var attribute = value.attributes[name];
+          if (attribute.buffer !== undefined) {
+            gl.deleteBuffer( attribute.buffer);
+            attribute.buffer = undefined;
+          }
+        }
+        value.__webglInit = undefined;
+      } else if (value.dispose) {
+        value.dispose();
+      } else if (value.constructor === Object) {
+        for (var name in value) {
+          this.dispose( value[name]);
+        }
+      }
+    },
+
+    // The color maps of the objects drawn with liveColors, by id. Each
+    // holds the lookup table, the range, the color attributes it fills
+    // and a redraw for each plot that draws it, called when the range
+    // changes. They go with the plots and geometries, see release.
+    colorMaps : {},
+
+    colorMap : function( id, lut, range, redraw) {
+      var map = this.colorMaps[id];
+      if (!map) {
+        map = this.colorMaps[id] = { id : id, lut : lut, range : range,
+                                     targets : [], redraws : [] };
+      }
+      map.lut = lut;
+      var plot = this.plot ? this.plotOf( this.plot) : null;
+      var record = null;
+      for (var i = 0; i < map.redraws.length; i++) {
+        if (map.redraws[i].plot === plot) {
+          record = map.redraws[i];
+        }
+      }
+      if (!record) {
+        record = { map : map, plot : plot };
+        map.redraws.push( record);
+        if (plot) {
+          plot.redraws.push( record);
+          this.watch( plot);
+        }
+      }
+      record.redraw = redraw;
+      this.setColorRange( id, range[0], range[1]);
+    },
+
+    // The map of the id of map, which is map itself unless it was
+    // dropped and another took its place.
+    reinstate : function( map) {
+      if (!this.colorMaps[map.id]) {
+        this.colorMaps[map.id] = map;
+      }
+      return this.colorMaps[map.id];
+    },
+
+    scalarColors : function( id, steps, lo, hi) {
+      var map = this.colorMaps[id];
+      var target = {
+        steps : steps,
+        lo : lo,
+        step : (hi-lo)/65535,
+        attribute : new THREE.BufferAttribute(
+          new Float32Array( 3*steps.length), 3),
+        map : map
+      };
+      map.targets.push( target);
+      if (this.entry) {
+        this.entry.targets.push( target);
+      }
+      this.fillColors( map, target);
+      return target.attribute;
+    },
+
+    fillColors : function( map, target) {
+      var lut = map.lut, last = lut.length/3 - 1;
+      var scale = map.range[1] > map.range[0] ?
+                  last/(map.range[1]-map.range[0]) : 0;
+      var colors = target.attribute.array;
+      for (var i = 0; i < target.steps.length; i++) {
+        var t = (target.lo + target.steps[i]*target.step - map.range[0])*scale;
+        var k = 3*Math.min( Math.max( Math.floor( t), 0), last);
+        colors[3*i] = lut[k]/255;
+        colors[3*i+1] = lut[k+1]/255;
+        colors[3*i+2] = lut[k+2]/255;
+      }
+      target.attribute.needsUpdate = true;
+    },
+
+    setColorRange : function( id, vmin, vmax) {
+      var map = this.colorMaps[id];
+      if (!map) {
+        return;
+      }
+      map.range = [vmin, vmax];
+      for (var i = 0; i < map.targets.length; i++) {
+        this.fillColors( map, map.targets[i]);
+      }
+      for (var i = 0; i < map.redraws.length; i++) {
+        map.redraws[i].redraw();
+      }
+    },
+
+    // The mesh, line pieces and point cloud geometries, or null, that
+    // draw one set of vertex attributes through the faces and edges
+    // index attributes, and as its first points vertices.
+    geometrySet : function( attributes, faces, edges, points) {
+      if (faces && !attributes.normal) {
+        var geometry = new THREE.BufferGeometry();
+        geometry.addAttribute( 'position', attributes.position);
+        geometry.addAttribute( 'index', faces);
+        geometry.computeVertexNormals();
+        attributes.normal = new THREE.BufferAttribute(
+          geometry.attributes.normal.array, 3);
+      }
+      var lines = {};
+      for (var name in attributes) {
+        if (name !== 'normal') {
+          lines[name] = attributes[name];
+        }
+      }
+      return {
+        faces : faces ? this.sharedGeometry( attributes, faces) : null,
+        edges : edges ? this.sharedGeometry( lines, edges) : null,
+        points : (points === null) ? null :
+                 this.sharedGeometry( lines, null, points)
+      };
+    },
+
+    // A BufferGeometry of the attributes, drawn through index, or as
+    // the first count vertices. The renderer would give every
+    // geometry buffers of its own, so the buffers are made here, once
+    // for each attribute, and shared by the geometries that draw it.
+    sharedGeometry : function( attributes, index, count) {
+      var gl = this.renderer.context;
+      var geometry = new THREE.BufferGeometry();
+      geometry.__webglInit = true;
+      geometry.sharedBuffers = true;
+      for (var name in attributes) {
+        var attribute = attributes[name];
+        this.upload( gl, gl.ARRAY_BUFFER, attribute);
+        if (count !== undefined &&
+            count*attribute.itemSize < attribute.array.length) {
+          var view = new THREE.BufferAttribute( attribute.array.subarray(
+            0, count*attribute.itemSize), attribute.itemSize);
+          view.buffer = attribute.buffer;
+          attribute = view;
+        }
+        geometry.addAttribute( name, attribute);
+      }
+      if (index) {
+        this.upload( gl, gl.ELEMENT_ARRAY_BUFFER, index);
+        geometry.addAttribute( 'index', index);
+      }
+      return geometry;
+    },
+
+    upload : function( gl, target, attribute) {
+      if (attribute.buffer !== undefined) {
+        return;
+      }
+      // Leave the renderer's bindings as they were.
+      var bound = gl.getParameter( target === gl.ARRAY_BUFFER ?
+        gl.ARRAY_BUFFER_BINDING : gl.ELEMENT_ARRAY_BUFFER_BINDING);
+      attribute.buffer = gl.createBuffer();
+      gl.bindBuffer( target, attribute.buffer);
+      gl.bufferData( target, attribute.array, gl.STATIC_DRAW);
+      gl.bindBuffer( target, bound);
+    },
+
+    // Objects drawn back to front through orders, one for each of the
+    // directions, that sort their primitives along it. item is the
+    // number of vertices to a primitive in buffers without an index.
+    depthSorted : function( object, orders, directions, center, item) {
+      object.depthOrder = {
+        orders : orders,
+        directions : directions,
+        center : new THREE.Vector3( center[0], center[1], center[2]),
+        item : item
+      };
+      if (object instanceof THREE.Mesh) {
+        object.material.depthWrite = false;
+      }
+    },
+
+    sortDepth : function( scene, camera) {
+      var self = this;
+      var eye = null;
+      scene.traverse( function( object) {
+        if (object.depthOrder) {
+          if (!eye) {
+            scene.updateMatrixWorld();
+            camera.updateMatrixWorld();
+            eye = new THREE.Vector3().setFromMatrixPosition( camera.matrixWorld);
+          }
+          self.depthOrder( object, eye);
+        }
+      });
+    },
+
+    // Gather the index of the object's geometry, or its vertices if it
+    // has none, in the order of the direction nearest the one from the
+    // camera to the object, if that changed since it was last drawn.
+    // Looking along a direction, the far primitives come last in its
+    // order, so it is read backwards.
+    depthOrder : function( object, eye) {
+      var order = object.depthOrder;
+      var d = order.center.clone().sub( eye.clone().applyMatrix4(
+        new THREE.Matrix4().getInverse( object.matrixWorld)));
+      var dirs = order.directions, bucket = 0, best = -1;
+      for (var k = 0; 3*k < dirs.length; k++) {
+        var t = d.x*dirs[3*k] + d.y*dirs[3*k+1] + d.z*dirs[3*k+2];
+        if (Math.abs( t) > best) {
+          best = Math.abs( t);
+          bucket = 2*k + (t < 0 ? 1 : 0);
+        }
+      }
+      if (order.bucket === bucket) {
+        return;
+      }
+      order.bucket = bucket;
+      var geometry = object.geometry;
+      var perm = order.orders[bucket >> 1], n = perm.length;
+      var backwards = !(bucket & 1);
+      var attributes = geometry.attributes;
+      var names = attributes.index ? ['index'] : Object.keys( attributes);
+      geometry.depthSources = geometry.depthSources || {};
+      for (var a = 0; a < names.length; a++) {
+        var attribute = attributes[names[a]];
+        var src = geometry.depthSources[names[a]];
+        if (!src) {
+          src = geometry.depthSources[names[a]] =
+            new attribute.array.constructor( attribute.array);
+        }
+        var dst = attribute.array;
+        var width = names[a] === 'index' ? 3 : order.item*attribute.itemSize;
+        for (var i = 0; i < n; i++) {
+          var from = perm[backwards ? n-1-i : i]*width, to = i*width;
+          for (var j = 0; j < width; j++) {
+            dst[to+j] = src[from+j];
+          }
+        }
+        attribute.needsUpdate = true;
+      }
+    },
+
+    draw : function( scene, camera, canvas) {
+      var plot = this.canvases.get( canvas);
+      if (plot && plot.released) {
+        this.restore( plot, scene);
+      }
+      var w = canvas.width, h = canvas.height;
+      if (w > this.width || h > this.height) {
+        this.width = Math.max( w, this.width);
+        this.height = Math.max( h, this.height);
+        this.renderer.setSize( this.width, this.height, false);
+      }
+      this.renderer.setViewport( 0, 0, w, h);
+      this.renderer.setScissor( 0, 0, w, h);
+      this.renderer.enableScissorTest( true);
+      this.sortDepth( scene, camera);
+      this.renderer.render( scene, camera);
+      var context = canvas.getContext( '2d');
+      context.clearRect( 0, 0, w, h);
+      context.drawImage( this.renderer.domElement,
+                         0, this.height-h, w, h, 0, 0, w, h);
+    }
+  };
+}
+THREE = window.pyplot3d.THREE;
+"""
+
 #<script type="text/javascript" src="js/three.min.js"></script>
 #<script type="text/javascript" src="js/TrackBallControls.js"></script>
 #<script type="text/javascript" src="js/OrbitControls.js"></script>
 fullScript = """\
-<script type="text/javascript" src="js/three.min.js"></script>
-<script type="text/javascript" src="js/TrackBallControls.js"></script>
-<script type="text/javascript" src="js/OrbitControls.js"></script>
+<script type="text/javascript" src="{ASSETS}/three.min.js"></script>
+<script type="text/javascript" src="{ASSETS}/TrackballControls.js"></script>
+<script type="text/javascript" src="{ASSETS}/OrbitControls.js"></script>
 <canvas 
   id="{UUID}" 
   width="600" 
@@ -768,28 +3203,148 @@ fullScript = """\
 </canvas>
 
 <script>
+{PAGE}
+(function() {{
 var canvas = 
   document.getElementById("{UUID}");
 
-var camera, controls; 
-var scene, renderer;
+function decodeBuffer( str, type) {{
+  var bin = atob( str);
+  var bytes = new Uint8Array( bin.length);
+  for (var i = 0; i < bin.length; i++) {{
+    bytes[i] = bin.charCodeAt( i);
+  }}
+  return new type( bytes.buffer);
+}}
 
-renderer = new THREE.WebGLRenderer({{ 
-  canvas: canvas,
-  alpha: true,
-  antialiasing: true
-}});
-renderer.setSize( canvas.width, canvas.height);
+// The arrays of a compressed payload, base64 or an ArrayBuffer, see
+// packArrays
+function inflateArrays( data, layout) {{
+  var bytes = (typeof data === 'string') ? decodeBuffer( data, Uint8Array)
+                                         : data;
+  var stream = new Blob( [bytes]).stream()
+    .pipeThrough( new DecompressionStream( 'deflate'));
+  return new Response( stream).arrayBuffer().then( function( buffer) {{
+    var bytes = new Uint8Array( buffer);
+    return layout.map( function( entry) {{
+      var start = entry[0], length = entry[1], size = entry[2];
+      var count = length/size;
+      if (size === 4) {{
+        // Whole items at once, little endian as decodeBuffer assumes
+        var words = new Uint32Array( count);
+        var b0 = start, b1 = b0+count, b2 = b1+count, b3 = b2+count;
+        for (var i = 0; i < count; i++) {{
+          words[i] = (bytes[b0+i] | (bytes[b1+i] << 8) |
+                      (bytes[b2+i] << 16) | (bytes[b3+i] << 24)) >>> 0;
+        }}
+        return words.buffer;
+      }}
+      var out = new Uint8Array( length);
+      for (var j = 0; j < size; j++) {{
+        var plane = start + j*count;
+        for (var i = 0; i < count; i++) {{
+          out[i*size+j] = bytes[plane+i];
+        }}
+      }}
+      return out.buffer;
+    }});
+  }});
+}}
+
+// The arrays of a scene buffer served by the kernel
+function fetchArrays( url, layout, compressed) {{
+  return fetch( url).then( function( response) {{
+    return response.arrayBuffer();
+  }}).then( function( buffer) {{
+    if (compressed) {{
+      return inflateArrays( buffer, layout);
+    }}
+    return layout.map( function( entry) {{
+      return buffer.slice( entry[0], entry[0]+entry[1]);
+    }});
+  }});
+}}
+
+function instanceGeometry( tPos, tNorm, tFaces, pos, scale, quat, colors) {{
+  var nt = tPos.length/3;
+  var nf = tFaces.length;
+  var ni = pos.length/3;
+  var positions = new Float32Array( 3*nt*ni);
+  var normals = new Float32Array( 3*nt*ni);
+  var index = (nt*ni < 65536) ? new Uint16Array( nf*ni)
+                              : new Uint32Array( nf*ni);
+  var rgb = colors ? new Float32Array( 3*nt*ni) : null;
+  var q = new THREE.Quaternion();
+  var s = new THREE.Vector3();
+  var v = new THREE.Vector3();
+  var n = new THREE.Vector3();
+  for (var i = 0; i < ni; i++) {{
+    s.set( scale[3*i], scale[3*i+1], scale[3*i+2]);
+    if (quat) {{
+      q.set( quat[4*i], quat[4*i+1], quat[4*i+2], quat[4*i+3]);
+    }}
+    for (var j = 0; j < nt; j++) {{
+      var k = 3*(i*nt+j);
+      v.set( tPos[3*j], tPos[3*j+1], tPos[3*j+2]).multiply( s);
+      n.set( tNorm[3*j]/(s.x || 1), tNorm[3*j+1]/(s.y || 1),
+             tNorm[3*j+2]/(s.z || 1));
+      if (quat) {{
+        v.applyQuaternion( q);
+        n.applyQuaternion( q);
+      }}
+      n.normalize();
+      positions[k] = v.x + pos[3*i];
+      positions[k+1] = v.y + pos[3*i+1];
+      positions[k+2] = v.z + pos[3*i+2];
+      normals[k] = n.x;
+      normals[k+1] = n.y;
+      normals[k+2] = n.z;
+      if (rgb) {{
+        rgb[k] = colors[3*i]/255;
+        rgb[k+1] = colors[3*i+1]/255;
+        rgb[k+2] = colors[3*i+2]/255;
+      }}
+    }}
+    for (var j = 0; j < nf; j++) {{
+      index[i*nf+j] = tFaces[j] + i*nt;
+    }}
+  }}
+  var geometry = new THREE.BufferGeometry();
+  geometry.addAttribute( 'position', new THREE.BufferAttribute( positions, 3));
+  geometry.addAttribute( 'normal', new THREE.BufferAttribute( normals, 3));
+  geometry.addAttribute( 'index', new THREE.BufferAttribute( index, 1));
+  if (rgb) {{
+    geometry.addAttribute( 'color', new THREE.BufferAttribute( rgb, 3));
+  }}
+  return geometry;
+}}
+
+function unitColors( bytes) {{
+  var colors = new Float32Array( bytes.length);
+  for (var i = 0; i < bytes.length; i++) {{
+    colors[i] = bytes[i]/255;
+  }}
+  return colors;
+}}
+
+var camera, controls; 
+var scene;
+var inflated = [];
 
 scene = new THREE.Scene();
 
+// The scene is only drawn when something changed: the controls moved
+// the camera, the window resized or the scene requested it, and never
+// while the canvas is scrolled out of view.
+var dirty = true;
+var onScreen = true;
+var pending = false;
+
 init_camera();
 init_lights();
 init_controls();
-init_scene();
-
-render();
-animate();
+init_visibility();
+{LOAD_SCENE}
 
 function init_camera() {{
   camera = new THREE.PerspectiveCamera( 
@@ -815,27 +3370,80 @@ function init_controls() {{
   controls.noPan = true;
   controls.staticMoving = true;
   controls.dynamicDampingFactor = 0.3;
-  controls.addEventListener( 'change', render ); 
+  controls.addEventListener( 'change', requestRender ); 
   controls.target.set( {TARGET} );
 }}
 
+function init_visibility() {{
+  window.addEventListener( 'resize', requestRender );
+  if (window.IntersectionObserver) {{
+    new IntersectionObserver( function( entries) {{
+      onScreen = entries[entries.length-1].isIntersecting;
+      if (onScreen && dirty) {{
+        requestRender();
+      }}
+    }}).observe( canvas);
+  }}
+}}
+
 function init_scene() {{
+  pyplot3d.building( canvas, function() {{
 {SCENE}
+  }});
+}}
+
+// The script of an object that arrives after the scene was built, run
+// in this closure so it sees the names init_scene does.
+function evalObject( code) {{
+  pyplot3d.building( canvas, function() {{
+    eval( code);
+  }});
 }}
 
 function render(){{
-  renderer.render(scene, camera);
+  pyplot3d.draw( scene, camera, canvas);
 }}
 
-function animate(){{
-  requestAnimationFrame( animate );
-  controls.update();        
+function requestRender(){{
+  dirty = true;
+  if (onScreen && !pending) {{
+    pending = true;
+    requestAnimationFrame( function() {{
+      pending = false;
+      if (onScreen && dirty) {{
+        dirty = false;
+        render();
+      }}
+    }});
+  }}
 }}
+}})();
 </script>
 """
 
 from uuid import uuid4 as uuid
 
+loadScene = """\
+init_scene();
+requestRender();
+"""
+
+inflateScene = """\
+inflateArrays( "{PAYLOAD}", {LAYOUT}).then( function( arrays) {{
+  inflated = arrays;
+  init_scene();
+  requestRender();
+}});
+"""
+
+fetchScene = """\
+fetchArrays( "{URL}", {LAYOUT}, {COMPRESSED}).then( function( arrays) {{
+  inflated = arrays;
+  init_scene();
+  requestRender();
+}});
+"""
+
 _rDefaultDict = {
   "cameraFOV" : math.pi/8.,
   "cameraFrontPlane" : 0.1,
@@ -843,10 +3451,15 @@ _rDefaultDict = {
   "cameraUp" : Vector3( 0, 0, 1),
   "cameraTheta" : 2.*math.pi/5.,
   "cameraPhi" : -math.pi/10.,
-  "lighting" : defaultLighting
+  "lighting" : defaultLighting,
+  "compress" : False,
+  "assets" : "js"
 }
 
-def render( *geoObjs, **kwargs):
+def sceneParameters( geoObjs, kwargs):
+  """The camera and lighting for rendering geoObjs, from the render
+  keywords, with the camera fitted to the objects where it is not
+  given."""
   renderD = {}
   for key in _rDefaultDict:
     if key in kwargs:
@@ -866,13 +3479,7 @@ def render( *geoObjs, **kwargs):
     num = 0.;
     denom = 0.;
     for geoObj in geoObjs:
-      objNum, objDenom = geoObj.stats();
-      if isinstance( geoObj, Line):
-        objNum *= dw
-        objDenom *= dw
-      if isinstance( geoObj, Point) or isinstance( geoObj, Text):
-        objNum *= dw*dw
-        objDenom *= dw*dw
+      objNum, objDenom = sceneStats( geoObj, dw)
       num += objNum
       denom += objDenom
     renderD["cameraTarget"] = num/denom;
@@ -882,7 +3489,7 @@ def render( *geoObjs, **kwargs):
   else:
     cameraDist = maxWidth/(math.sin(renderD["cameraFOV"])/2)
     if "cameraVector" in kwargs:
-      renderD[cameraVector] = norm(vec3(kwargs["cameraVector"]))
+      renderD["cameraVector"] = norm(vec3(kwargs["cameraVector"]))
     else:
       th = renderD["cameraTheta"]
       phi = renderD["cameraPhi"]
@@ -891,13 +3498,34 @@ def render( *geoObjs, **kwargs):
                                            math.cos(th))
     renderD["cameraPosition"] = (renderD["cameraTarget"] + 
                                  cameraDist*renderD["cameraVector"])
-  # Get the geometry string
-  geometry = ""
-  for geoObj in geoObjs:
-    geometry = geometry+geoObj.render()
-  #
+  return renderD
+
+def compressLevel( renderD):
+  """The zlib level of the compress keyword in renderD, None if the
+  arrays are not compressed"""
+  if not renderD.get("compress"):
+    return None
+  return 6 if renderD["compress"] is True else int( renderD["compress"])
+
+def renderScript( renderD, geometry):
+  """The canvas and script that draw the geometry string with the
+  camera and lighting of renderD. If renderD["compress"] is set, the
+  arrays of the geometry are sent compressed, and it may be a zlib
+  level."""
+  load = loadScene
+  if renderD.get("compress"):
+    geometry, payload, layout = compressArrays( geometry,
+                                                compressLevel( renderD))
+    load = inflateScene.format( PAYLOAD = payload, LAYOUT = layout)
+  return sceneScript( renderD, geometry, load)
+
+def sceneScript( renderD, geometry, load):
+  """The canvas and script that draw the geometry string with the
+  camera and lighting of renderD, once the load script has run"""
   uu = uuid()
   return (fullScript.format(
+            ASSETS = renderD["assets"],
+            PAGE = pageScript,
             UUID = uu,
             FOV = 180./math.pi*renderD["cameraFOV"],
             FRONTPLANE = renderD["cameraFrontPlane"],
@@ -906,6 +3534,75 @@ def render( *geoObjs, **kwargs):
             UP = renderD["cameraUp"],
             TARGET = renderD["cameraTarget"],
             LIGHTS = renderD["lighting"],
-            SCENE = geometry
+            SCENE = geometry,
+            LOAD_SCENE = load
           ))
 
+def renderObject( geoObj):
+  """The script of geoObj, put together from the parts a GeoVertObj
+  keeps cached until its geometry changes"""
+  return geoObj.render()
+
+def render( *geoObjs, **kwargs):
+  renderD = sceneParameters( geoObjs, kwargs)
+  # Get the geometry string
+  geometry = ""
+  for geoObj in geoObjs:
+    geometry = geometry+renderObject( geoObj)
+  return renderScript( renderD, geometry)
+
+# Rendering without blocking the event loop
+#
+# renderAsync does the work of render in an executor, an object at a
+# time, awaiting each step, so the kernel's event loop keeps serving
+# widget callbacks and other tasks. Cancelling it stops it at the next
+# step; the object being serialized at that moment is finished in its
+# thread and thrown away.
+
+async def renderAsync( *geoObjs, executor=None, **kwargs):
+  """Like render, but a coroutine that serializes the objects in
+  executor, the event loop's default thread pool if it is None"""
+  loop = asyncio.get_running_loop()
+  renderD = await loop.run_in_executor( executor, sceneParameters,
+                                        geoObjs, kwargs)
+  parts = []
+  for geoObj in geoObjs:
+    parts.append( await loop.run_in_executor( executor, renderObject,
+                                              geoObj))
+  return await loop.run_in_executor( executor, renderScript, renderD,
+                                     "".join( parts))
+
+class LatestRender:
+  """Renders in the background, delivering only the latest request.
+
+  Every call to request starts a renderAsync and cancels the one still
+  running, if any, so a render that was superseded while it ran never
+  reaches display, a function called with the html of every render
+  that completes. In a notebook it may update a display handle:
+
+    handle = IPython.display.display( HTML(""), display_id=True)
+    latest = LatestRender( lambda html: handle.update( HTML( html)))
+  """
+
+  def __init__(self, display=None, executor=None):
+    self.display = display
+    self.executor = executor
+    self.task = None
+
+  def request(self, *geoObjs, **kwargs):
+    """Start rendering geoObjs with the keywords of render, and return
+    the task, whose result is the html"""
+    self.cancel()
+    self.task = asyncio.ensure_future( self.run( geoObjs, kwargs))
+    return self.task
+
+  def cancel(self):
+    """Cancel the render in flight"""
+    if self.task is not None and not self.task.done():
+      self.task.cancel()
+
+  async def run(self, geoObjs, kwargs):
+    html = await renderAsync( *geoObjs, executor=self.executor, **kwargs)
+    if self.display is not None:
+      self.display( html)
+    return html
@@ -0,0 +1,298 @@
+import numpy as np
+
+import GeoObjects as go
+
+_aDefaultDict = {
+  "fps" : 10.,
+  "tolerance" : None,
+  "keyframeInterval" : None,
+  "recomputeNormals" : True
+}
+
+class Animation(go.GeoVertObj):
+  """A TriangleSet or Instances whose positions change over time.
+
+  frames is a sequence of (N,3) position arrays, such as an (F,N,3)
+  array that may be memory mapped, for the vertices of a TriangleSet
+  or the instances of an Instances object. colorFrames is an optional
+  sequence of (N,3) uint8 colors. The faces, template and material are
+  sent once, then every frame only sends the positions that moved by
+  more than tolerance since the previous frame, as int16 deltas with a
+  per frame scale, and the colors that changed. Every keyframeInterval
+  frames the full positions are sent so the slider can jump back
+  without replaying from the first frame."""
+
+  def __init__(self, geoObj, frames, colorFrames=None, **kwargs):
+    self.geoObj = geoObj
+    self.frames = frames
+    self.colorFrames = colorFrames
+    for attr in _aDefaultDict:
+      if attr in kwargs:
+        setattr( self, attr, kwargs[attr])
+      else:
+        setattr( self, attr, _aDefaultDict[attr])
+    if isinstance( geoObj, go.Instances):
+      self.key = "positions"
+    else:
+      self.key = "vertices"
+    setattr( geoObj, self.key, go.vertexArray( np.asarray(frames[0])))
+    if colorFrames is not None:
+      geoObj.colors = np.asarray( colorFrames[0], dtype=np.uint8)
+
+  def frameBoundingBoxes(self):
+    """The bounding box of every frame"""
+    first = getattr( self.geoObj, self.key)
+    try:
+      for frame in self.frames:
+        setattr( self.geoObj, self.key, go.vertexArray( np.asarray(frame)))
+        yield self.geoObj.boundingBox()
+    finally:
+      setattr( self.geoObj, self.key, first)
+
+  def boundingBox(self):
+    """The bounding box of all the frames"""
+    return go.totalBoundingBox( list(self.frameBoundingBoxes()))
+
+  def stats(self):
+    return self.geoObj.stats()
+
+  def cached(self, name, compute, versions, key=()):
+    # The frames may be changed without a new version, and the geometry
+    # is another object's, so nothing is cached.
+    return compute()
+
+  def layout(self, frame):
+    """frame arranged like the position buffer of the geometry"""
+    if self.key == "vertices" and not self.geoObj.smooth:
+      return frame[self.geoObj.faces.reshape(-1)]
+    return frame
+
+  def encode(self):
+    """The per frame position and color changes as arrays"""
+    tolerance = self.tolerance
+    if tolerance is None:
+      vmin, vmax = self.geoObj.boundingBox()
+      tolerance = 1e-5*go.mag(vmax-vmin)
+    prev = self.layout( go.vertexArray( np.asarray(self.frames[0]))).copy()
+    first = prev.copy()
+    offsets = [0]
+    indices = []
+    deltas = []
+    scales = [1.]
+    keys = []
+    for f in range(1, len(self.frames)):
+      target = self.layout( go.vertexArray( np.asarray(self.frames[f])))
+      if self.keyframeInterval and f % self.keyframeInterval == 0:
+        # The browser restores a keyframe as the first frame plus an
+        # offset, so track exactly what it will hold.
+        offset = target - first
+        keys.append( offset)
+        prev = (first.astype(np.float64) + offset).astype(np.float32)
+      diff = target.astype(np.float64) - prev
+      changed = np.flatnonzero( np.abs(diff).max(axis=1) > tolerance)
+      d = diff[changed]
+      scale = float( np.float32( np.abs(d).max()/32767. if len(d) else 1.))
+      q = np.rint( d/scale).astype(np.int16) if scale > 0. else \
+          np.zeros( d.shape, dtype=np.int16)
+      # Delta against what the browser will hold, not against the
+      # exact previous frame, so the rounding never builds up.
+      prev[changed] = (prev[changed].astype(np.float64) +
+                       q*scale).astype(np.float32)
+      indices.append( changed)
+      deltas.append( q)
+      scales.append( scale)
+      offsets.append( offsets[-1] + len(changed))
+    return {
+      "offsets" : np.array( offsets, dtype=np.uint32),
+      "indices" : np.concatenate( indices or [np.empty(0)]),
+      "deltas" : np.concatenate( deltas or [np.empty((0,3))]),
+      "scales" : np.array( scales, dtype=np.float32),
+      "keys" : np.array( keys, dtype=np.float32).reshape(-1,3)
+    }
+
+  def encodeColors(self):
+    """The per frame color changes as arrays"""
+    prev = self.layout( np.asarray( self.colorFrames[0], dtype=np.uint8))
+    offsets = [0]
+    indices = []
+    values = []
+    for f in range(1, len(self.colorFrames)):
+      target = self.layout( np.asarray( self.colorFrames[f],
+                                        dtype=np.uint8))
+      changed = np.flatnonzero( (target != prev).any(axis=1))
+      indices.append( changed)
+      values.append( target[changed])
+      offsets.append( offsets[-1] + len(changed))
+      prev = target
+    return {
+      "offsets" : np.array( offsets, dtype=np.uint32),
+      "indices" : np.concatenate( indices or [np.empty(0)]),
+      "values" : np.concatenate( values or [np.empty((0,3))])
+    }
+
+  aScene = """\
+  mesh.frustumCulled = false;
+  (function( geometry) {{
+    var count = {FRAMES};
+    var per = {PER};
+    var offsets = {OFFSETS};
+    var indices = {INDICES};
+    var deltas = {DELTAS};
+    var scales = {SCALES};
+    var keyInterval = {KEY_INTERVAL};
+    var keys = {KEYS};
+    var colorOffsets = {COLOR_OFFSETS};
+    var colorIndices = {COLOR_INDICES};
+    var colorValues = {COLOR_VALUES};
+    var normals = {NORMALS};
+    var pos = geometry.attributes.position.array;
+    var first = new Float32Array( pos);
+    var rgb = colorOffsets ? geometry.attributes.color.array : null;
+    var firstRgb = rgb ? new Float32Array( rgb) : null;
+    var current = 0;
+    var nv = pos.length/(3*per);
+
+    function stepPositions( f) {{
+      var s = scales[f];
+      for (var m = offsets[f-1]; m < offsets[f]; m++) {{
+        var k = 3*indices[m]*per;
+        var dx = deltas[3*m]*s, dy = deltas[3*m+1]*s, dz = deltas[3*m+2]*s;
+        for (var j = 0; j < per; j++, k += 3) {{
+          pos[k] += dx;
+          pos[k+1] += dy;
+          pos[k+2] += dz;
+        }}
+      }}
+    }}
+
+    function stepColors( f) {{
+      for (var m = colorOffsets[f-1]; m < colorOffsets[f]; m++) {{
+        var k = 3*colorIndices[m]*per;
+        for (var j = 0; j < per; j++, k += 3) {{
+          rgb[k] = colorValues[3*m]/255;
+          rgb[k+1] = colorValues[3*m+1]/255;
+          rgb[k+2] = colorValues[3*m+2]/255;
+        }}
+      }}
+    }}
+
+    function restore( key) {{
+      pos.set( first);
+      if (key > 0) {{
+        var base = 3*(key-1)*nv;
+        for (var i = 0; i < nv; i++) {{
+          for (var j = 0, k = 3*i*per; j < per; j++, k += 3) {{
+            pos[k] += keys[base+3*i];
+            pos[k+1] += keys[base+3*i+1];
+            pos[k+2] += keys[base+3*i+2];
+          }}
+        }}
+      }}
+    }}
+
+    function seek( f) {{
+      var colorFrom = current;
+      if (f < current) {{
+        current = 0;
+        colorFrom = 0;
+        restore( 0);
+        if (rgb) {{
+          rgb.set( firstRgb);
+        }}
+      }}
+      // Jump to the last keyframe if that is ahead, its delta is
+      // relative to the keyframe.
+      var key = keyInterval ? Math.floor( f/keyInterval) : 0;
+      var g = current+1;
+      if (key > 0 && key*keyInterval > current) {{
+        restore( key);
+        g = key*keyInterval;
+      }}
+      for (; g <= f; g++) {{
+        stepPositions( g);
+      }}
+      for (g = colorFrom+1; rgb && g <= f; g++) {{
+        stepColors( g);
+      }}
+      current = f;
+    }}
+
+    var panel = document.createElement( 'div');
+    var button = document.createElement( 'button');
+    var slider = document.createElement( 'input');
+    var label = document.createElement( 'span');
+    button.textContent = 'Play';
+    slider.type = 'range';
+    slider.min = 0;
+    slider.max = count-1;
+    slider.value = 0;
+    label.textContent = '0 / ' + (count-1);
+    panel.appendChild( button);
+    panel.appendChild( slider);
+    panel.appendChild( label);
+    canvas.parentNode.insertBefore( panel, canvas.nextSibling);
+
+    function show( f) {{
+      seek( f);
+      slider.value = f;
+      label.textContent = f + ' / ' + (count-1);
+      geometry.attributes.position.needsUpdate = true;
+      if (rgb) {{
+        geometry.attributes.color.needsUpdate = true;
+      }}
+      if (normals) {{
+        geometry.computeVertexNormals();
+        geometry.attributes.normal.needsUpdate = true;
+      }}
+      requestRender();
+    }}
+
+    var timer = null;
+    button.onclick = function() {{
+      if (timer) {{
+        clearInterval( timer);
+        timer = null;
+        button.textContent = 'Play';
+      }} else {{
+        timer = setInterval( function() {{
+          show( (current+1) % count);
+        }}, 1000/{FPS});
+        button.textContent = 'Pause';
+      }}
+    }};
+    slider.oninput = function() {{
+      show( parseInt( slider.value));
+    }};
+  }})( geometry);
+  """
+
+  def render(self):
+    frames = self.encode()
+    if isinstance( self.geoObj, go.Instances):
+      per = len( self.geoObj.template( self.geoObj.lod)[0])
+      normals = False
+    else:
+      per = 1
+      normals = self.recomputeNormals
+    if self.colorFrames is not None:
+      colors = self.encodeColors()
+      colorStr = [go.encodeArray( colors["offsets"], "<u4"),
+                  go.encodeArray( colors["indices"], "<u4"),
+                  go.encodeArray( colors["values"], "|u1")]
+    else:
+      colorStr = ["null", "null", "null"]
+    return (self.geoObj.render( shared=False) + self.aScene.format(
+              FRAMES = len(self.frames),
+              PER = per,
+              OFFSETS = go.encodeArray( frames["offsets"], "<u4"),
+              INDICES = go.encodeArray( frames["indices"], "<u4"),
+              DELTAS = go.encodeArray( frames["deltas"], "<i2"),
+              SCALES = go.encodeArray( frames["scales"], "<f4"),
+              KEY_INTERVAL = self.keyframeInterval or 0,
+              KEYS = go.encodeArray( frames["keys"], "<f4"),
+              COLOR_OFFSETS = colorStr[0],
+              COLOR_INDICES = colorStr[1],
+              COLOR_VALUES = colorStr[2],
+              NORMALS = ("false","true")[normals],
+              FPS = self.fps
+            ))
@@ -0,0 +1,105 @@
+"""Idle CPU of a page of plots in a headless browser.
+
+Writes a page with --plots plots and opens it in a headless Chrome or
+Chromium, then reports the CPU time the browser's processes use over
+--seconds seconds in which nothing touches the page. Run it from a
+checkout of an older commit, with the same arguments, to compare:
+
+  python benchmarks/idle_cpu.py --chrome /path/to/chrome-headless-shell
+
+The CPU time is read from /proc, so it runs on Linux only."""
+
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+root = os.path.dirname( os.path.dirname( os.path.abspath( __file__)))
+sys.path.insert( 0, root)
+
+import numpy as np
+
+import GeoObjects as go
+
+def idlePage( path, plots):
+  """Write a page of plots surfaces, each with a canvas of its own"""
+  x = np.linspace( -3., 3., 60)
+  parts = []
+  for i in range(plots):
+    surface = go.Surface( x, x, lambda X, Y, i=i: np.sin( X*Y + i),
+                          colormap="viridis")
+    parts.append( go.render( surface, assets="file://" +
+                             os.path.join( root, "js")))
+  with open( path, "w") as f:
+    f.write( "<html><body>\n" + "\n".join( parts) + "\n</body></html>\n")
+
+def processTree( pid):
+  """pid and all its descendants"""
+  children = {}
+  for entry in os.listdir( "/proc"):
+    if entry.isdigit():
+      try:
+        with open( "/proc/{}/stat".format( entry)) as f:
+          ppid = int( f.read().rsplit( ")", 1)[1].split()[1])
+      except (OSError, IndexError, ValueError):
+        continue
+      children.setdefault( ppid, []).append( int(entry))
+  tree = [pid]
+  for p in tree:
+    tree.extend( children.get( p, []))
+  return tree
+
+def cpuSeconds( pid):
+  """The user and system CPU seconds of pid and its descendants"""
+  ticks = 0
+  for p in processTree( pid):
+    try:
+      with open( "/proc/{}/stat".format( p)) as f:
+        fields = f.read().rsplit( ")", 1)[1].split()
+    except OSError:
+      continue
+    ticks += int( fields[11]) + int( fields[12])
+  return ticks/float( os.sysconf( "SC_CLK_TCK"))
+
+def main():
+  parser = argparse.ArgumentParser( description=__doc__.split( "\n")[0])
+  parser.add_argument( "--chrome", default=os.environ.get( "CHROME",
+                                                         "chromium"),
+                       help="headless Chrome or Chromium to run")
+  parser.add_argument( "--plots", type=int, default=20)
+  parser.add_argument( "--settle", type=float, default=5.,
+                       help="seconds to let the page load and draw")
+  parser.add_argument( "--seconds", type=float, default=10.,
+                       help="seconds to measure")
+  parser.add_argument( "--height", type=int, default=2000,
+                       help="window height, the plots below it are off "
+                            "screen")
+  args = parser.parse_args()
+  directory = tempfile.mkdtemp()
+  page = os.path.join( directory, "idle.html")
+  idlePage( page, args.plots)
+  browser = subprocess.Popen(
+    [args.chrome, "--headless", "--no-sandbox", "--use-angle=swiftshader",
+     "--enable-unsafe-swiftshader", "--allow-file-access-from-files",
+     "--remote-debugging-port=0", "--user-data-dir=" + directory,
+     "--window-size=800,{}".format( args.height), "file://" + page],
+    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+  try:
+    time.sleep( args.settle)
+    if browser.poll() is not None:
+      sys.exit( "the browser exited, run it by hand to see why")
+    start = cpuSeconds( browser.pid)
+    time.sleep( args.seconds)
+    used = cpuSeconds( browser.pid) - start
+  finally:
+    browser.send_signal( signal.SIGTERM)
+    browser.wait()
+  print( "{} plots: {:.2f} CPU seconds in {:g} s idle, {:.1f}% of a "
+         "core".format( args.plots, used, args.seconds,
+                        100.*used/args.seconds))
+
+if __name__ == "__main__":
+  main()
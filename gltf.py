@@ -0,0 +1,337 @@
+import json
+import math
+import struct
+
+import numpy as np
+
+import GeoObjects as go
+from animation import Animation
+from raster import colorArray
+
+# glTF 2.0 binary export
+#
+# exportGLB writes objects to one GLB file: a JSON chunk describing
+# the meshes, materials and nodes, and a binary chunk holding every
+# array as a bufferView of its own. The layout of the binary chunk is
+# planned from the shapes of the arrays before anything is written, so
+# the file is written front to back and may go to a pipe or socket.
+# Arrays that are already contiguous little endian float32 or integer
+# indices, memory mapped or not, are written straight from their
+# memory; the others, like colors mapped from scalars, a chunk at a
+# time.
+#
+# TriangleSets, GeoSets, Lines and Points become mesh primitives that
+# draw triangles, lines, line strips and points. The vertices of a
+# GeoSet are one accessor that all its primitives share, and a Group is
+# a node with the group's matrix, whose children may share meshes.
+# Instances are drawn through EXT_mesh_gpu_instancing, lines and
+# points are unlit through KHR_materials_unlit, and Text is left out.
+
+_componentTypes = {
+  "<f4" : 5126,
+  "<u4" : 5125,
+  "|u1" : 5121
+}
+
+_accessorTypes = {1 : "SCALAR", 2 : "VEC2", 3 : "VEC3", 4 : "VEC4"}
+
+_modes = {"points" : 0, "lines" : 1, "lineStrip" : 3, "triangles" : 4}
+
+def arrayChunks( arr, dtype):
+  """The bytes of arr as dtype, its own memory when it is laid out so,
+  otherwise converted a chunk of rows at a time"""
+  dtype = np.dtype( dtype)
+  if isinstance( arr, np.ndarray) and arr.dtype == dtype and \
+     arr.flags.c_contiguous:
+    if arr.size:
+      yield memoryview( arr).cast( "B")
+    return
+  for sl in go.chunks( len(arr)):
+    yield np.ascontiguousarray( arr[sl], dtype=dtype).tobytes()
+
+def rgbaChunks( colors):
+  """The bytes of (N,3) uint8 colors as opaque RGBA, which keeps every
+  vertex aligned to 4 bytes as glTF requires"""
+  for sl in go.chunks( len(colors)):
+    rgba = np.full( (sl.stop-sl.start, 4), 255, dtype=np.uint8)
+    rgba[:,:3] = colors[sl]
+    yield rgba.tobytes()
+
+class GLBWriter:
+  """Collects the glTF description of objects and the arrays of the
+  binary chunk"""
+
+  def __init__(self):
+    self.gltf = {
+      "asset" : {"version" : "2.0", "generator" : "pyplot3d"},
+      "scene" : 0,
+      "scenes" : [{"nodes" : []}],
+      "nodes" : [],
+      "meshes" : [],
+      "materials" : [],
+      "accessors" : [],
+      "bufferViews" : [],
+      "buffers" : [{"byteLength" : 0}]
+    }
+    self.blobs = []
+    self.length = 0
+    self.meshes = {}
+    self.extensions = set()
+    self.required = set()
+
+  def bufferView(self, chunks, byteLength, target=None):
+    """Place the bytes that chunks yields after those before it"""
+    self.length += -self.length % 4
+    view = {"buffer" : 0, "byteOffset" : self.length,
+            "byteLength" : byteLength}
+    if target is not None:
+      view["target"] = target
+    self.gltf["bufferViews"].append( view)
+    self.blobs.append( (self.length, chunks))
+    self.length += byteLength
+    return len(self.gltf["bufferViews"]) - 1
+
+  def accessor(self, arr, dtype, width, target=None, bounds=None):
+    """An accessor of the rows of arr, width components of dtype"""
+    dtype = np.dtype( dtype)
+    view = self.bufferView( arrayChunks( arr, dtype),
+                            len(arr)*width*dtype.itemsize, target)
+    accessor = {"bufferView" : view,
+                "componentType" : _componentTypes[dtype.str],
+                "count" : len(arr),
+                "type" : _accessorTypes[width]}
+    if bounds is not None:
+      accessor["min"] = [float(x) for x in bounds[0]]
+      accessor["max"] = [float(x) for x in bounds[1]]
+    self.gltf["accessors"].append( accessor)
+    return len(self.gltf["accessors"]) - 1
+
+  def colors(self, colors, target=None):
+    """A normalized RGBA accessor of (N,3) uint8 colors"""
+    view = self.bufferView( rgbaChunks( colors), 4*len(colors), target)
+    self.gltf["accessors"].append( {"bufferView" : view,
+                                    "componentType" : 5121,
+                                    "normalized" : True,
+                                    "count" : len(colors),
+                                    "type" : "VEC4"})
+    return len(self.gltf["accessors"]) - 1
+
+  def indices(self, idx):
+    """An accessor of the uint32 indices idx, written as they are"""
+    return self.accessor( idx.reshape(-1), "<u4", 1, 34963)
+
+  def material(self, color, opacity=1., unlit=False, obj=None):
+    """A material of color, with the Phong style of obj if it is given"""
+    rgb = [float(x) for x in colorArray( color)]
+    material = {
+      "pbrMetallicRoughness" : {
+        "baseColorFactor" : rgb + [float(opacity)],
+        "metallicFactor" : 0.
+      },
+      "doubleSided" : True
+    }
+    if opacity < 1.:
+      material["alphaMode"] = "BLEND"
+    if unlit:
+      material["extensions"] = {"KHR_materials_unlit" : {}}
+      self.extensions.add( "KHR_materials_unlit")
+    elif obj is not None:
+      # The roughness of a Phong shininess, as Blinn-Phong to GGX
+      # conversions have it.
+      material["pbrMetallicRoughness"]["roughnessFactor"] = \
+        math.sqrt( 2./(float(obj.shininess)+2.))
+      material["emissiveFactor"] = [float(x) for x in
+                                    colorArray( obj.emissive)]
+    self.gltf["materials"].append( material)
+    return len(self.gltf["materials"]) - 1
+
+  def vertexAttributes(self, obj, normals=None):
+    """The attributes of the vertices of obj, with the vertex colors
+    of its colors or scalars"""
+    attributes = {"POSITION" : self.accessor( obj.vertices, "<f4", 3,
+                                              34962, obj.boundingBox())}
+    if normals is not None:
+      attributes["NORMAL"] = self.accessor( normals, "<f4", 3, 34962)
+    colors = go.ScalarColors( obj) if obj.scalars is not None else \
+             getattr( obj, "colors", None)
+    if colors is not None:
+      attributes["COLOR_0"] = self.colors( colors, 34962)
+    return attributes
+
+  def pointColor(self, obj):
+    return obj.pointColor or obj.pointEdgeColor or "0x000000"
+
+  def primitive(self, attributes, mode, material, indices=None):
+    primitive = {"attributes" : attributes, "material" : material,
+                 "mode" : _modes[mode]}
+    if indices is not None:
+      primitive["indices"] = self.indices( indices)
+    return primitive
+
+  def mesh(self, obj):
+    """The index of the mesh of obj, made the first time, or None if
+    glTF has nothing to draw obj with. Accessors may not be empty, so
+    an object without vertices, or primitives, is not drawn."""
+    if id(obj) in self.meshes:
+      return self.meshes[id(obj)]
+    if isinstance( obj, go.Instances):
+      if len(obj.positions) == 0:
+        return None
+    elif len(getattr( obj, "vertices", ())) == 0:
+      return None
+    # Vertex colors are multiplied by the base color, which is then
+    # white.
+    if isinstance( obj, go.GeoSet):
+      attributes = self.vertexAttributes( obj, obj.smoothNormals())
+      white = "COLOR_0" in attributes
+      lines = dict( (k, v) for k, v in attributes.items() if k != "NORMAL")
+      primitives = []
+      if obj.faces is not None and len(obj.faces):
+        primitives.append( self.primitive( attributes, "triangles",
+          self.material( "0xffffff" if white else obj.color, obj.opacity,
+                         obj=obj), obj.faces))
+      if obj.edges is not None and len(obj.edges):
+        primitives.append( self.primitive( lines, "lines",
+          self.material( "0xffffff" if white else obj.lineColor,
+                         unlit=True), obj.edges))
+      if obj.points is not None and len(obj.points):
+        primitives.append( self.primitive( lines, "points",
+          self.material( "0xffffff" if white else self.pointColor( obj),
+                         unlit=True), obj.points))
+    elif isinstance( obj, go.TriangleSet):
+      if len(obj.faces) == 0:
+        return None
+      # Without normals glTF is shaded flat.
+      attributes = self.vertexAttributes(
+          obj, obj.smoothNormals() if obj.smooth else None)
+      white = "COLOR_0" in attributes
+      primitives = [self.primitive( attributes, "triangles",
+        self.material( "0xffffff" if white else obj.color, obj.opacity,
+                       obj=obj), obj.faces)]
+    elif isinstance( obj, go.Line):
+      attributes = self.vertexAttributes( obj)
+      white = "COLOR_0" in attributes
+      primitives = [self.primitive( attributes, "lineStrip",
+        self.material( "0xffffff" if white else obj.lineColor,
+                       unlit=True))]
+    elif isinstance( obj, go.Point):
+      attributes = self.vertexAttributes( obj)
+      white = "COLOR_0" in attributes
+      primitives = [self.primitive( attributes, "points",
+        self.material( "0xffffff" if white else self.pointColor( obj),
+                       unlit=True))]
+    elif isinstance( obj, go.Instances):
+      verts, normals, faces = obj.template( obj.lod)
+      attributes = {"POSITION" : self.accessor( verts, "<f4", 3, 34962,
+                                   (verts.min(axis=0), verts.max(axis=0))),
+                    "NORMAL" : self.accessor( normals, "<f4", 3, 34962)}
+      primitives = [self.primitive( attributes, "triangles",
+        self.material( "0xffffff" if obj.colors is not None else obj.color,
+                       obj.opacity, obj=obj),
+        np.asarray( faces, dtype=np.uint32))]
+    else:
+      return None
+    if not primitives:
+      return None
+    self.gltf["meshes"].append( {"primitives" : primitives})
+    self.meshes[id(obj)] = len(self.gltf["meshes"]) - 1
+    return self.meshes[id(obj)]
+
+  def node(self, obj):
+    """The index of a new node that draws obj, or None if glTF has
+    nothing to draw it with"""
+    node = {}
+    if isinstance( obj, Animation):
+      obj = obj.geoObj
+    if isinstance( obj, go.Group):
+      # glTF matrices are column major.
+      node["matrix"] = [float(x) for x in go.matrixArray( obj.matrix).T.reshape(-1)]
+      children = [self.node( child) for child in obj.children]
+      children = [c for c in children if c is not None]
+      # glTF does not allow an empty list of children.
+      if children:
+        node["children"] = children
+    else:
+      mesh = self.mesh( obj)
+      if mesh is None:
+        return None
+      node["mesh"] = mesh
+      if isinstance( obj, go.Instances):
+        node["extensions"] = {"EXT_mesh_gpu_instancing" : {"attributes" :
+                               self.instanceAttributes( obj)}}
+        self.extensions.add( "EXT_mesh_gpu_instancing")
+        self.required.add( "EXT_mesh_gpu_instancing")
+    self.gltf["nodes"].append( node)
+    return len(self.gltf["nodes"]) - 1
+
+  def instanceAttributes(self, obj):
+    """The EXT_mesh_gpu_instancing attributes of Instances, with their
+    colors as the application specific _COLOR_0"""
+    attributes = {"TRANSLATION" : self.accessor( obj.positions, "<f4", 3),
+                  "SCALE" : self.accessor( obj.scales, "<f4", 3)}
+    if obj.orientations is not None:
+      attributes["ROTATION"] = self.accessor( obj.orientations, "<f4", 4)
+    if obj.colors is not None:
+      attributes["_COLOR_0"] = self.colors( obj.colors)
+    return attributes
+
+  def write(self, f):
+    """Write the GLB to the binary file f, front to back"""
+    self.length += -self.length % 4
+    self.gltf["buffers"][0]["byteLength"] = self.length
+    if self.extensions:
+      self.gltf["extensionsUsed"] = sorted( self.extensions)
+    if self.required:
+      self.gltf["extensionsRequired"] = sorted( self.required)
+    for key in ("nodes", "meshes", "materials", "accessors",
+                "bufferViews"):
+      if not self.gltf[key]:
+        del self.gltf[key]
+    meta = json.dumps( self.gltf, separators=(",", ":")).encode( "utf-8")
+    meta += b" "*(-len(meta) % 4)
+    total = 12 + 8 + len(meta) + (8 + self.length if self.length else 0)
+    f.write( struct.pack( "<4sII", b"glTF", 2, total))
+    f.write( struct.pack( "<I4s", len(meta), b"JSON"))
+    f.write( meta)
+    if not self.length:
+      return total
+    f.write( struct.pack( "<I4s", self.length, b"BIN\0"))
+    written = 0
+    for offset, chunks in self.blobs:
+      f.write( bytes( offset - written))
+      written = offset
+      for chunk in chunks:
+        f.write( chunk)
+        written += len(chunk)
+    f.write( bytes( self.length - written))
+    return total
+
+_gDefaultDict = {
+  "zUp" : True
+}
+
+def exportGLB( target, *geoObjs, **kwargs):
+  """Write geoObjs to a GLB file, target being a path or a binary file
+  object, and return the number of bytes written.
+
+  With zUp, the default, the scene is turned so that the z axis of
+  the plot is up in glTF, whose up is y."""
+  opts = {}
+  for attr in _gDefaultDict:
+    opts[attr] = kwargs.get( attr, _gDefaultDict[attr])
+  writer = GLBWriter()
+  roots = [writer.node( obj) for obj in geoObjs]
+  roots = [r for r in roots if r is not None]
+  if opts["zUp"] and roots:
+    s = math.sqrt( 0.5)
+    writer.gltf["nodes"].append( {"rotation" : [-s, 0., 0., s],
+                                  "children" : roots})
+    roots = [len(writer.gltf["nodes"]) - 1]
+  if roots:
+    writer.gltf["scenes"][0]["nodes"] = roots
+  else:
+    del writer.gltf["scenes"][0]["nodes"]
+  if hasattr( target, "write"):
+    return writer.write( target)
+  with open( target, "wb") as f:
+    return writer.write( f)
@@ -0,0 +1,238 @@
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+import GeoObjects as go
+
+# Marching cubes tables
+#
+# Corner c of a cube sits at offset ((c>>0)&1, (c>>1)&1, (c>>2)&1)
+# along the three volume axes. Edge e joins corner edgeCorner[e] to the
+# corner one step along edgeAxis[e]. Rather than carrying the classic
+# 256 case table around, the triangles of every case are traced from
+# the crossings on the six faces of the cube. Faces with four crossings
+# always cut off the corners that are above the level, so neighbouring
+# cubes agree on the shared face and the surface has no cracks. Each
+# loop of crossings is fanned from a crossing none of whose diagonals
+# lie on a face of the cube, as a neighbour could have the same one.
+_corners = [((c>>0)&1, (c>>1)&1, (c>>2)&1) for c in range(8)]
+_edges = [(c, ax) for c in range(8) for ax in range(3)
+          if not (c >> ax) & 1]
+edgeCorner = np.array( [c for c, ax in _edges], dtype=np.intp)
+edgeAxis = np.array( [ax for c, ax in _edges], dtype=np.intp)
+
+def _edgeIndex( c0, c1):
+  """The edge between corners c0 and c1"""
+  c = min(c0, c1)
+  ax = (c0 ^ c1).bit_length()-1
+  return _edges.index((c, ax))
+
+def _faces():
+  """The six faces of the cube as cyclic lists of corners"""
+  faces = []
+  for ax in range(3):
+    u, w = [a for a in range(3) if a != ax]
+    for side in range(2):
+      faces.append([(side << ax) | (a << u) | (b << w)
+                    for a, b in ((0,0),(1,0),(1,1),(0,1))])
+  return faces
+
+def _shareFace( e0, e1):
+  """Whether edges e0 and e1 lie on one face of the cube"""
+  corners = [c for e in (e0, e1)
+             for c in (edgeCorner[e], edgeCorner[e] | (1 << edgeAxis[e]))]
+  return any( len({(c >> ax) & 1 for c in corners}) == 1 for ax in range(3))
+
+def _caseTriangles( case):
+  """The triangles of one case as triples of edges"""
+  above = [(case >> c) & 1 for c in range(8)]
+  links = {}
+  for face in _faces():
+    cut = [_edgeIndex(face[i], face[(i+1)%4]) for i in range(4)
+           if above[face[i]] != above[face[(i+1)%4]]]
+    if len(cut) == 2:
+      pairs = [cut]
+    elif len(cut) == 4:
+      pairs = [[_edgeIndex(face[i-1], face[i]),
+                _edgeIndex(face[i], face[(i+1)%4])]
+               for i in range(4) if above[face[i]]]
+    else:
+      pairs = []
+    for e0, e1 in pairs:
+      links.setdefault(e0, []).append(e1)
+      links.setdefault(e1, []).append(e0)
+  triangles = []
+  while links:
+    loop = [min(links)]
+    prev = None
+    while True:
+      nxt = [e for e in links[loop[-1]] if e != prev]
+      if not nxt or nxt[0] == loop[0]:
+        break
+      prev = loop[-1]
+      loop.append(nxt[0])
+    for e in loop:
+      del links[e]
+    # Orient the loop so that it winds counter clockwise seen from
+    # the side of the corners below the level.
+    mid = [np.add(_corners[edgeCorner[e]],
+                  0.5*np.eye(3)[edgeAxis[e]]) for e in loop]
+    normal = np.zeros(3)
+    for i in range(len(mid)):
+      normal += np.cross(mid[i], mid[(i+1)%len(mid)])
+    out = np.zeros(3)
+    for e in loop:
+      c0 = edgeCorner[e]
+      c1 = c0 | (1 << edgeAxis[e])
+      out += (np.array(_corners[c1])-np.array(_corners[c0]))* \
+             (1 if above[c0] else -1)
+    if np.dot(normal, out) < 0:
+      loop = loop[::-1]
+    n = len(loop)
+    apex = next( (k for k in range(n)
+                  if not any( _shareFace( loop[k], loop[j]) for j in range(n)
+                              if (j-k) % n not in (0, 1, n-1))), 0)
+    loop = loop[apex:] + loop[:apex]
+    triangles += [[loop[0], loop[i], loop[i+1]]
+                  for i in range(1, len(loop)-1)]
+  return triangles
+
+def _caseTable():
+  """Triangle counts and a (256,5,3) table of edge triples"""
+  cases = [_caseTriangles(case) for case in range(256)]
+  count = np.array( [len(t) for t in cases], dtype=np.intp)
+  table = np.full( (256, max(count), 3), -1, dtype=np.intp)
+  for case, tris in enumerate(cases):
+    if tris:
+      table[case,:len(tris)] = tris
+  return count, table
+
+triangleCount, triangleTable = _caseTable()
+
+def marchSlab( values, level, i0, shape):
+  """Marching cubes over one slab of planes i0, i0+1, ... of a volume
+  of the given shape.
+
+  Returns the sorted global edge ids of the vertices, their positions
+  in voxel units, and the faces as indices into those vertices."""
+  values = np.asarray( values, dtype=np.float32)
+  n0, n1, n2 = values.shape
+  above = values > level
+  case = np.zeros( (n0-1, n1-1, n2-1), dtype=np.uint8)
+  for c, (o0, o1, o2) in enumerate(_corners):
+    case |= above[o0:n0-1+o0, o1:n1-1+o1, o2:n2-1+o2].astype(np.uint8) << c
+  active = np.flatnonzero( triangleCount[case])
+  if len(active) == 0:
+    return (np.empty(0, dtype=np.int64), np.empty((0,3), dtype=np.float32),
+            np.empty((0,3), dtype=np.uint32))
+  cubeCase = case.reshape(-1)[active]
+  counts = triangleCount[cubeCase]
+  cube = np.repeat( np.arange(len(active)), counts)
+  tri = np.arange(len(cube)) - np.repeat( np.cumsum(counts)-counts, counts)
+  edges = triangleTable[cubeCase[cube], tri]
+  ci, cj, ck = np.unravel_index( active[cube], case.shape)
+  # Each vertex lies on a grid edge, identified by its lower grid point
+  # and its axis, so vertices shared by neighbouring cubes, and by
+  # neighbouring slabs, get the same id.
+  corner = np.array(_corners, dtype=np.int64)[edgeCorner[edges]]
+  gi = ci[:,None] + corner[...,0] + i0
+  gj = cj[:,None] + corner[...,1]
+  gk = ck[:,None] + corner[...,2]
+  ids = ((gi*shape[1] + gj)*shape[2] + gk)*3 + edgeAxis[edges]
+  ids, faces = np.unique( ids.reshape(-1), return_inverse=True)
+  axis = ids % 3
+  gi, gj, gk = np.unravel_index( ids//3, shape)
+  grid = np.stack( (gi, gj, gk), axis=1)
+  step = np.eye( 3, dtype=np.int64)[axis]
+  v0 = values[gi-i0, gj, gk]
+  v1 = values[gi-i0+step[:,0], gj+step[:,1], gk+step[:,2]]
+  with np.errstate( divide='ignore', invalid='ignore'):
+    t = np.nan_to_num( (level-v0)/(v1-v0), nan=0.5)
+  t = np.clip( t, 0., 1.)
+  positions = (grid + t[:,None]*step).astype(np.float32)
+  return ids, positions, faces.reshape(-1,3).astype(np.uint32)
+
+_iDefaultDict = {
+  "spacing" : (1., 1., 1.),
+  "origin" : (0., 0., 0.),
+  "slabSize" : None,
+  "workers" : 1
+}
+
+def marchingCubes( volume, level, **kwargs):
+  """Extract the surface where volume crosses level.
+
+  volume is any 3-D array, including a memory mapped one, and it is
+  read a slab of slabSize planes along the first axis at a time. With
+  workers > 1 the slabs are processed by that many processes. Returns
+  the welded vertices as an (N,3) float32 array, scaled by spacing and
+  shifted by origin, and the faces as an (M,3) uint32 array."""
+  opts = {}
+  for attr in _iDefaultDict:
+    opts[attr] = kwargs.get(attr, _iDefaultDict[attr])
+  shape = tuple(volume.shape)
+  slab = opts["slabSize"] or max( 1, 4*go.chunkSize//(shape[1]*shape[2]))
+  starts = list(range(0, shape[0]-1, slab))
+  def slabValues( i0):
+    return np.asarray( volume[i0:min(i0+slab, shape[0]-1)+1])
+  if opts["workers"] > 1:
+    pool = ProcessPoolExecutor( opts["workers"])
+    # Keep only a few slabs in flight so the memory stays bounded.
+    pending = [pool.submit( marchSlab, slabValues(i0), level, i0, shape)
+               for i0 in starts[:2*opts["workers"]]]
+    queued = starts[2*opts["workers"]:]
+    def results():
+      while pending:
+        result = pending.pop(0).result()
+        if queued:
+          i0 = queued.pop(0)
+          pending.append( pool.submit( marchSlab, slabValues(i0),
+                                       level, i0, shape))
+        yield result
+  else:
+    pool = None
+    results = lambda: (marchSlab( slabValues(i0), level, i0, shape)
+                       for i0 in starts)
+  vertices = []
+  faces = []
+  nVerts = 0
+  prevIds = np.empty( 0, dtype=np.int64)
+  prevIndex = np.empty( 0, dtype=np.int64)
+  try:
+    for i0, (ids, positions, tris) in zip(starts, results()):
+      # Vertices on the plane shared with the previous slab already
+      # have an index.
+      where = np.minimum( np.searchsorted( prevIds, ids),
+                          max(len(prevIds)-1, 0))
+      found = (prevIds[where] == ids) if len(prevIds) else \
+              np.zeros( len(ids), dtype=bool)
+      index = np.empty( len(ids), dtype=np.int64)
+      index[found] = prevIndex[where[found]]
+      index[~found] = nVerts + np.arange( np.count_nonzero(~found))
+      nVerts += np.count_nonzero(~found)
+      vertices.append( positions[~found])
+      faces.append( index[tris].astype(np.uint32))
+      top = min(i0+slab, shape[0]-1)
+      onTop = (ids//3)//(shape[1]*shape[2]) == top
+      prevIds = ids[onTop]
+      prevIndex = index[onTop]
+  finally:
+    if pool:
+      pool.shutdown()
+  vertices = np.concatenate( vertices) if vertices else \
+             np.empty( (0,3), dtype=np.float32)
+  faces = np.concatenate( faces) if faces else \
+          np.empty( (0,3), dtype=np.uint32)
+  vertices *= np.asarray( opts["spacing"], dtype=np.float32)
+  vertices += np.asarray( opts["origin"], dtype=np.float32)
+  return (vertices, faces)
+
+def isosurface( volume, level, **kwargs):
+  """A TriangleSet of the surface where volume crosses level. The
+  keywords of marchingCubes control the extraction, the rest are
+  passed on to the TriangleSet."""
+  opts = {}
+  for attr in _iDefaultDict:
+    if attr in kwargs:
+      opts[attr] = kwargs.pop(attr)
+  vertices, faces = marchingCubes( volume, level, **opts)
+  return go.TriangleSet( vertices, faces, **kwargs)
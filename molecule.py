@@ -0,0 +1,147 @@
+import numpy as np
+
+import GeoObjects as go
+
+# Covalent radii in Angstrom (Cordero et al. 2008), used to decide
+# which atoms are bonded.
+covalentRadius = {
+  "H" : 0.31, "He" : 0.28, "Li" : 1.28, "Be" : 0.96, "B" : 0.84,
+  "C" : 0.76, "N" : 0.71, "O" : 0.66, "F" : 0.57, "Ne" : 0.58,
+  "Na" : 1.66, "Mg" : 1.41, "Al" : 1.21, "Si" : 1.11, "P" : 1.07,
+  "S" : 1.05, "Cl" : 1.02, "Ar" : 1.06, "K" : 2.03, "Ca" : 1.76,
+  "Mn" : 1.39, "Fe" : 1.32, "Co" : 1.26, "Ni" : 1.24, "Cu" : 1.32,
+  "Zn" : 1.22, "Se" : 1.20, "Br" : 1.20, "I" : 1.39
+}
+defaultRadius = 1.5
+
+# CPK colors as used by Jmol.
+elementColor = {
+  "H" : 0xffffff, "He" : 0xd9ffff, "Li" : 0xcc80ff, "B" : 0xffb5b5,
+  "C" : 0x909090, "N" : 0x3050f8, "O" : 0xff0d0d, "F" : 0x90e050,
+  "Na" : 0xab5cf2, "Mg" : 0x8aff00, "Si" : 0xf0c8a0, "P" : 0xff8000,
+  "S" : 0xffff30, "Cl" : 0x1ff01f, "K" : 0x8f40d4, "Ca" : 0x3dff00,
+  "Mn" : 0x9c7ac7, "Fe" : 0xe06633, "Co" : 0xf090a0, "Ni" : 0x50d050,
+  "Cu" : 0xc88033, "Zn" : 0x7d80b0, "Se" : 0xffa100, "Br" : 0xa62929,
+  "I" : 0x940094
+}
+defaultColor = 0xff1493
+
+def elementTable( elements, table, default):
+  """Look up a per element value for an array of element symbols.
+  Only the distinct symbols go through the table, so this is linear
+  in the number of atoms."""
+  symbols, inverse = np.unique( np.asarray(elements).astype(str),
+                                return_inverse=True)
+  values = [table.get( s.strip().capitalize(), default) for s in symbols]
+  return np.asarray( values)[inverse.reshape(-1)]
+
+def elementColors( elements):
+  """(N,3) uint8 CPK colors of the elements"""
+  rgb = elementTable( elements, elementColor, defaultColor)
+  return np.stack( ((rgb >> 16) & 255, (rgb >> 8) & 255, rgb & 255),
+                   axis=1).astype(np.uint8)
+
+# The cell itself and the 13 neighbouring cells that come after it, so
+# every pair of neighbouring cells is visited once.
+_cellOffsets = [(i, j, k) for i in (-1,0,1) for j in (-1,0,1)
+                for k in (-1,0,1) if (i, j, k) >= (0, 0, 0)]
+
+_bDefaultDict = {
+  "tolerance" : 0.45,
+  "minDistance" : 0.4
+}
+
+def findBonds( coords, elements, **kwargs):
+  """Pairs of bonded atoms as an (M,2) array of indices.
+
+  Atoms i and j are bonded when they are further apart than
+  minDistance and closer than the sum of their covalent radii plus
+  tolerance. The atoms are binned in cubic cells as wide as the
+  largest cutoff, so only atoms in neighbouring cells are compared and
+  the work grows linearly with the number of atoms."""
+  opts = {}
+  for attr in _bDefaultDict:
+    opts[attr] = kwargs.get(attr, _bDefaultDict[attr])
+  coords = np.asarray( coords, dtype=np.float64).reshape(-1,3)
+  radius = elementTable( elements, covalentRadius, defaultRadius)
+  if len(coords) < 2:
+    return np.empty( (0,2), dtype=np.int64)
+  width = 2.*radius.max() + opts["tolerance"]
+  cell = np.floor( (coords-coords.min(axis=0))/width).astype(np.int64)
+  dims = cell.max(axis=0) + 2
+  key = (cell[:,0]*dims[1] + cell[:,1])*dims[2] + cell[:,2]
+  order = np.argsort( key, kind='stable')
+  cells, start, count = np.unique( key[order], return_index=True,
+                                   return_counts=True)
+  atomCell = np.repeat( np.arange(len(cells)), count)
+  cellOf = cell[order]
+  xyz = coords[order]
+  rad = radius[order]
+  bonds = []
+  step = max( 1, go.chunkSize//32)
+  for off in _cellOffsets:
+    # Where the neighbouring cell of every occupied cell starts, and
+    # how many atoms it holds.
+    nb = cellOf + off
+    nkey = (nb[:,0]*dims[1] + nb[:,1])*dims[2] + nb[:,2]
+    where = np.minimum( np.searchsorted( cells, nkey), len(cells)-1)
+    found = (cells[where] == nkey) & (nb >= 0).all(axis=1)
+    nStart = np.where( found, start[where], 0)
+    nCount = np.where( found, count[where], 0)
+    if off == (0, 0, 0):
+      # Within a cell only pair each atom with the ones after it.
+      pos = np.arange(len(xyz)) - start[atomCell]
+      nStart = nStart + pos + 1
+      nCount = np.maximum( nCount - pos - 1, 0)
+    for sl in go.chunks( len(xyz), step):
+      m = nCount[sl]
+      i = np.repeat( np.arange(sl.start, sl.stop), m)
+      j = np.repeat( nStart[sl], m) + \
+          np.arange(len(i)) - np.repeat( np.cumsum(m)-m, m)
+      d = np.linalg.norm( xyz[i]-xyz[j], axis=1)
+      ok = (d > opts["minDistance"]) & \
+           (d < rad[i] + rad[j] + opts["tolerance"])
+      bonds.append( np.stack( (order[i[ok]], order[j[ok]]), axis=1))
+  bonds = np.concatenate( bonds)
+  return np.sort( bonds, axis=1)
+
+_mDefaultDict = {
+  "atomScale" : 0.5,
+  "bondRadius" : 0.15,
+  "atomLod" : 2,
+  "bondLod" : 1
+}
+
+def ballAndStick( coords, elements, bonds=None, **kwargs):
+  """Ball and stick geometry of a molecule.
+
+  Returns a Sphere with one ball per atom, colored by element and
+  sized atomScale times its covalent radius, and a Cylinder with two
+  half sticks per bond, each colored like the atom it starts from.
+  The bonds are found with findBonds unless they are given. Other
+  keywords are passed on to findBonds and to the geometry."""
+  opts = {}
+  for attr in _mDefaultDict:
+    opts[attr] = kwargs.pop(attr, _mDefaultDict[attr])
+  bondOpts = {}
+  for attr in _bDefaultDict:
+    if attr in kwargs:
+      bondOpts[attr] = kwargs.pop(attr)
+  coords = np.asarray( coords, dtype=np.float32).reshape(-1,3)
+  if bonds is None:
+    bonds = findBonds( coords, elements, **bondOpts)
+  bonds = np.asarray( bonds, dtype=np.int64).reshape(-1,2)
+  colors = elementColors( elements)
+  radius = opts["atomScale"]*elementTable( elements, covalentRadius,
+                                           defaultRadius)
+  atoms = go.Sphere( coords, radius, colors=colors, lod=opts["atomLod"],
+                     **kwargs)
+  ends = coords[bonds]
+  mid = 0.5*(ends[:,0]+ends[:,1])
+  sticks = go.Cylinder( np.concatenate( (ends[:,0], ends[:,1])),
+                        np.concatenate( (mid, mid)),
+                        opts["bondRadius"],
+                        colors = np.concatenate( (colors[bonds[:,0]],
+                                                  colors[bonds[:,1]])),
+                        lod = opts["bondLod"], **kwargs)
+  return (atoms, sticks)
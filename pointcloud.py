@@ -0,0 +1,333 @@
+import os
+import json
+
+import numpy as np
+
+import GeoObjects as go
+from server import TileServer
+
+# Multi-resolution point cloud tiles
+#
+# buildOctree splits a point set into an octree whose every node holds
+# a random sample of at most about tileSize of the points in its cube,
+# and whose children hold the rest. A node is written to <key>.bin as
+# float32 positions followed by uint8 colors, where the key is "r"
+# followed by the octant (x + 2y + 4z) of each level. Nodes that hold
+# more than memoryPoints points are split by streaming them into spill
+# files for their eight children, so the build never holds more than
+# memoryPoints points in memory.
+
+def recordType( hasColors):
+  """The dtype of a point record in the spill files"""
+  fields = [("xyz", "<f4", (3,))]
+  if hasColors:
+    fields.append( ("rgb", "u1", (3,)))
+  return np.dtype(fields)
+
+def octants( xyz, lo, size):
+  """The child octant of every point of a cube at lo of width size"""
+  c = np.clip( ((xyz-lo)*(2./size)).astype(np.intp), 0, 1)
+  return c[:,0] + 2*c[:,1] + 4*c[:,2]
+
+def childCorner( lo, size, c):
+  """The corner of octant c of a cube at lo of width size"""
+  return lo + 0.5*size*np.array( [c & 1, (c >> 1) & 1, (c >> 2) & 1])
+
+_oDefaultDict = {
+  "tileSize" : 1 << 16,
+  "memoryPoints" : 1 << 24,
+  "maxDepth" : 20,
+  "seed" : 0
+}
+
+class OctreeBuilder:
+  """Writes the tiles of an octree into directory"""
+
+  def __init__(self, directory, hasColors, **kwargs):
+    for attr in _oDefaultDict:
+      setattr( self, attr, kwargs.get(attr, _oDefaultDict[attr]))
+    self.directory = directory
+    self.dtype = recordType( hasColors)
+    self.rng = np.random.default_rng( self.seed)
+    self.nodes = {}
+
+  def writeTile(self, key, rec):
+    with open( os.path.join( self.directory, key + ".bin"), "wb") as f:
+      f.write( np.ascontiguousarray( rec["xyz"], dtype="<f4").tobytes())
+      if "rgb" in rec.dtype.names:
+        f.write( np.ascontiguousarray( rec["rgb"], dtype="u1").tobytes())
+    self.nodes[key] = len(rec)
+
+  def build(self, source, count, key, lo, size, depth=0):
+    """Build the node key from source, a function that returns an
+    iterator over the record chunks of its count points"""
+    if count <= self.memoryPoints or depth >= self.maxDepth:
+      rec = np.concatenate( list(source()) or
+                            [np.empty( 0, dtype=self.dtype)])
+      self.buildInMemory( rec[self.rng.permutation(len(rec))],
+                          key, lo, size, depth)
+      return
+    # Keep every point with probability tileSize/count, and spill the
+    # others into a file for each child.
+    keep = float(self.tileSize)/count
+    tile = []
+    spill = [os.path.join( self.directory, key + str(c) + ".spill")
+             for c in range(8)]
+    # A build that failed may have left its spill files behind, which
+    # would be appended to.
+    for path in spill:
+      if os.path.exists( path):
+        os.remove( path)
+    counts = np.zeros( 8, dtype=np.int64)
+    for rec in source():
+      mask = self.rng.random( len(rec)) < keep
+      tile.append( rec[mask])
+      rest = rec[~mask]
+      oct = octants( rest["xyz"], lo, size)
+      order = np.argsort( oct, kind='stable')
+      n = np.bincount( oct, minlength=8)
+      start = 0
+      for c in range(8):
+        if n[c]:
+          with open( spill[c], "ab") as f:
+            f.write( rest[order[start:start+n[c]]].tobytes())
+        start += n[c]
+      counts += n
+    self.writeTile( key, np.concatenate( tile))
+    for c in range(8):
+      if counts[c]:
+        mm = np.memmap( spill[c], dtype=self.dtype, mode="r")
+        self.build( lambda mm=mm: (mm[sl] for sl in go.chunks(len(mm))),
+                    len(mm), key + str(c), childCorner( lo, size, c),
+                    0.5*size, depth+1)
+        del mm
+        os.remove( spill[c])
+
+  def buildInMemory(self, rec, key, lo, size, depth):
+    """Build the node key from shuffled records held in memory"""
+    stack = [(rec, key, lo, size, depth)]
+    while stack:
+      rec, key, lo, size, depth = stack.pop()
+      if len(rec) <= self.tileSize or depth >= self.maxDepth:
+        self.writeTile( key, rec)
+        continue
+      # The records are shuffled, and the split keeps their order, so
+      # the first tileSize of every node are a random sample.
+      self.writeTile( key, rec[:self.tileSize])
+      rest = rec[self.tileSize:]
+      oct = octants( rest["xyz"], lo, size)
+      order = np.argsort( oct, kind='stable')
+      n = np.bincount( oct, minlength=8)
+      start = 0
+      for c in range(8):
+        if n[c]:
+          stack.append( (rest[order[start:start+n[c]]], key + str(c),
+                         childCorner( lo, size, c), 0.5*size, depth+1))
+        start += n[c]
+
+def buildOctree( points, directory, colors=None, **kwargs):
+  """Write the octree tiles of points, an (N,3) array that may be
+  memory mapped, with optional (N,3) uint8 colors, into directory,
+  along with an octree.json that describes them."""
+  if not os.path.isdir( directory):
+    os.makedirs( directory)
+  builder = OctreeBuilder( directory, colors is not None, **kwargs)
+  vmin, vmax = go.arrayBoundingBox( points)
+  lo = np.array( vmin.v)
+  size = max( max( go.listSub( vmax.v, vmin.v)), 1e-12)*(1.+1e-6)
+  def source():
+    for sl in go.chunks( len(points)):
+      rec = np.empty( sl.stop-sl.start, dtype=builder.dtype)
+      rec["xyz"] = points[sl]
+      if colors is not None:
+        rec["rgb"] = colors[sl]
+      yield rec
+  builder.build( source, len(points), "r", lo, size)
+  meta = {
+    "min" : list(lo),
+    "size" : size,
+    "boxMin" : vmin.v,
+    "boxMax" : vmax.v,
+    "points" : int(len(points)),
+    "tileSize" : builder.tileSize,
+    "hasColors" : colors is not None,
+    "nodes" : builder.nodes
+  }
+  with open( os.path.join( directory, "octree.json"), "w") as f:
+    json.dump( meta, f)
+  return meta
+
+_ptDefaultDict = {
+  "pointBudget" : 1 << 22,
+  "maxScreenError" : 2.,
+  "maxRequests" : 4
+}
+
+class PointTiles(go.Point):
+  """A point cloud drawn from the octree tiles that buildOctree wrote
+  into directory.
+
+  The tiles are fetched from url, or from a TileServer started on the
+  directory. As the camera moves the page loads the nodes in view
+  whose point spacing would cover more than maxScreenError pixels, and
+  unloads the others, keeping at most pointBudget points."""
+
+  def __init__(self, directory, url=None, **kwargs):
+    with open( os.path.join( directory, "octree.json")) as f:
+      self.meta = json.load(f)
+    if self.meta["hasColors"] and "pointColor" not in kwargs:
+      kwargs["pointColor"] = 'rgb(255,255,255)'
+    go.Point.__init__( self, **kwargs)
+    for attr in _ptDefaultDict:
+      if attr in kwargs:
+        setattr( self, attr, kwargs[attr])
+      else:
+        setattr( self, attr, _ptDefaultDict[attr])
+    self.server = None
+    if url is None:
+      self.server = TileServer( directory).start()
+      url = self.server.url
+    self.url = url
+
+  def boundingBox(self):
+    return (go.Vector3( self.meta["boxMin"]), go.Vector3( self.meta["boxMax"]))
+
+  def stats(self):
+    vmin, vmax = self.boundingBox()
+    n = self.meta["points"]
+    return (0.5*n*(vmin+vmax), n)
+
+  ptScene = """\
+  (function() {{
+    var meta = {META};
+    var url = "{URL}";
+    var budget = {BUDGET};
+    var maxError = {MAX_ERROR};
+    var maxRequests = {MAX_REQUESTS};
+    var texture = new THREE.Texture( canv);
+    texture.needsUpdate = true;
+    var material = new THREE.PointCloudMaterial({{
+      map: texture,
+      transparent: true,
+      size: canvSize,
+      sizeAttenuation: false,
+      vertexColors: meta.hasColors ? THREE.VertexColors : THREE.NoColors,
+      fog: true
+    }});
+    material.alphaTest = 0.05;
+    var loaded = {{}};
+    var requests = 0;
+    var visible = {{}};
+
+    function nodeBox( key) {{
+      var size = meta.size;
+      var lo = new THREE.Vector3( meta.min[0], meta.min[1], meta.min[2]);
+      for (var i = 1; i < key.length; i++) {{
+        var c = parseInt( key[i]);
+        size = size/2;
+        lo.x += (c & 1) ? size : 0;
+        lo.y += (c & 2) ? size : 0;
+        lo.z += (c & 4) ? size : 0;
+      }}
+      return new THREE.Box3( lo, lo.clone().addScalar( size));
+    }}
+
+    // The size on screen, in pixels, of the gap between the points of
+    // a node.
+    function screenError( box) {{
+      var size = box.max.x - box.min.x;
+      var d = box.distanceToPoint( camera.position);
+      var scale = canvas.height/(2*Math.tan( camera.fov*Math.PI/360));
+      return size/Math.sqrt( meta.tileSize)*scale/Math.max( d, 1e-6*size);
+    }}
+
+    function load( key) {{
+      requests++;
+      loaded[key] = null;
+      var xhr = new XMLHttpRequest();
+      xhr.open( 'GET', url + '/' + key + '.bin');
+      xhr.responseType = 'arraybuffer';
+      xhr.onload = function() {{
+        requests--;
+        var n = meta.nodes[key];
+        var geometry = new THREE.BufferGeometry();
+        geometry.addAttribute( 'position', new THREE.BufferAttribute(
+          new Float32Array( xhr.response, 0, 3*n), 3));
+        if (meta.hasColors) {{
+          geometry.addAttribute( 'color', new THREE.BufferAttribute(
+            unitColors( new Uint8Array( xhr.response, 12*n, 3*n)), 3));
+        }}
+        loaded[key] = new THREE.PointCloud( geometry, material);
+        scene.add( loaded[key]);
+        update();
+      }};
+      xhr.onerror = function() {{
+        requests--;
+        delete loaded[key];
+      }};
+      xhr.send();
+    }}
+
+    function update() {{
+      camera.updateMatrixWorld();
+      var frustum = new THREE.Frustum();
+      frustum.setFromMatrix( new THREE.Matrix4().multiplyMatrices(
+        camera.projectionMatrix, camera.matrixWorldInverse));
+      // Visit the nodes with the largest error first, until the point
+      // budget is used up.
+      var queue = [{{ key : 'r', error : Infinity }}];
+      var points = 0;
+      visible = {{}};
+      while (queue.length) {{
+        queue.sort( function( a, b) {{ return b.error - a.error; }});
+        var node = queue.shift();
+        if (points + meta.nodes[node.key] > budget) {{
+          break;
+        }}
+        visible[node.key] = node.error;
+        points += meta.nodes[node.key];
+        for (var c = 0; c < 8; c++) {{
+          var child = node.key + c;
+          if (meta.nodes[child] === undefined) {{
+            continue;
+          }}
+          var box = nodeBox( child);
+          var error = screenError( box);
+          if (error > maxError && frustum.intersectsBox( box)) {{
+            queue.push( {{ key : child, error : error }});
+          }}
+        }}
+      }}
+      for (var key in loaded) {{
+        if (visible[key] === undefined && loaded[key]) {{
+          scene.remove( loaded[key]);
+          loaded[key].geometry.dispose();
+          delete loaded[key];
+        }}
+      }}
+      var wanted = Object.keys( visible).filter( function( key) {{
+        return !(key in loaded);
+      }}).sort( function( a, b) {{ return visible[b] - visible[a]; }});
+      for (var i = 0; i < wanted.length && requests < maxRequests; i++) {{
+        load( wanted[i]);
+      }}
+      requestRender();
+    }}
+
+    var timer = null;
+    controls.addEventListener( 'change', function() {{
+      clearTimeout( timer);
+      timer = setTimeout( update, 100);
+    }});
+    update();
+  }})();
+  """
+
+  def render(self):
+    return (self.renderCanvas() + self.ptScene.format(
+              META = json.dumps( self.meta),
+              URL = self.url,
+              BUDGET = self.pointBudget,
+              MAX_ERROR = self.maxScreenError,
+              MAX_REQUESTS = self.maxRequests
+            ))
@@ -0,0 +1,578 @@
+import re
+import math
+import zlib
+import struct
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import GeoObjects as go
+from animation import Animation
+
+# Software rendering to PNG
+#
+# rasterize draws the geo objects on the CPU, from the camera that
+# render would fit to them and with the lights of its lighting script,
+# for outputs that cannot run WebGL. The vertices are projected once,
+# then the image is cut into bands of rows that are drawn on their own,
+# in threads when workers > 1. Triangles, lines and points are drawn in
+# batches of the same bounding square size, testing every pixel of the
+# square at once. Every batch writes the inverse depth of its fragments
+# into a z-buffer, and for triangles the face and barycentric
+# coordinates of the nearest one, so the Phong lighting of three.js is
+# evaluated once for every visible pixel at the end.
+#
+# Transparency, fog and Text objects are not drawn, and primitives
+# that reach behind the camera's front plane are dropped rather than
+# clipped.
+
+def colorArray( color):
+  """RGB in [0,1] of a color given as 0xRRGGBB, #RRGGBB, rgb(r,g,b)
+  or an integer"""
+  if isinstance( color, (int, np.integer)):
+    value = int(color)
+  else:
+    s = str(color).strip()
+    m = re.match( r"rgba?\(\s*([\d.]+)\s*,\s*([\d.]+)\s*,\s*([\d.]+)", s)
+    if m:
+      return np.array( [float(x) for x in m.groups()])/255.
+    value = int( s[1:] if s.startswith("#") else s, 16)
+  return np.array( [(value >> 16) & 255, (value >> 8) & 255,
+                    value & 255])/255.
+
+_lightPattern = re.compile(
+  r"new THREE\.(Directional|Ambient)Light\(\s*(\w+)\s*\)"
+  r"|(camera|scene)\.add\(\s*light\s*\)"
+  r"|light\.position\.set\(([^)]*)\)")
+
+def parseLighting( lighting):
+  """The lights of a lighting script, like defaultLighting, as a list
+  of [kind, color, parent, position]"""
+  lights = []
+  for m in _lightPattern.finditer( lighting):
+    if m.group(1):
+      lights.append( [m.group(1), colorArray( m.group(2)), "scene",
+                      np.array( [0., 1., 0.])])
+    elif m.group(3) and lights:
+      lights[-1][2] = m.group(3)
+    elif m.group(4) is not None and lights:
+      lights[-1][3] = np.array( [float(x) for x in m.group(4).split(",")])
+  return lights
+
+class RasterCamera:
+  """The perspective camera of renderD for an image of width x height"""
+
+  def __init__(self, renderD, width, height):
+    self.position = np.array( renderD["cameraPosition"].v, dtype=np.float64)
+    forward = np.array( renderD["cameraTarget"].v) - self.position
+    forward = forward/np.linalg.norm( forward)
+    right = np.cross( forward, renderD["cameraUp"].v)
+    right = right/np.linalg.norm( right)
+    # The rows map world directions to the camera's x, y and z, which
+    # looks down -z like a three.js camera.
+    self.rotation = np.array( [right, np.cross( right, forward), -forward])
+    self.near = renderD["cameraFrontPlane"]
+    self.far = renderD["cameraBackPlane"]
+    self.width = width
+    self.height = height
+    self.focal = 0.5*height/math.tan( 0.5*renderD["cameraFOV"])
+
+  def project(self, points):
+    """Pixel x, y and inverse depth of (N,3) points, with a depth of
+    zero for those outside the front and back planes"""
+    cam = (np.asarray( points, dtype=np.float64) - self.position) @ \
+          self.rotation.T
+    depth = -cam[:,2]
+    inside = (depth >= self.near) & (depth <= self.far)
+    w = np.where( inside, 1./np.where( inside, depth, 1.), 0.)
+    x = 0.5*self.width + self.focal*cam[:,0]*w
+    y = 0.5*self.height - self.focal*cam[:,1]*w
+    return (x.astype(np.float32), y.astype(np.float32), w.astype(np.float32))
+
+  def lightDirections(self, lights):
+    """Unit directions towards the directional lights, and the total
+    ambient color"""
+    dirs = []
+    colors = []
+    ambient = np.zeros(3)
+    for kind, color, parent, position in lights:
+      if kind == "Ambient":
+        ambient = ambient + color
+        continue
+      if parent == "camera":
+        position = self.position + position @ self.rotation
+      # A three.js directional light shines from its position towards
+      # its target, which stays at the origin.
+      dirs.append( position/max( np.linalg.norm( position), 1e-12))
+      colors.append( color)
+    return (np.array( dirs).reshape(-1,3), np.array( colors).reshape(-1,3),
+            ambient)
+
+def instanceMesh( inst):
+  """The vertices, normals, faces and colors of every copy of an
+  Instances object"""
+  verts, normals, faces = inst.template( inst.lod)
+  scales = inst.scales.astype(np.float64)
+  v = verts[None]*scales[:,None]
+  n = normals[None]/np.where( scales == 0., 1., scales)[:,None]
+  if inst.orientations is not None:
+    rot = go.quaternionMatrices( inst.orientations)
+    v = np.einsum( 'kij,ktj->kti', rot, v)
+    n = np.einsum( 'kij,ktj->kti', rot, n)
+  v = v + inst.positions[:,None]
+  n = n/np.maximum( np.linalg.norm( n, axis=2, keepdims=True), 1e-12)
+  k = len(inst.positions)
+  f = faces[None].astype(np.int64) + len(verts)*np.arange(k)[:,None,None]
+  colors = None
+  if inst.colors is not None:
+    colors = np.repeat( inst.colors, len(verts), axis=0)
+  return (v.reshape(-1,3), n.reshape(-1,3), f.reshape(-1,3), colors)
+
+class RasterScene:
+  """The projected triangles, line segments and points of geoObjs"""
+
+  def __init__(self, geoObjs, camera):
+    self.camera = camera
+    meshes = []
+    segments = []
+    points = []
+    # Objects in groups are moved into world coordinates here, as the
+    # page does with the matrices of their THREE.Object3D's.
+    for geoObj, matrix in go.groupLeaves( geoObjs):
+      if isinstance( geoObj, Animation):
+        geoObj = geoObj.geoObj
+      moved = not np.array_equal( matrix, np.eye(4))
+      if isinstance( geoObj, (go.TriangleSet, go.Instances)):
+        if isinstance( geoObj, go.TriangleSet):
+          normals = None
+          if geoObj.smooth:
+            normals = geoObj.smoothNormals()
+          v, n, f, c = (geoObj.vertices, normals,
+                        geoObj.faces.astype(np.int64),
+                        go.vertexColors( geoObj))
+        else:
+          v, n, f, c = instanceMesh( geoObj)
+        if moved:
+          v = go.transformPoints( v, matrix)
+          n = None if n is None else go.transformNormals( n, matrix)
+        meshes.append( (geoObj, v, n, f, c))
+      elif isinstance( geoObj, go.GeoSet):
+        v = np.asarray( geoObj.vertices, dtype=np.float64)
+        n = geoObj.smoothNormals()
+        if moved:
+          v = go.transformPoints( v, matrix)
+          n = None if n is None else go.transformNormals( n, matrix)
+        colors = go.vertexColors( geoObj)
+        if geoObj.faces is not None:
+          meshes.append( (geoObj, v, n, geoObj.faces.astype(np.int64),
+                          colors))
+        if geoObj.edges is not None:
+          e = geoObj.edges.astype(np.int64)
+          color = colorArray( geoObj.lineColor) if colors is None else \
+                  colors[e[:,0]]/255.
+          segments.append( (v[e[:,0]], v[e[:,1]], color, geoObj.lineWidth))
+        if geoObj.points is not None:
+          color = geoObj.pointColor or geoObj.pointEdgeColor or "0x000000"
+          points.append( (v[geoObj.points],
+                          colorArray( color) if colors is None else
+                          colors[geoObj.points]/255., geoObj.pointSize,
+                          geoObj.pointStyle in ("circle", "disk")))
+      elif isinstance( geoObj, go.Line):
+        v = np.asarray( geoObj.vertices, dtype=np.float64)
+        if moved:
+          v = go.transformPoints( v, matrix)
+        colors = go.vertexColors( geoObj)
+        # A segment takes the color of its first vertex.
+        color = colorArray( geoObj.lineColor) if colors is None else \
+                colors[:-1]/255.
+        segments.append( (v[:-1], v[1:], color, geoObj.lineWidth))
+      elif isinstance( geoObj, go.Point) and hasattr( geoObj, "vertices"):
+        v = np.asarray( geoObj.vertices, dtype=np.float64)
+        if moved:
+          v = go.transformPoints( v, matrix)
+        colors = go.vertexColors( geoObj)
+        color = geoObj.pointColor or geoObj.pointEdgeColor or "0x000000"
+        points.append( (v, colorArray( color) if colors is None else
+                           colors/255., geoObj.pointSize,
+                        geoObj.pointStyle in ("circle", "disk")))
+    self.setMeshes( meshes)
+    self.setSegments( segments)
+    self.setPoints( points)
+
+  def setMeshes(self, meshes):
+    """Stack the triangles of all the meshes"""
+    verts, normals, faces, colors, faceMesh = [], [], [], [], []
+    self.materials = []
+    offset = 0
+    for i, (obj, v, n, f, c) in enumerate(meshes):
+      v = np.asarray( v, dtype=np.float64)
+      if n is None:
+        # Flat shading, every face gets its own vertices.
+        tri = v[f]
+        n = np.repeat( np.cross( tri[:,1]-tri[:,0], tri[:,2]-tri[:,0]),
+                       3, axis=0)
+        v = tri.reshape(-1,3)
+        c = None if c is None else np.asarray(c)[f.reshape(-1)]
+        f = np.arange( len(v)).reshape(-1,3)
+      verts.append( v)
+      normals.append( np.asarray( n, dtype=np.float32))
+      faces.append( f + offset)
+      colors.append( np.ones( (len(v),3), dtype=np.float32) if c is None
+                     else np.asarray( c, dtype=np.float32)/255.)
+      faceMesh.append( np.full( len(f), i, dtype=np.int32))
+      offset += len(v)
+      self.materials.append( {
+        "color" : colorArray( "0xffffff" if c is not None else obj.color),
+        "ambient" : colorArray( obj.ambient),
+        "specular" : colorArray( obj.specular),
+        "emissive" : colorArray( obj.emissive),
+        "shininess" : float( obj.shininess)})
+    self.vertices = np.concatenate( verts or [np.empty((0,3))])
+    self.normals = np.concatenate( normals or [np.empty((0,3), np.float32)])
+    self.faces = np.concatenate( faces or [np.empty((0,3), np.int64)])
+    self.colors = np.concatenate( colors or [np.empty((0,3), np.float32)])
+    self.faceMesh = np.concatenate( faceMesh or [np.empty(0, np.int32)])
+    self.x, self.y, self.w = self.camera.project( self.vertices)
+    # Keep the faces that are in front of the camera, with an area.
+    fx, fy, fw = self.x[self.faces], self.y[self.faces], self.w[self.faces]
+    area = (fx[:,1]-fx[:,0])*(fy[:,2]-fy[:,0]) - \
+           (fx[:,2]-fx[:,0])*(fy[:,1]-fy[:,0])
+    keep = (fw > 0.).all(axis=1) & (area != 0.) & \
+           (fx.max(axis=1) >= 0.) & (fx.min(axis=1) <= self.camera.width) & \
+           (fy.max(axis=1) >= 0.) & (fy.min(axis=1) <= self.camera.height)
+    self.visible = np.flatnonzero( keep)
+    self.faceYMin = fy.min(axis=1)[self.visible]
+    self.faceYMax = fy.max(axis=1)[self.visible]
+
+  def setSegments(self, segments):
+    """Stack the line segments, and project their ends"""
+    ends = [np.concatenate( [s[i] for s in segments] or
+                            [np.empty((0,3))]) for i in range(2)]
+    self.segmentColors = np.concatenate(
+      [np.broadcast_to( s[2], (len(s[0]),3)) for s in segments] or
+      [np.empty((0,3))]).astype(np.float32)
+    self.segmentWidths = np.concatenate(
+      [np.full( len(s[0]), max( 1, int(round(s[3])))) for s in segments] or
+      [np.empty(0, np.int64)])
+    (x0, y0, w0), (x1, y1, w1) = [[a.astype(np.float64) for a in
+                                   self.camera.project( e)] for e in ends]
+    keep = np.flatnonzero( (w0 > 0.) & (w1 > 0.))
+    # Clip to the image once, so every band samples a segment at the
+    # same points.
+    pad = float( self.segmentWidths.max()) if len(keep) else 0.
+    sel, start, end = clipSegments(
+      *[a[keep] for a in (x0, y0, w0, x1, y1, w1)],
+      lo = (-pad, -pad), hi = (self.camera.width+pad, self.camera.height+pad))
+    self.segmentVisible = keep[sel]
+    self.segmentStart = start
+    self.segmentEnd = end
+    self.segmentSteps = np.ceil( np.maximum( np.abs(end[0]-start[0]),
+                                             np.abs(end[1]-start[1]))
+                               ).astype(np.int64) + 1
+
+  def setPoints(self, points):
+    """Stack the points, and project them"""
+    v = np.concatenate( [p[0] for p in points] or [np.empty((0,3))])
+    self.pointColors = np.concatenate(
+      [np.broadcast_to( p[1], (len(p[0]),3)) for p in points] or
+      [np.empty((0,3))]).astype(np.float32)
+    # The radius of the sprite drawn by Point.renderCanvas
+    self.pointRadii = np.concatenate(
+      [np.full( len(p[0]), 1.77*p[2]) for p in points] or
+      [np.empty(0)]).astype(np.float32)
+    self.pointRound = np.concatenate(
+      [np.full( len(p[0]), p[3]) for p in points] or [np.empty(0, bool)])
+    self.px, self.py, self.pw = self.camera.project( v)
+
+# Primitives up to this many pixels wide are batched with others of
+# exactly their width and height, wider ones by the power of two above.
+exactSide = 16
+
+def rectangleSides( size):
+  """The batch width or height for primitives size pixels wide"""
+  size = np.maximum( np.ceil( size), 1).astype(np.int64)
+  return np.where( size <= exactSide, size,
+                   1 << np.ceil( np.log2( size)).astype(np.int64))
+
+def rectangleBuckets( width, height, budget):
+  """Batches of indices of primitives with the same bounding rectangle
+  size, of at most budget pixels each"""
+  nx = rectangleSides( width)
+  ny = rectangleSides( height)
+  key = nx*(1 << 32) + ny
+  order = np.argsort( key, kind='stable')
+  keys, starts = np.unique( key[order], return_index=True)
+  ends = np.append( starts[1:], len(order))
+  for k, a, b in zip(keys, starts, ends):
+    w, h = int(k >> 32), int(k & 0xffffffff)
+    per = max( 1, budget//(w*h))
+    for i in range(a, b, per):
+      yield (w, h, order[i:min( i+per, b)])
+
+class Band:
+  """The buffers of rows y0 to y1 of the image"""
+
+  def __init__(self, width, y0, y1):
+    self.width = width
+    self.y0 = y0
+    self.y1 = y1
+    n = width*(y1-y0)
+    self.depth = np.zeros( n, dtype=np.float32)
+    self.face = np.full( n, -1, dtype=np.int64)
+    self.b = np.zeros( (n,2), dtype=np.float32)
+    self.color = np.zeros( (n,3), dtype=np.float32)
+
+  def write(self, px, py, depth, face=None, b=None, color=None):
+    """Keep the fragments at px, py that are nearer than those drawn"""
+    inside = (px >= 0) & (px < self.width) & (py >= self.y0) & \
+             (py < self.y1) & (depth > 0.)
+    pix = (py[inside] - self.y0)*self.width + px[inside]
+    depth = depth[inside]
+    np.maximum.at( self.depth, pix, depth)
+    win = depth >= self.depth[pix]
+    pix = pix[win]
+    if face is not None:
+      self.face[pix] = face[inside][win]
+      self.b[pix] = b[inside][win]
+    else:
+      self.face[pix] = -2
+      self.color[pix] = color[inside][win]
+
+def drawTriangles( scene, band, budget):
+  """Draw the faces that reach into band"""
+  sel = np.flatnonzero( (scene.faceYMax >= band.y0) &
+                        (scene.faceYMin < band.y1))
+  faces = scene.visible[sel]
+  tri = scene.faces[faces]
+  x, y, w = scene.x[tri], scene.y[tri], scene.w[tri]
+  # The pixels whose centers may be inside each face
+  i0 = np.clip( np.floor( x.min(axis=1)-0.5), 0, band.width).astype(np.int64)
+  i1 = np.clip( np.ceil( x.max(axis=1)+0.5), 0, band.width).astype(np.int64)
+  j0 = np.clip( np.floor( y.min(axis=1)-0.5), band.y0, band.y1).astype(np.int64)
+  j1 = np.clip( np.ceil( y.max(axis=1)+0.5), band.y0, band.y1).astype(np.int64)
+  ok = (i1 > i0) & (j1 > j0)
+  for nx, ny, idx in rectangleBuckets( i1-i0, j1-j0, budget):
+    idx = idx[ok[idx]]
+    if len(idx) == 0:
+      continue
+    grid = np.arange( nx*ny)
+    gx = (grid % nx).astype(np.float32)
+    gy = (grid//nx).astype(np.float32)
+    tx, ty, tw = [a[idx].astype(np.float64) for a in (x, y, w)]
+    area = (tx[:,1]-tx[:,0])*(ty[:,2]-ty[:,0]) - \
+           (tx[:,2]-tx[:,0])*(ty[:,1]-ty[:,0])
+    # The barycentric coordinates b1 and b2 are linear in the offset
+    # gx, gy of the pixel from the corner of the square.
+    ex = i0[idx] + 0.5 - tx[:,0]
+    ey = j0[idx] + 0.5 - ty[:,0]
+    a1, c1 = (ty[:,2]-ty[:,0])/area, (tx[:,0]-tx[:,2])/area
+    a2, c2 = (ty[:,0]-ty[:,1])/area, (tx[:,1]-tx[:,0])/area
+    def plane( a, c, e):
+      return (a.astype(np.float32)[:,None]*gx + c.astype(np.float32)[:,None]*gy
+              + e.astype(np.float32)[:,None])
+    b1 = plane( a1, c1, ex*a1 + ey*c1)
+    b2 = plane( a2, c2, ex*a2 + ey*c2)
+    inside = (b1 >= 0.) & (b2 >= 0.) & (b1 + b2 <= 1.)
+    if max( nx, ny) > exactSide:
+      inside &= (gx < (i1-i0)[idx,None]) & (gy < (j1-j0)[idx,None])
+    k = np.nonzero( inside)
+    t, g = k[0], k[1]
+    b1, b2 = b1[k], b2[k]
+    depth = tw[t,0] + b1*(tw[t,1]-tw[t,0]) + b2*(tw[t,2]-tw[t,0])
+    band.write( i0[idx][t] + g % nx, j0[idx][t] + g//nx,
+                depth.astype(np.float32), face = faces[idx][t],
+                b = np.stack( (b1, b2), axis=1))
+
+def clipSegments( x0, y0, w0, x1, y1, w1, lo, hi):
+  """Clip the segments to the box from lo to hi, returning the
+  indices of those that reach into it and their clipped ends"""
+  t0 = np.zeros( len(x0))
+  t1 = np.ones( len(x0))
+  for p, q in ((x0-x1, x0-lo[0]), (x1-x0, hi[0]-x0),
+               (y0-y1, y0-lo[1]), (y1-y0, hi[1]-y0)):
+    with np.errstate( divide='ignore', invalid='ignore'):
+      t = q/p
+    t0 = np.where( p < 0., np.maximum( t0, t), t0)
+    t1 = np.where( p > 0., np.minimum( t1, t), t1)
+    t1 = np.where( (p == 0.) & (q < 0.), -1., t1)
+  idx = np.flatnonzero( t0 <= t1)
+  t0, t1 = t0[idx], t1[idx]
+  return (idx, [a[idx] + t0*(b[idx]-a[idx]) for a, b in
+                ((x0, x1), (y0, y1), (w0, w1))],
+               [a[idx] + t1*(b[idx]-a[idx]) for a, b in
+                ((x0, x1), (y0, y1), (w0, w1))])
+
+def drawSegments( scene, band, budget):
+  """Draw the line segments, as runs of squares lineWidth wide"""
+  (x0, y0, w0), (x1, y1, w1) = scene.segmentStart, scene.segmentEnd
+  sel = scene.segmentVisible
+  width = scene.segmentWidths[sel]
+  last = np.maximum( scene.segmentSteps-1, 1)
+  # The samples i/last of every segment whose squares reach the band
+  dy = (y1-y0)/last
+  lo = band.y0 - 0.5*(width+1) - y0
+  hi = band.y1 + 0.5*(width+1) - y0
+  with np.errstate( divide='ignore', invalid='ignore'):
+    a = np.where( dy > 0., lo/dy, np.where( dy < 0., hi/dy, 0.))
+    b = np.where( dy > 0., hi/dy, np.where( dy < 0., lo/dy, last))
+  flat = (dy == 0.) & ((lo > 0.) | (hi < 0.))
+  first = np.clip( np.ceil(a), 0, scene.segmentSteps).astype(np.int64)
+  stop = np.clip( np.floor(b)+1, 0, scene.segmentSteps).astype(np.int64)
+  count = np.where( flat, 0, np.maximum( stop-first, 0))
+  # Batches of segments with about budget squares in all
+  batch = np.cumsum( count*width*width)//budget
+  for bb in np.unique( batch[count > 0]):
+    m = np.flatnonzero( (batch == bb) & (count > 0))
+    seg = np.repeat( m, count[m])
+    t = (np.arange( len(seg)) - np.repeat( np.cumsum( count[m]) - count[m],
+                                           count[m]) + first[seg])/last[seg]
+    cx = x0[seg] + t*(x1[seg]-x0[seg])
+    cy = y0[seg] + t*(y1[seg]-y0[seg])
+    cw = (w0[seg] + t*(w1[seg]-w0[seg])).astype(np.float32)
+    for n in np.unique( width[m]):
+      k = np.flatnonzero( width[seg] == n)
+      grid = np.arange( n*n)
+      px = np.floor( cx[k,None] - 0.5*(n-1)).astype(np.int64) + grid % n
+      py = np.floor( cy[k,None] - 0.5*(n-1)).astype(np.int64) + grid//n
+      band.write( px.reshape(-1), py.reshape(-1), np.repeat( cw[k], n*n),
+                  color = np.repeat( scene.segmentColors[sel[seg[k]]],
+                                     n*n, axis=0))
+
+def drawPoints( scene, band, budget):
+  """Draw the point sprites as disks or squares"""
+  r = scene.pointRadii
+  keep = (scene.pw > 0.) & (scene.py+r >= band.y0) & (scene.py-r < band.y1)
+  size = np.where( keep, np.ceil( 2*r)+1, 0)
+  for n, _, idx in rectangleBuckets( size, size, budget):
+    idx = idx[keep[idx]]
+    if len(idx) == 0:
+      continue
+    grid = np.arange( n*n)
+    px = np.floor( scene.px[idx,None] - 0.5*n).astype(np.int64) + grid % n
+    py = np.floor( scene.py[idx,None] - 0.5*n).astype(np.int64) + grid//n
+    ddx = px + 0.5 - scene.px[idx,None]
+    ddy = py + 0.5 - scene.py[idx,None]
+    rr = r[idx,None]
+    inside = np.where( scene.pointRound[idx,None], ddx*ddx + ddy*ddy <= rr*rr,
+                       (np.abs(ddx) <= rr) & (np.abs(ddy) <= rr))
+    k = np.nonzero( inside)
+    band.write( px[k], py[k], scene.pw[idx][k[0]],
+                color = scene.pointColors[idx][k[0]])
+
+def phong( normal, view, color, material, lights):
+  """The color of a three.js MeshPhongMaterial at points with unit
+  normal and view directions, and vertex colors color"""
+  dirs, colors, ambient = lights
+  diffuse = np.zeros( normal.shape, dtype=np.float32)
+  specular = np.zeros( normal.shape, dtype=np.float32)
+  shininess = material["shininess"]
+  for L, lc in zip(dirs.astype(np.float32), colors.astype(np.float32)):
+    diffuse += np.maximum( normal @ L, 0.)[:,None]*lc
+    half = view + L
+    half /= np.maximum( np.linalg.norm( half, axis=1, keepdims=True), 1e-12)
+    nh = np.maximum( (normal*half).sum(axis=1), 0.)
+    schlick = material["specular"] + (1.-material["specular"]) * \
+              np.maximum( 1. - half @ L, 0.)[:,None]**5
+    specular += schlick*lc*(nh**(shininess+1.)*(shininess+2.)/8.)[:,None]
+  return color*(material["emissive"] + material["color"]*diffuse +
+                ambient*material["ambient"] + specular)
+
+def shade( scene, band, lights, background):
+  """The RGB rows of band, lighting the visible faces of every mesh"""
+  image = np.tile( background.astype(np.float32), (len(band.face),1))
+  lineMask = band.face == -2
+  image[lineMask] = band.color[lineMask]
+  pix = np.flatnonzero( band.face >= 0)
+  face = band.face[pix]
+  mesh = scene.faceMesh[face]
+  for m in np.unique( mesh):
+    sel = np.flatnonzero( mesh == m)
+    tri = scene.faces[face[sel]]
+    b = np.empty( (len(sel),3), dtype=np.float32)
+    b[:,1:] = band.b[pix[sel]]
+    b[:,0] = 1. - b[:,1] - b[:,2]
+    # Perspective correct weights
+    b *= scene.w[tri]
+    b /= b.sum(axis=1, keepdims=True)
+    pos = np.einsum( 'ni,nij->nj', b, scene.vertices[tri])
+    normal = np.einsum( 'ni,nij->nj', b, scene.normals[tri])
+    normal /= np.maximum( np.linalg.norm( normal, axis=1, keepdims=True),
+                          1e-12)
+    color = np.einsum( 'ni,nij->nj', b, scene.colors[tri])
+    view = (scene.camera.position - pos).astype(np.float32)
+    view /= np.maximum( np.linalg.norm( view, axis=1, keepdims=True), 1e-12)
+    # Double sided, the back faces are lit from behind.
+    normal *= np.where( (normal*view).sum(axis=1) < 0., -1., 1.)[:,None]
+    image[pix[sel]] = np.clip( phong( normal, view, color,
+                                      scene.materials[m], lights), 0., 1.)
+  return image
+
+_rsDefaultDict = {
+  "width" : 600,
+  "height" : 400,
+  "background" : "0xffffff",
+  "workers" : 1,
+  "bandRows" : None,
+  "fragmentBudget" : 1 << 21
+}
+
+def rasterize( *geoObjs, **kwargs):
+  """Draw geoObjs on the CPU into an (height, width, 3) uint8 image.
+
+  The camera and lighting keywords are those of render. The image is
+  drawn in bands of bandRows rows, on workers threads, and every batch
+  of primitives tests at most about fragmentBudget pixels."""
+  opts = {}
+  for attr in _rsDefaultDict:
+    opts[attr] = kwargs.get( attr, _rsDefaultDict[attr])
+  width, height = opts["width"], opts["height"]
+  renderD = go.sceneParameters( geoObjs, kwargs)
+  camera = RasterCamera( renderD, width, height)
+  lights = camera.lightDirections( parseLighting( renderD["lighting"]))
+  scene = RasterScene( geoObjs, camera)
+  background = colorArray( opts["background"])
+  rows = opts["bandRows"]
+  if rows is None:
+    rows = -(-height//(4*opts["workers"])) if opts["workers"] > 1 else height
+  budget = opts["fragmentBudget"]
+
+  def drawBand( y0):
+    band = Band( width, y0, min( y0+rows, height))
+    drawTriangles( scene, band, budget)
+    drawSegments( scene, band, budget)
+    drawPoints( scene, band, budget)
+    return shade( scene, band, lights, background)
+
+  starts = range(0, height, rows)
+  if opts["workers"] > 1:
+    with ThreadPoolExecutor( opts["workers"]) as pool:
+      bands = list( pool.map( drawBand, starts))
+  else:
+    bands = [drawBand( y0) for y0 in starts]
+  image = np.concatenate( bands).reshape( height, width, 3)
+  return np.rint( image*255.).astype(np.uint8)
+
+def pngBytes( image):
+  """An (height, width, 3) uint8 image encoded as a PNG"""
+  height, width = image.shape[:2]
+  raw = np.zeros( (height, 1+3*width), dtype=np.uint8)
+  raw[:,1:] = image.reshape( height, -1)
+  def chunk( tag, data):
+    return (struct.pack( ">I", len(data)) + tag + data +
+            struct.pack( ">I", zlib.crc32( tag+data) & 0xffffffff))
+  return (b"\x89PNG\r\n\x1a\n" +
+          chunk( b"IHDR", struct.pack( ">IIBBBBB", width, height,
+                                       8, 2, 0, 0, 0)) +
+          chunk( b"IDAT", zlib.compress( raw.tobytes(), 6)) +
+          chunk( b"IEND", b""))
+
+def renderPNG( *geoObjs, **kwargs):
+  """Like render, but draws geoObjs on the CPU and returns the PNG
+  bytes, which are also written to filename if it is given. The other
+  keywords are those of rasterize."""
+  filename = kwargs.pop( "filename", None)
+  data = pngBytes( rasterize( *geoObjs, **kwargs))
+  if filename is not None:
+    with open( filename, "wb") as f:
+      f.write( data)
+  return data
@@ -0,0 +1,200 @@
+import json
+import struct
+import importlib
+from uuid import uuid4 as uuid
+
+import numpy as np
+
+import GeoObjects as go
+
+# Scene files
+#
+# saveScene writes objects to one binary file: a fixed header, a JSON
+# description of the objects and then their arrays, each at an offset
+# that is a multiple of 64. Every object is described by its class
+# and attributes, where arrays, vectors, matrices and other objects
+# are references, so an array or a child shared by several objects is
+# stored once. openScene maps the file into memory and gives the
+# objects back with their arrays as read only views of the mapping,
+# so nothing is read or copied until it is used, and the objects can
+# be passed to render as they are. The page ids of colormaps are not
+# stored, each object opened gets a new one.
+#
+#   magic    8 bytes  b"PYP3DSCN"
+#   version  uint32
+#   flags    uint32   reserved, 0
+#   length   uint64   bytes of the JSON description that follows
+
+sceneMagic = b"PYP3DSCN"
+sceneVersion = 1
+_headerFormat = "<8sIIQ"
+_align = 64
+
+def sceneClasses():
+  """The classes saveScene may store, the objects of GeoObjects and of
+  the modules built on it"""
+  return (go.GeoVertObj, go.Group, go.Vector3, go.Matrix4)
+
+# The modules whose classes a scene file may name. No other module is
+# imported when a file is opened.
+sceneModules = frozenset( ["GeoObjects", "shapes", "volume", "animation",
+                           "pointcloud"])
+
+def className( obj):
+  cls = type(obj)
+  return "{}.{}".format( cls.__module__, cls.__qualname__)
+
+def findClass( name):
+  """The class a scene file names, which must be one of sceneClasses
+  in one of sceneModules"""
+  module, _, qualname = name.rpartition( ".")
+  if module not in sceneModules:
+    raise ValueError( "not a scene class: " + name)
+  cls = getattr( importlib.import_module( module), qualname, None)
+  if not isinstance( cls, type) or not issubclass( cls, sceneClasses()):
+    raise ValueError( "not a scene class: " + name)
+  return cls
+
+class SceneWriter:
+  """Describes objects as JSON, collecting their arrays"""
+
+  def __init__(self):
+    self.objects = []
+    self.objectIds = {}
+    self.arrays = []
+    self.arrayIds = {}
+    self.offset = 0
+
+  def array(self, arr):
+    """The description of an array, placed after the arrays before it.
+    Views of the same memory with the same layout are one array, as
+    the objects hold views of the arrays they were given."""
+    key = (arr.__array_interface__["data"][0], arr.shape, arr.strides,
+           arr.dtype.str)
+    if key not in self.arrayIds:
+      if arr.dtype.hasobject:
+        raise TypeError( "arrays of objects cannot be saved")
+      dtype = arr.dtype.newbyteorder( "<") if arr.dtype.byteorder == ">" \
+              else arr.dtype
+      self.offset += -self.offset % _align
+      self.arrayIds[key] = len(self.arrays)
+      self.arrays.append( (arr, dtype, self.offset))
+      self.offset += arr.size*dtype.itemsize
+    i = self.arrayIds[key]
+    return {"array" : i, "dtype" : self.arrays[i][1].str,
+            "shape" : list(arr.shape)}
+
+  def value(self, value):
+    """The JSON description of an attribute value"""
+    if value is None or isinstance( value, (bool, int, float, str)):
+      return value
+    if isinstance( value, np.generic):
+      return value.item()
+    if isinstance( value, np.ndarray):
+      return self.array( value)
+    if isinstance( value, list):
+      return [self.value( v) for v in value]
+    if isinstance( value, tuple):
+      return {"tuple" : [self.value( v) for v in value]}
+    if isinstance( value, dict):
+      return {"dict" : dict( (str(k), self.value( v))
+                             for k, v in value.items())}
+    if isinstance( value, go.Vector3):
+      return {"vector" : list(value.v)}
+    if isinstance( value, go.Matrix4):
+      return {"matrix" : list(value.m)}
+    if isinstance( value, sceneClasses()):
+      return {"object" : self.object( value)}
+    raise TypeError( "cannot save a {} in a scene".format(
+                       type(value).__name__))
+
+  def object(self, obj):
+    """The index of obj in the objects, describing it the first time"""
+    if id(obj) not in self.objectIds:
+      self.objectIds[id(obj)] = len(self.objects)
+      self.objects.append( None)
+      attrs = dict( (name, self.value( value))
+                    for name, value in vars(obj).items()
+                    if not name.startswith( "_") and
+                       name not in ("version", "styleVersion",
+                                    "colormapId"))
+      self.objects[self.objectIds[id(obj)]] = {
+        "class" : className( obj), "attributes" : attrs}
+    return self.objectIds[id(obj)]
+
+def saveScene( path, *geoObjs):
+  """Write geoObjs, with everything they hold, to the scene file path.
+  Arrays that are memory mapped or larger than memory are written a
+  chunk at a time."""
+  writer = SceneWriter()
+  roots = [writer.object( obj) for obj in geoObjs]
+  meta = json.dumps( {"objects" : writer.objects,
+                      "roots" : roots,
+                      "arrays" : [offset for arr, dtype, offset
+                                  in writer.arrays]}).encode( "utf-8")
+  start = struct.calcsize( _headerFormat) + len(meta)
+  start += -start % _align
+  with open( path, "wb") as f:
+    f.write( struct.pack( _headerFormat, sceneMagic, sceneVersion, 0,
+                          len(meta)))
+    f.write( meta)
+    for arr, dtype, offset in writer.arrays:
+      if arr.size == 0:
+        continue
+      f.write( bytes( start + offset - f.tell()))
+      rows = arr.reshape( len(arr), -1) if arr.ndim else arr.reshape(1)
+      for sl in go.chunks( len(rows)):
+        f.write( np.ascontiguousarray( rows[sl], dtype=dtype).tobytes())
+
+def openScene( path):
+  """The objects saved in the scene file path, with their arrays
+  memory mapped from it"""
+  with open( path, "rb") as f:
+    magic, version, flags, length = struct.unpack(
+      _headerFormat, f.read( struct.calcsize( _headerFormat)))
+    if magic != sceneMagic:
+      raise ValueError( path + " is not a scene file")
+    if version > sceneVersion:
+      raise ValueError( "scene file version {} is newer than {}".format(
+                          version, sceneVersion))
+    meta = json.loads( f.read( length).decode( "utf-8"))
+  start = struct.calcsize( _headerFormat) + length
+  start += -start % _align
+  data = np.memmap( path, dtype=np.uint8, mode="r")
+  objects = [None]*len(meta["objects"])
+
+  def value( desc):
+    if isinstance( desc, list):
+      return [value( v) for v in desc]
+    if not isinstance( desc, dict):
+      return desc
+    if "array" in desc:
+      dtype = np.dtype( desc["dtype"])
+      offset = start + meta["arrays"][desc["array"]]
+      count = int( np.prod( desc["shape"]))
+      return data[offset:offset + count*dtype.itemsize].view(
+               dtype).reshape( desc["shape"])
+    if "tuple" in desc:
+      return tuple( value( v) for v in desc["tuple"])
+    if "dict" in desc:
+      return dict( (k, value( v)) for k, v in desc["dict"].items())
+    if "vector" in desc:
+      return go.Vector3( desc["vector"])
+    if "matrix" in desc:
+      return go.Matrix4( *desc["matrix"])
+    return build( desc["object"])
+
+  def build( i):
+    if objects[i] is None:
+      desc = meta["objects"][i]
+      cls = findClass( desc["class"])
+      # The objects are rebuilt from their attributes, not their
+      # constructors, so nothing is recomputed.
+      obj = objects[i] = cls.__new__( cls)
+      for name, attr in desc["attributes"].items():
+        setattr( obj, name, value( attr))
+      if "colormap" in desc["attributes"]:
+        obj.colormapId = str( uuid())
+    return objects[i]
+
+  return [build( i) for i in meta["roots"]]
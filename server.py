@@ -0,0 +1,289 @@
+import os
+import re
+import threading
+from collections import OrderedDict
+from functools import partial
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler, \
+                        SimpleHTTPRequestHandler
+from uuid import uuid4 as uuid
+
+import GeoObjects as go
+
+# A small HTTP server that runs in a thread of the kernel
+#
+# The notebook page is served from another origin, so every response
+# allows cross origin requests.
+
+class TileRequestHandler(SimpleHTTPRequestHandler):
+  """Serves the files of a directory with CORS and cache headers"""
+
+  protocol_version = "HTTP/1.1"
+  maxAge = 3600
+
+  def end_headers(self):
+    self.send_header( "Access-Control-Allow-Origin", "*")
+    self.send_header( "Cache-Control", "max-age={}".format(self.maxAge))
+    SimpleHTTPRequestHandler.end_headers( self)
+
+  def log_message(self, format, *args):
+    pass
+
+class KernelServer:
+  """An HTTP server on host:port serving with handler from a thread of
+  the kernel. A port of 0 picks a free port."""
+
+  def __init__(self, handler, port=0, host="127.0.0.1"):
+    self.httpd = ThreadingHTTPServer( (host, port), handler)
+    self.httpd.daemon_threads = True
+    self.thread = None
+
+  @property
+  def url(self):
+    host, port = self.httpd.server_address[:2]
+    return "http://{}:{}".format(host, port)
+
+  def start(self):
+    """Start serving in a background thread"""
+    if self.thread is None:
+      self.thread = threading.Thread( target=self.httpd.serve_forever)
+      self.thread.daemon = True
+      self.thread.start()
+    return self
+
+  def stop(self):
+    """Stop serving and release the port"""
+    if self.thread is not None:
+      self.httpd.shutdown()
+      self.thread.join()
+      self.thread = None
+    self.httpd.server_close()
+
+class TileServer(KernelServer):
+  """Serve the tiles in directory on host:port. A port of 0 picks a
+  free port."""
+
+  def __init__(self, directory, port=0, host="127.0.0.1"):
+    self.directory = os.path.abspath( directory)
+    handler = partial( TileRequestHandler, directory=self.directory)
+    KernelServer.__init__( self, handler, port, host)
+
+# Scenes served from memory
+#
+# In place of writing a temp.html next to the notebook, a SceneServer
+# holds each rendered page and the binary buffer of its arrays in
+# memory under a URL of its own, /scenes/<id>/, and serves the three.js
+# files under /js/. Neither ever changes at its URL, so both are sent
+# with a long lived, immutable Cache-Control, and the browser loads
+# three.js once for all the scenes. Every response has a length, so a
+# connection is kept alive across requests, and single byte ranges are
+# answered with 206. Only the maxScenes most recently used scenes are
+# kept, the others are dropped and their URLs answer 404.
+
+_rangePattern = re.compile( r"bytes=(\d*)-(\d*)$")
+
+def byteRange( header, length):
+  """The (start, stop) of the Range header of a request for length
+  bytes, None if the whole should be sent, or False if the range
+  cannot be satisfied"""
+  match = _rangePattern.match( header.strip()) if header else None
+  if match is None or match.group(0) == "bytes=-":
+    return None
+  first, last = match.groups()
+  if not first:
+    start, stop = max( length-int(last), 0), length
+    if int(last) == 0:
+      return False
+  else:
+    start = int(first)
+    stop = min( int(last)+1, length) if last else length
+    if last and int(last) < start:
+      return None
+  if start >= length:
+    return False
+  return (start, stop)
+
+_contentTypes = {
+  ".html" : "text/html; charset=utf-8",
+  ".js" : "application/javascript",
+  ".bin" : "application/octet-stream"
+}
+
+class SceneRequestHandler(BaseHTTPRequestHandler):
+  """Serves the assets and scenes of a SceneServer"""
+
+  protocol_version = "HTTP/1.1"
+  cacheControl = "public, max-age=31536000, immutable"
+
+  def __init__(self, *args, scenes=None, **kwargs):
+    self.scenes = scenes
+    BaseHTTPRequestHandler.__init__( self, *args, **kwargs)
+
+  def do_GET(self):
+    self.sendFile( True)
+
+  def do_HEAD(self):
+    self.sendFile( False)
+
+  def sendFile(self, body):
+    path = self.path.split( "?", 1)[0]
+    found = self.scenes.lookup( path)
+    if found is None:
+      self.sendEmpty( 404)
+      return
+    name, data = found
+    rng = byteRange( self.headers.get( "Range"), len(data))
+    if rng is False:
+      self.sendEmpty( 416, ("Content-Range", "bytes */{}".format(len(data))))
+      return
+    if rng is None:
+      self.send_response( 200)
+      start, stop = 0, len(data)
+    else:
+      self.send_response( 206)
+      start, stop = rng
+      self.send_header( "Content-Range",
+                        "bytes {}-{}/{}".format(start, stop-1, len(data)))
+    ext = os.path.splitext( name)[1]
+    self.send_header( "Content-Type",
+                      _contentTypes.get( ext, "application/octet-stream"))
+    self.send_header( "Content-Length", str(stop-start))
+    self.send_header( "Accept-Ranges", "bytes")
+    self.send_header( "Cache-Control", self.cacheControl)
+    self.end_headers()
+    if body:
+      self.wfile.write( memoryview(data)[start:stop])
+
+  def sendEmpty(self, code, *headers):
+    """An empty response that keeps the connection open"""
+    self.send_response( code)
+    for header in headers:
+      self.send_header( *header)
+    self.send_header( "Content-Length", "0")
+    self.end_headers()
+
+  def end_headers(self):
+    self.send_header( "Access-Control-Allow-Origin", "*")
+    BaseHTTPRequestHandler.end_headers( self)
+
+  def log_message(self, format, *args):
+    pass
+
+_assetDirectory = os.path.join( os.path.dirname( os.path.abspath( __file__)),
+                                "js")
+
+class SceneServer(KernelServer):
+  """Serve the three.js files in assets and the scenes added to it on
+  host:port, keeping at most maxScenes scenes. A port of 0 picks a
+  free port."""
+
+  def __init__(self, maxScenes=32, assets=None, port=0, host="127.0.0.1"):
+    self.maxScenes = maxScenes
+    self.assets = os.path.abspath( assets or _assetDirectory)
+    self.assetCache = {}
+    self.scenes = OrderedDict()
+    self.lock = threading.Lock()
+    handler = partial( SceneRequestHandler, scenes=self)
+    KernelServer.__init__( self, handler, port, host)
+
+  @property
+  def assetUrl(self):
+    return self.url + "/js"
+
+  def sceneUrl(self, sceneId):
+    return "{}/scenes/{}/".format(self.url, sceneId)
+
+  def add(self, files, sceneId=None):
+    """Keep files, a dict from file name to bytes or str, as a scene,
+    dropping the least recently used scenes past maxScenes, and return
+    its id"""
+    sceneId = sceneId or uuid().hex
+    files = dict( (name, data.encode('utf-8') if isinstance( data, str)
+                   else bytes(data)) for name, data in files.items())
+    with self.lock:
+      self.scenes[sceneId] = files
+      self.scenes.move_to_end( sceneId)
+      while len(self.scenes) > self.maxScenes:
+        self.scenes.popitem( last=False)
+    return sceneId
+
+  def remove(self, sceneId):
+    """Drop a scene"""
+    with self.lock:
+      self.scenes.pop( sceneId, None)
+
+  def lookup(self, path):
+    """The file name and bytes served at path, or None"""
+    parts = path.strip( "/").split( "/")
+    if len(parts) == 2 and parts[0] == "js":
+      data = self.asset( parts[1])
+      return None if data is None else (parts[1], data)
+    if len(parts) in (2, 3) and parts[0] == "scenes":
+      name = parts[2] if len(parts) == 3 and parts[2] else "index.html"
+      with self.lock:
+        files = self.scenes.get( parts[1])
+        if files is None:
+          return None
+        self.scenes.move_to_end( parts[1])
+      return (name, files[name]) if name in files else None
+    return None
+
+  def asset(self, name):
+    """The bytes of a file of the asset directory, read once"""
+    with self.lock:
+      if name in self.assetCache:
+        return self.assetCache[name]
+    if name.startswith( ".") or name not in os.listdir( self.assets):
+      return None
+    with open( os.path.join( self.assets, name), "rb") as f:
+      data = f.read()
+    with self.lock:
+      self.assetCache[name] = data
+    return data
+
+_sceneServer = None
+_sceneServerLock = threading.Lock()
+
+def sceneServer():
+  """The SceneServer of the kernel, started on first use"""
+  global _sceneServer
+  with _sceneServerLock:
+    if _sceneServer is None:
+      _sceneServer = SceneServer().start()
+    return _sceneServer
+
+iframeHtml = """\
+<iframe src="{URL}" width="{WIDTH}" height="{HEIGHT}" frameborder="0"></iframe>
+"""
+
+_svDefaultDict = {
+  "server" : None,
+  "width" : 620,
+  "height" : 420
+}
+
+def renderServed( *geoObjs, **kwargs):
+  """Like render, but the page and the binary buffer of its arrays are
+  kept in memory by a SceneServer, the kernel's own if server is None,
+  and the result is an iframe of width by height that loads them.
+
+  The other keywords are those of render."""
+  opts = {}
+  for attr in _svDefaultDict:
+    opts[attr] = kwargs.pop( attr, _svDefaultDict[attr])
+  server = opts["server"] or sceneServer()
+  renderD = go.sceneParameters( geoObjs, kwargs)
+  renderD["assets"] = server.assetUrl
+  geometry = "".join( [go.renderObject( geoObj) for geoObj in geoObjs])
+  level = go.compressLevel( renderD)
+  geometry, data, layout = go.packArrays( geometry, level)
+  sceneId = uuid().hex
+  load = go.fetchScene.format( URL = server.sceneUrl( sceneId) + "arrays.bin",
+                               LAYOUT = layout,
+                               COMPRESSED = "true" if level is not None
+                                            else "false")
+  page = go.htmlWrapper.format(
+           SCRIPT = go.sceneScript( renderD, geometry, load))
+  server.add( {"index.html" : page, "arrays.bin" : data}, sceneId)
+  return iframeHtml.format( URL = server.sceneUrl( sceneId),
+                            WIDTH = opts["width"],
+                            HEIGHT = opts["height"])
@@ -0,0 +1,227 @@
+import math
+
+import numpy as np
+
+import GeoObjects as go
+
+# Shapes built on GeoSet
+#
+# Each shape is a GeoSet whose outline and faces draw from the same
+# vertices. They live here rather than in GeoObjects, whose Box is the
+# instanced one.
+
+def polygonNormal( verts):
+  """The unit normal of a planar polygon by Newell's method"""
+  v = np.asarray( verts, dtype=np.float64)
+  w = np.roll( v, -1, axis=0)
+  n = np.array( [((v[:,1]-w[:,1])*(v[:,2]+w[:,2])).sum(),
+                 ((v[:,2]-w[:,2])*(v[:,0]+w[:,0])).sum(),
+                 ((v[:,0]-w[:,0])*(v[:,1]+w[:,1])).sum()])
+  length = np.linalg.norm( n)
+  return n/length if length > 0. else np.array( [0., 0., 1.])
+
+def triangulate( verts):
+  """The (N-2,3) triangles of a simple polygon, by ear clipping in the
+  plane of the polygon"""
+  n = len(verts)
+  normal = polygonNormal( verts)
+  # Project onto the plane, with the polygon counter clockwise.
+  u = np.cross( normal, [1., 0., 0.] if abs(normal[0]) < 0.9
+                        else [0., 1., 0.])
+  u /= np.linalg.norm( u)
+  p = np.asarray( verts, dtype=np.float64)
+  xy = np.stack( (p.dot(u), p.dot( np.cross( normal, u))), axis=1)
+  def cross( a, b, c):
+    return (b[0]-a[0])*(c[1]-a[1]) - (b[1]-a[1])*(c[0]-a[0])
+  remaining = list( range(n))
+  faces = []
+  while len(remaining) > 3:
+    m = len(remaining)
+    for k in range(m):
+      i, j, l = remaining[k-1], remaining[k], remaining[(k+1) % m]
+      a, b, c = xy[i], xy[j], xy[l]
+      if cross( a, b, c) <= 0.:
+        continue
+      # An ear holds none of the other vertices.
+      others = xy[[r for r in remaining if r not in (i, j, l)]]
+      inside = ((b[0]-a[0])*(others[:,1]-a[1]) -
+                (b[1]-a[1])*(others[:,0]-a[0]) >= 0.) & \
+               ((c[0]-b[0])*(others[:,1]-b[1]) -
+                (c[1]-b[1])*(others[:,0]-b[0]) >= 0.) & \
+               ((a[0]-c[0])*(others[:,1]-c[1]) -
+                (a[1]-c[1])*(others[:,0]-c[0]) >= 0.)
+      if not inside.any():
+        faces.append( (i, j, l))
+        del remaining[k]
+        break
+    else:
+      # Degenerate, fan out what is left.
+      faces.extend( (remaining[0], remaining[t], remaining[t+1])
+                    for t in range(1, m-1))
+      remaining = []
+  if len(remaining) == 3:
+    faces.append( tuple(remaining))
+  return np.array( faces, dtype=np.uint32).reshape(-1,3)
+
+class Polygon(go.GeoSet):
+  """A planar polygon through the (N,3) vertices, in order, with a
+  line around the perimeter and triangles in the center"""
+
+  def __init__(self, vertices, **kwargs):
+    verts = go.vertexArray( vertices)
+    n = len(verts)
+    edges = np.stack( (np.arange(n), np.roll( np.arange(n), -1)), axis=1)
+    if "normals" not in kwargs:
+      kwargs["normals"] = np.tile( polygonNormal( verts).astype(np.float32),
+                                   (n,1))
+    go.GeoSet.__init__( self, verts, edges=edges,
+                        faces=triangulate( verts), **kwargs)
+
+class Rectangle(Polygon):
+  """The rectangle with a corner at origin and sides along u and v"""
+
+  def __init__(self, origin, u, v, **kwargs):
+    o, u, v = [np.asarray( go.vec3( x).v, dtype=np.float64)
+               for x in (origin, u, v)]
+    Polygon.__init__( self, [o, o+u, o+u+v, o+v], **kwargs)
+
+def boxCorners( vmin, vmax):
+  """The 8 corners of a box, corner c at x, y and z of vmax where bits
+  0, 1 and 2 of c are set"""
+  c = np.arange(8)
+  return np.where( np.stack( (c & 1, c & 2, c & 4), axis=1) > 0,
+                   np.asarray( vmax, dtype=np.float64),
+                   np.asarray( vmin, dtype=np.float64))
+
+# The corners of the faces of a box, counter clockwise seen from
+# outside, and their axis and side.
+_boxFaces = [((0, 4, 6, 2), 0, 0), ((1, 3, 7, 5), 0, 1),
+             ((0, 1, 5, 4), 1, 0), ((2, 6, 7, 3), 1, 1),
+             ((0, 2, 3, 1), 2, 0), ((4, 5, 7, 6), 2, 1)]
+
+_boxEdges = [(0,1), (2,3), (4,5), (6,7), (0,2), (1,3), (4,6), (5,7),
+             (0,4), (1,5), (2,6), (3,7)]
+
+class Box(go.GeoSet):
+  """An axis aligned box from vmin to vmax, with lines at the edges and
+  triangles filling in the faces. Each face has vertices of its own so
+  that it is shaded flat."""
+
+  def __init__(self, vmin, vmax, **kwargs):
+    corners = boxCorners( go.vec3( vmin).v, go.vec3( vmax).v)
+    verts = []
+    normals = []
+    faces = []
+    vertexOf = {}
+    for k, (quad, axis, side) in enumerate(_boxFaces):
+      n = np.zeros(3)
+      n[axis] = 1. if side else -1.
+      for c in quad:
+        vertexOf.setdefault( c, len(verts))
+        verts.append( corners[c])
+        normals.append( n)
+      faces.extend( [(4*k, 4*k+1, 4*k+2), (4*k, 4*k+2, 4*k+3)])
+    # The edges draw from the vertices of the first face at each corner.
+    edges = [(vertexOf[a], vertexOf[b]) for a, b in _boxEdges]
+    if "normals" not in kwargs:
+      kwargs["normals"] = np.array( normals, dtype=np.float32)
+    go.GeoSet.__init__( self, verts, edges=edges, faces=faces, **kwargs)
+
+def niceTicks( lo, hi, count=5):
+  """About count round numbers from lo to hi, steps of 1, 2 or 5 times
+  a power of ten"""
+  span = hi - lo
+  if not span > 0.:
+    return np.array( [lo])
+  raw = span/max( count, 1)
+  power = 10.**math.floor( math.log10( raw))
+  step = min( (s*power for s in (1., 2., 5., 10.) if s*power >= raw),
+              key=lambda s: s)
+  first = math.ceil( lo/step - 1e-9)*step
+  return np.arange( first, hi + 1e-9*step, step)
+
+def hexColor( color):
+  """The rgb bytes of a color given as 0xrrggbb, a string or a number"""
+  value = int( color, 16) if isinstance( color, str) else int( color)
+  return [(value >> 16) & 255, (value >> 8) & 255, value & 255]
+
+_f3DefaultDict = {
+  "ticks" : 5,
+  "tickLength" : 0.02,
+  "labels" : True,
+  "grid" : True,
+  "cameraVector" : None,
+  "lineColor" : '0x444444',
+  "gridColor" : '0xbbbbbb',
+  "lineWidth" : 1.
+}
+
+class Frame3D(go.GeoSet):
+  """The outline of the box from vmin to vmax with tickmarks along the
+  three edges from vmin, and a wire grid through the ticks on the rear
+  faces, those facing away from cameraVector, the default camera of
+  render if it is None.
+
+  ticks is the number of ticks an axis is aimed to have, tickLength
+  their length as a fraction of the largest side of the box, and
+  labels adds Text of their values at the ends of the ticks."""
+
+  def __init__(self, vmin, vmax, **kwargs):
+    for attr in _f3DefaultDict:
+      setattr( self, attr, kwargs.pop( attr, _f3DefaultDict[attr]))
+    lo = np.array( go.vec3( vmin).v, dtype=np.float64)
+    hi = np.array( go.vec3( vmax).v, dtype=np.float64)
+    view = self.cameraVector
+    if view is None:
+      th = go._rDefaultDict["cameraTheta"]
+      phi = go._rDefaultDict["cameraPhi"]
+      view = (math.sin(th)*math.cos(phi), math.sin(th)*math.sin(phi),
+              math.cos(th))
+    view = np.asarray( go.vec3( view).v, dtype=np.float64)
+    size = (hi-lo).max()*self.tickLength
+    verts = list( boxCorners( lo, hi))
+    edges = list( _boxEdges)
+    ticks = [niceTicks( lo[a], hi[a], self.ticks) for a in range(3)]
+    self.texts = []
+    for axis in range(3):
+      # Ticks point away from the box, along the next axis.
+      out = np.zeros(3)
+      out[(axis+1) % 3] = -size
+      for t in ticks[axis]:
+        p = lo.copy()
+        p[axis] = t
+        edges.append( (len(verts), len(verts)+1))
+        verts.extend( [p, p+out])
+        if self.labels:
+          self.texts.append( go.Text( "{:g}".format(t), *(p+2.*out)))
+    gridEdges = []
+    outline = len(verts)
+    if self.grid:
+      for quad, axis, side in _boxFaces:
+        normal = np.zeros(3)
+        normal[axis] = 1. if side else -1.
+        if normal.dot( view) >= 0.:
+          continue
+        plane = hi[axis] if side else lo[axis]
+        for a in range(3):
+          if a == axis:
+            continue
+          b = 3 - a - axis
+          for t in ticks[a]:
+            p, q = lo.copy(), lo.copy()
+            p[axis] = q[axis] = plane
+            p[a] = q[a] = t
+            q[b] = hi[b]
+            gridEdges.append( (len(verts), len(verts)+1))
+            verts.extend( [p, q])
+    # The grid is drawn in its own color through the vertex colors.
+    colors = np.empty( (len(verts), 3), dtype=np.uint8)
+    colors[:outline] = hexColor( self.lineColor)
+    colors[outline:] = hexColor( self.gridColor)
+    go.GeoSet.__init__( self, verts, edges=edges+gridEdges, colors=colors,
+                        lineColor=self.lineColor, lineWidth=self.lineWidth,
+                        **kwargs)
+
+  def render(self, shared=True):
+    return (go.GeoSet.render( self, shared) +
+            "".join( [go.renderObject( t) for t in self.texts]))
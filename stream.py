@@ -0,0 +1,276 @@
+import threading
+from uuid import uuid4 as uuid
+
+import numpy as np
+from IPython import get_ipython
+
+import GeoObjects as go
+
+# Progressive rendering over the Jupyter comm channel
+#
+# renderProgressive returns a page with the canvas, camera and the
+# bounding box of every object. When the page runs it opens a comm to
+# the kernel, and the kernel sends the geometry in chunks of at most
+# chunkBytes, each a self contained BufferGeometry that is added to the
+# scene as soon as it arrives. The page acknowledges every chunk, and
+# the kernel never has more than maxInFlight chunks unacknowledged, so
+# neither side holds much more than that. Objects that are not chunked
+# are sent as their script, which the page runs as it runs those of
+# render.
+
+def meshChunks( ts, chunkBytes):
+  """Split a TriangleSet into self contained chunks of faces"""
+  flat = not ts.smooth
+  normals = None
+  colors = go.vertexColors( ts)
+  if not flat:
+    normals = ts.smoothNormals()
+  # A face brings at most three vertices with a position, a normal and
+  # a color, and three indices.
+  perFace = 3*(12 + 12 + 3 + 4)
+  for sl in go.chunks( len(ts.faces), max( 1, chunkBytes//perFace)):
+    faces = ts.faces[sl]
+    if flat:
+      used = faces.reshape(-1)
+      arrays = [("positions", ts.vertices[used], "<f4")]
+    else:
+      used, local = np.unique( faces, return_inverse=True)
+      arrays = [("positions", ts.vertices[used], "<f4"),
+                ("normals", normals[used], "<f4"),
+                ("indices", local.reshape(-1), "<u4")]
+    if colors is not None:
+      arrays.append( ("colors", colors[used], "|u1"))
+    yield arrays
+
+def instanceChunks( inst, chunkBytes):
+  """Split an Instances object into chunks of instances"""
+  perInstance = 12 + 12 + 16 + 3
+  for sl in go.chunks( len(inst.positions),
+                       max( 1, chunkBytes//perInstance)):
+    arrays = [("positions", inst.positions[sl], "<f4"),
+              ("scales", inst.scales[sl], "<f4")]
+    if inst.orientations is not None:
+      arrays.append( ("orientations", inst.orientations[sl], "<f4"))
+    if inst.colors is not None:
+      arrays.append( ("colors", inst.colors[sl], "|u1"))
+    yield arrays
+
+def chunked( geoObj):
+  """Whether geoObj is sent in chunks rather than as its script. The
+  depth order of transparent faces and the page's colormap of live
+  colors cover the whole object, so those TriangleSets are scripts."""
+  if isinstance( geoObj, go.TriangleSet):
+    return geoObj.opacity >= 1. and not (geoObj.liveColors and
+                                         geoObj.scalars is not None)
+  return isinstance( geoObj, go.Instances)
+
+def chunkCount( geoObj, chunkBytes):
+  """The number of chunks geoObj is sent in"""
+  if not chunked( geoObj):
+    return 1
+  if isinstance( geoObj, go.TriangleSet):
+    n, per = len(geoObj.faces), max( 1, chunkBytes//(3*(12+12+3+4)))
+  else:
+    n, per = len(geoObj.positions), max( 1, chunkBytes//(12+12+16+3))
+  return -(-n//per)
+
+def objectMessages( i, geoObj, chunkBytes):
+  """The comm messages, as (data, arrays) pairs, that send geoObj"""
+  if not chunked( geoObj):
+    yield ({"type" : "object", "id" : i, "kind" : "script",
+            "code" : go.renderObject( geoObj)}, [])
+    return
+  if isinstance( geoObj, go.TriangleSet):
+    hasColors = geoObj.colors is not None or geoObj.scalars is not None
+    header = {"type" : "object", "id" : i, "kind" : "mesh",
+              "material" : go.renderMaterial( geoObj, hasColors)}
+    yield (header, [])
+    parts = meshChunks( geoObj, chunkBytes)
+  else:
+    verts, normals, faces = geoObj.template( geoObj.lod)
+    header = {"type" : "object", "id" : i, "kind" : "instances",
+              "material" : go.renderMaterial( geoObj,
+                                              geoObj.colors is not None)}
+    yield (header, [("positions", verts, "<f4"),
+                    ("normals", normals, "<f4"),
+                    ("indices", faces, "<u4")])
+    parts = instanceChunks( geoObj, chunkBytes)
+  for arrays in parts:
+    yield ({"type" : "chunk", "id" : i}, arrays)
+
+class ProgressiveStream:
+  """The kernel side of a progressive render: sends the messages of
+  all the objects over the comm the page opens, keeping at most
+  maxInFlight chunks unacknowledged."""
+
+  def __init__(self, geoObjs, chunkBytes, maxInFlight):
+    self.geoObjs = geoObjs
+    self.chunkBytes = chunkBytes
+    self.window = threading.Semaphore( maxInFlight)
+    self.target = "pyplot3d-" + str(uuid())
+
+  def open(self, comm, msg):
+    """Comm target, called when the page opens its comm"""
+    self.comm = comm
+    comm.on_msg( self.ack)
+    # Acknowledgements arrive on the kernel's own thread, so the
+    # sending has to happen on another one.
+    thread = threading.Thread( target=self.send)
+    thread.daemon = True
+    thread.start()
+
+  def ack(self, msg):
+    self.window.release()
+
+  def send(self):
+    try:
+      for i, geoObj in enumerate(self.geoObjs):
+        for data, arrays in objectMessages( i, geoObj, self.chunkBytes):
+          if data["type"] == "chunk":
+            self.window.acquire()
+          data["layout"] = [[name, go.jsArrayType( dtype)]
+                            for name, arr, dtype in arrays]
+          buffers = [memoryview( np.ascontiguousarray( arr, dtype=dtype))
+                     for name, arr, dtype in arrays]
+          self.comm.send( data, buffers=buffers)
+      self.comm.send( {"type" : "done"})
+    finally:
+      get_ipython().kernel.comm_manager.unregister_target(
+          self.target, self.open)
+
+sBox = """\
+  (function() {{
+    var geometry = new THREE.Geometry();
+    var a = [{MIN}], b = [{MAX}];
+    var corners = [];
+    for (var c = 0; c < 8; c++) {{
+      corners.push( new THREE.Vector3( (c&1) ? b[0] : a[0],
+                                       (c&2) ? b[1] : a[1],
+                                       (c&4) ? b[2] : a[2]));
+    }}
+    [[0,1],[2,3],[4,5],[6,7],[0,2],[1,3],[4,6],[5,7],
+     [0,4],[1,5],[2,6],[3,7]].forEach( function( e) {{
+      geometry.vertices.push( corners[e[0]], corners[e[1]]);
+    }});
+    boxes[{ID}] = new THREE.Line( geometry,
+      new THREE.LineBasicMaterial( {{ color : 0x888888 }}), THREE.LinePieces);
+    scene.add( boxes[{ID}]);
+  }})();
+"""
+
+sClient = """\
+  var boxes = {{}};
+{BOXES}
+  var progress = document.createElement( 'div');
+  canvas.parentNode.insertBefore( progress, canvas.nextSibling);
+  var total = {TOTAL};
+  var received = 0;
+  var objects = {{}};
+  progress.textContent = 'Loading 0%';
+
+  function typedArray( view, type) {{
+    var start = view.byteOffset;
+    return new window[type]( view.buffer.slice( start, start+view.byteLength));
+  }}
+
+  function streamMessage( data, buffers) {{
+    var arrays = {{}};
+    (data.layout || []).forEach( function( entry, i) {{
+      arrays[entry[0]] = typedArray( buffers[i], entry[1]);
+    }});
+    if (data.type === 'object') {{
+      var obj = {{ kind : data.kind, template : arrays }};
+      if (data.kind === 'script') {{
+        evalObject( data.code);
+        scene.remove( boxes[data.id]);
+        received++;
+      }} else {{
+        obj.material = new Function( data.material + '\\nreturn material;')();
+      }}
+      objects[data.id] = obj;
+    }} else if (data.type === 'chunk') {{
+      var obj = objects[data.id];
+      var geometry;
+      if (obj.kind === 'instances') {{
+        geometry = instanceGeometry( obj.template.positions,
+          obj.template.normals, obj.template.indices, arrays.positions,
+          arrays.scales, arrays.orientations || null, arrays.colors || null);
+      }} else {{
+        geometry = new THREE.BufferGeometry();
+        geometry.addAttribute( 'position',
+          new THREE.BufferAttribute( arrays.positions, 3));
+        if (arrays.indices) {{
+          geometry.addAttribute( 'index',
+            new THREE.BufferAttribute( arrays.indices, 1));
+        }}
+        if (arrays.normals) {{
+          geometry.addAttribute( 'normal',
+            new THREE.BufferAttribute( arrays.normals, 3));
+        }} else {{
+          geometry.computeVertexNormals();
+        }}
+        if (arrays.colors) {{
+          geometry.addAttribute( 'color',
+            new THREE.BufferAttribute( unitColors( arrays.colors), 3));
+        }}
+      }}
+      scene.add( new THREE.Mesh( geometry, obj.material));
+      scene.remove( boxes[data.id]);
+      received++;
+    }} else if (data.type === 'done') {{
+      received = total;
+      progress.parentNode.removeChild( progress);
+    }}
+    progress.textContent = 'Loading ' +
+      Math.min( 100, Math.round( 100*received/total)) + '%';
+    requestRender();
+  }}
+
+  var nb = window.Jupyter || window.IPython ||
+           (window.parent && (window.parent.Jupyter || window.parent.IPython));
+  var comm = nb.notebook.kernel.comm_manager.new_comm( "{TARGET}", {{}});
+  comm.on_msg( function( msg) {{
+    streamMessage( msg.content.data, msg.buffers || []);
+    if (msg.content.data.type === 'chunk') {{
+      comm.send( {{ ack : 1}});
+    }}
+  }});
+"""
+
+_pDefaultDict = {
+  "chunkBytes" : 1 << 22,
+  "maxInFlight" : 4
+}
+
+def renderProgressive( *geoObjs, **kwargs):
+  """Like render, but the page starts with the bounding boxes and the
+  geometry follows over the comm channel of the running kernel.
+
+  chunkBytes bounds the size of a chunk and maxInFlight the number of
+  chunks sent ahead of the page's acknowledgements. The other keywords
+  are those of render. Opaque TriangleSets and Instances come in
+  chunks, everything else, transparent faces and live colors
+  included, as a whole."""
+  opts = {}
+  for attr in _pDefaultDict:
+    opts[attr] = kwargs.pop( attr, _pDefaultDict[attr])
+  renderD = go.sceneParameters( geoObjs, kwargs)
+  stream = ProgressiveStream( geoObjs, opts["chunkBytes"],
+                              opts["maxInFlight"])
+  get_ipython().kernel.comm_manager.register_target( stream.target,
+                                                     stream.open)
+  return go.renderScript( renderD, clientScript( geoObjs, stream.target,
+                                                 opts["chunkBytes"]))
+
+def clientScript( geoObjs, target, chunkBytes):
+  """The page side of a progressive render of geoObjs, receiving over
+  the comm target"""
+  boxes = ""
+  for i, geoObj in enumerate(geoObjs):
+    vmin, vmax = geoObj.boundingBox()
+    boxes = boxes + sBox.format( ID = i, MIN = vmin, MAX = vmax)
+  total = sum( [chunkCount( x, chunkBytes) for x in geoObjs])
+  return sClient.format(
+           BOXES = boxes,
+           TOTAL = max( total, 1),
+           TARGET = target)
@@ -0,0 +1,25 @@
+import numpy as np
+
+import GeoObjects as go
+import shapes
+
+def test_render_reuses_encoded_parts_only():
+  rng = np.random.default_rng(0)
+  mesh = go.TriangleSet( rng.random( (50,3)), rng.integers( 0, 50, (40,3)))
+  script = go.renderObject( mesh)
+  assert "render" not in mesh._cache
+  encoded = {name : value for name, value in mesh._cache.items()
+             if name.startswith( "encoded")}
+  assert encoded
+  assert go.renderObject( mesh) == script
+  for name, value in encoded.items():
+    assert mesh._cache[name][1] is value[1]
+  mesh.clearCache()
+  assert "_cache" not in mesh.__dict__
+  assert go.renderObject( mesh) == script
+
+def test_frame_labels_restyled():
+  frame = shapes.Frame3D( (0., 0., 0.), (1., 1., 1.))
+  go.renderObject( frame)
+  frame.texts[0].textColor = 'rgb(255,0,0)'
+  assert "rgb(255,0,0)" in go.renderObject( frame)
@@ -0,0 +1,39 @@
+import io
+import json
+import struct
+
+import numpy as np
+
+import GeoObjects as go
+import gltf
+
+def glbJSON( *geoObjs):
+  """The JSON chunk of the GLB of geoObjs"""
+  f = io.BytesIO()
+  gltf.exportGLB( f, *geoObjs)
+  length, = struct.unpack_from( "<I", f.getvalue(), 12)
+  return json.loads( f.getvalue()[20:20+length])
+
+def emptyLists( value):
+  """Whether the JSON value holds an empty list anywhere"""
+  if isinstance( value, list):
+    return not value or any( emptyLists( v) for v in value)
+  if isinstance( value, dict):
+    return any( emptyLists( v) for v in value.values())
+  return False
+
+def test_nothing_to_draw():
+  for geoObjs in [(go.Text( "label", 0., 0., 0.),), (go.Group(),),
+                  (go.Point( np.zeros( (0,3))),),
+                  (go.Group( go.Point( np.zeros( (0,3)))),)]:
+    meta = glbJSON( *geoObjs)
+    assert not emptyLists( meta)
+    assert "meshes" not in meta
+
+def test_empty_objects_skipped():
+  rng = np.random.default_rng(0)
+  meta = glbJSON( go.Point( np.zeros( (0,3))),
+                  go.Group( go.Line( rng.random( (5,3)))))
+  assert not emptyLists( meta)
+  assert len(meta["meshes"]) == 1
+  assert all( a["count"] > 0 for a in meta["accessors"])
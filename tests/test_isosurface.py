@@ -0,0 +1,30 @@
+import numpy as np
+
+import isosurface as iso
+
+def edgeCounts( faces):
+  edges = np.sort( np.concatenate( (faces[:,[0,1]], faces[:,[1,2]],
+                                    faces[:,[2,0]])), axis=1)
+  return np.unique( edges, axis=0, return_counts=True)
+
+def test_sphere_is_closed_manifold():
+  x = np.linspace( -1., 1., 24)
+  X, Y, Z = np.meshgrid( x, x, x, indexing="ij")
+  vertices, faces = iso.marchingCubes( X*X + Y*Y + Z*Z, 0.6, slabSize=5)
+  edges, counts = edgeCounts( faces)
+  assert len(faces)
+  assert (counts == 2).all()
+
+def test_random_field_is_manifold():
+  n = 20
+  for seed in range(5):
+    volume = np.random.default_rng( seed).random( (n, n, n))
+    vertices, faces = iso.marchingCubes( volume, 0.5, slabSize=4)
+    s = np.sort( faces, axis=1)
+    assert len(np.unique( s, axis=0)) == len(s)
+    edges, counts = edgeCounts( faces)
+    # Edges along the sides of the volume bound the surface.
+    p = vertices[edges]
+    side = ((p <= 0.) | (p >= n-1)).any( axis=2).all( axis=1)
+    assert (counts[~side] == 2).all()
+    assert (counts[side] <= 2).all()
@@ -0,0 +1,107 @@
+import json
+import os
+import re
+import subprocess
+
+import numpy as np
+import pytest
+
+import GeoObjects as go
+from test_stream import node, pageStubs, root
+
+# The document holds the canvases until removed is called, and the
+# page's MutationObserver is told of it as a browser would.
+documentStubs = """
+var gone = [], observers = [];
+global.MutationObserver = function( f) {
+  this.observe = function() { observers.push( f); };
+};
+document.body = { contains : function( e) {
+  return gone.indexOf( e) < 0; } };
+function removed( canvas) {
+  gone.push( canvas);
+  observers.forEach( function( f) { f( []); });
+}
+"""
+
+def pageScript( *pages):
+  """The scripts of the html pages, run one after another"""
+  scripts = [s for page in pages
+             for s in re.findall( r"<script>(.*?)</script>", page, re.S)]
+  return (pageStubs % json.dumps( os.path.join( root, "js", "three.min.js"))
+          + documentStubs + "\n".join( scripts))
+
+@pytest.mark.skipif( node is None, reason="needs node")
+def test_released_with_plot( tmp_path):
+  rng = np.random.default_rng(0)
+  v = rng.random( (40,3)).astype(np.float32)
+  f = rng.integers( 0, 40, (30,3))
+  shared = go.TriangleSet( v, f)
+  own = go.TriangleSet( v+1., f, scalars=v[:,0], liveColors=True)
+  script = tmp_path/"page.js"
+  script.write_text( pageScript( go.render( shared, own),
+                                 go.render( shared, own),
+                                 go.render( shared)) + """
+    var counts = [];
+    function count() {
+      var map = pyplot3d.colorMaps[%s];
+      counts.push( [Object.keys( pyplot3d.geometries).length,
+                    map ? map.targets.length : 0,
+                    map ? map.redraws.length : 0]);
+    }
+    count();
+    var first = pyplot3d.plots[0];
+    removed( first.canvas);
+    count();
+    removed( pyplot3d.plots[0].canvas);
+    count();
+    removed( pyplot3d.plots[0].canvas);
+    count();
+    pyplot3d.restore( first, new THREE.Scene());
+    count();
+    console.log( JSON.stringify( counts));
+  """ % json.dumps( own.colormapId))
+  result = subprocess.run( [node, str(script)], capture_output=True,
+                           text=True)
+  assert result.returncode == 0, result.stderr[-2000:]
+  counts = json.loads( result.stdout.strip().splitlines()[-1])
+  assert counts == [[2, 1, 2], [2, 1, 1], [1, 0, 0], [0, 0, 0],
+                    [2, 1, 1]]
+
+@pytest.mark.skipif( node is None, reason="needs node")
+def test_depth_sorted_geometry_not_shared( tmp_path):
+  rng = np.random.default_rng(0)
+  v = rng.random( (40,3)).astype(np.float32)
+  f = rng.integers( 0, 40, (30,3))
+  points = go.Point( v, depthSort=True)
+  glass = go.TriangleSet( v, f, opacity=0.5)
+  group = go.Group( points, glass)
+  script = tmp_path/"page.js"
+  script.write_text( pageScript( go.render( points, glass),
+                                 go.render( group, group)) + """
+    var sorted = [];
+    scene.traverse( function( object) {
+      if (object.depthOrder) {
+        sorted.push( object);
+      }
+    });
+    var eye = new THREE.Vector3( 10., 0., 0.);
+    scene.updateMatrixWorld();
+    sorted.forEach( function( object) { pyplot3d.depthOrder( object, eye); });
+    var first = sorted[0].geometry.attributes.position.array.slice();
+    pyplot3d.depthOrder( sorted[2], new THREE.Vector3( -10., 0., 0.));
+    console.log( JSON.stringify( {
+      geometries : Object.keys( pyplot3d.geometries).length,
+      sorted : sorted.length,
+      distinct : new Set( sorted.map( function( o) {
+        return o.geometry; })).size,
+      untouched : first.every( function( x, i) {
+        return x === sorted[0].geometry.attributes.position.array[i]; })
+    }));
+  """)
+  result = subprocess.run( [node, str(script)], capture_output=True,
+                           text=True)
+  assert result.returncode == 0, result.stderr[-2000:]
+  out = json.loads( result.stdout.strip().splitlines()[-1])
+  assert out == {"geometries" : 6, "sorted" : 4, "distinct" : 4,
+                 "untouched" : True}
@@ -0,0 +1,24 @@
+import sys
+
+import numpy as np
+import pytest
+
+import GeoObjects as go
+import scenefile
+
+def test_round_trip( tmp_path):
+  rng = np.random.default_rng(0)
+  mesh = go.TriangleSet( rng.random( (20,3)), rng.integers( 0, 20, (10,3)))
+  path = str( tmp_path/"scene.p3d")
+  scenefile.saveScene( path, mesh)
+  opened, = scenefile.openScene( path)
+  assert type(opened) is go.TriangleSet
+  assert np.array_equal( opened.vertices, mesh.vertices)
+
+def test_other_modules_not_imported():
+  assert "antigravity" not in sys.modules
+  with pytest.raises( ValueError):
+    scenefile.findClass( "antigravity.Sky")
+  assert "antigravity" not in sys.modules
+  with pytest.raises( ValueError):
+    scenefile.findClass( "GeoObjects.np")
@@ -0,0 +1,23 @@
+import numpy as np
+import pytest
+
+import GeoObjects as go
+
+@pytest.mark.parametrize( "offset, count", [(3.0, 5), (3.5, 9)])
+def test_grid_slice_has_no_duplicates( offset, count):
+  x, y = np.arange( 7.), np.arange( 5.)
+  surface = go.Surface( x, y, lambda X, Y: 0.1*X + 0.05*Y*Y)
+  lines = surface.slice( (1., 0., 0.), [offset])
+  assert len(lines) == 1
+  vertices = lines[0].vertices
+  assert len(vertices) == count
+  assert len(np.unique( vertices, axis=0)) == count
+  assert np.allclose( vertices[:,0], offset)
+
+def test_slice_through_corners():
+  # A square of two triangles cut through the corners on its diagonal.
+  square = go.TriangleSet( [(0,0,0), (1,0,0), (1,1,0), (0,1,0)],
+                           [(0,1,2), (0,2,3)])
+  lines = square.slice( (1., -1., 0.), [0.])
+  assert len(lines) == 1
+  assert len(lines[0].vertices) == 2
@@ -0,0 +1,135 @@
+import base64
+import json
+import os
+import re
+import shutil
+import subprocess
+
+import numpy as np
+import pytest
+
+pytest.importorskip( "IPython")
+
+import GeoObjects as go
+import animation
+import pointcloud
+import stream
+import volume
+
+node = shutil.which( "node")
+root = os.path.dirname( os.path.dirname( os.path.abspath( __file__)))
+
+# A page with just enough of the DOM, WebGL and the notebook's comms to
+# build the scene. The messages are fed through the comm as the kernel
+# would send them.
+pageStubs = """
+global.window = global; global.self = global;
+global.addEventListener = function() {};
+var THREE = require( %s);
+global.THREE = THREE;
+THREE.WebGLRenderer = function() {
+  return new Proxy( { context : {} }, { get : function( t, k) {
+    return k in t ? t[k] : function() {}; } });
+};
+var Scene = THREE.Scene, scene = null;
+THREE.Scene = function() {
+  Scene.call( this);
+  scene = this;
+};
+THREE.Scene.prototype = Scene.prototype;
+THREE.OrbitControls = function() {
+  this.target = new THREE.Vector3();
+  this.addEventListener = function() {};
+};
+function element() {
+  return new Proxy( { style : {}, width : 600, height : 400 },
+    { get : function( t, k) {
+        if (k in t) { return t[k]; }
+        if (k === 'parentNode') { return element(); }
+        if (k === 'getContext') {
+          return function() { return element(); };
+        }
+        return function() { return { width : 10 }; };
+      } });
+}
+global.document = { createElement : element, getElementById : element };
+global.requestAnimationFrame = function() {};
+global.XMLHttpRequest = function() {
+  this.open = this.send = function() {};
+};
+global.atob = function( s) {
+  return Buffer.from( s, 'base64').toString( 'binary');
+};
+var onMessage = null;
+global.Jupyter = { notebook : { kernel : { comm_manager : {
+  new_comm : function() {
+    return { on_msg : function( f) { onMessage = f; },
+             send : function() {} };
+  } } } } };
+"""
+
+pageDriver = """
+var messages = %s;
+messages.forEach( function( m) {
+  onMessage( { content : { data : m.data },
+               buffers : m.buffers.map( function( b) {
+                 return new Uint8Array( Buffer.from( b, 'base64')); }) });
+});
+"""
+
+def streamPage( geoObjs, chunkBytes):
+  """The script of the page of a progressive render of geoObjs, with
+  the messages that send them"""
+  renderD = go.sceneParameters( geoObjs, {})
+  page = go.renderScript( renderD, stream.clientScript(
+           geoObjs, "target", chunkBytes))
+  script = re.findall( r"<script>(.*?)</script>", page, re.S)[0]
+  messages = []
+  for i, geoObj in enumerate(geoObjs):
+    for data, arrays in stream.objectMessages( i, geoObj, chunkBytes):
+      data["layout"] = [[name, go.jsArrayType( dtype)]
+                        for name, arr, dtype in arrays]
+      buffers = [base64.b64encode( np.ascontiguousarray(
+                   arr, dtype=dtype).tobytes()).decode()
+                 for name, arr, dtype in arrays]
+      messages.append( {"data" : data, "buffers" : buffers})
+  messages.append( {"data" : {"type" : "done"}, "buffers" : []})
+  return (pageStubs % json.dumps( os.path.join( root, "js", "three.min.js"))
+          + script + pageDriver % json.dumps( messages))
+
+@pytest.mark.skipif( node is None, reason="needs node")
+def test_stream_every_kind( tmp_path):
+  rng = np.random.default_rng(0)
+  v = rng.random( (40,3)).astype(np.float32)
+  f = rng.integers( 0, 40, (30,3))
+  pointcloud.buildOctree( rng.random( (500,3)), str(tmp_path), tileSize=64)
+  geoObjs = [
+    go.TriangleSet( v, f),
+    go.TriangleSet( v, f, smooth=False),
+    go.TriangleSet( v, f, opacity=0.5),
+    go.TriangleSet( v, f, scalars=v[:,0], liveColors=True),
+    go.Sphere( v[:5], 0.1),
+    go.Group( go.Sphere( v[:5], 0.1), go.Line( v),
+              matrix=go.translate( 1., 0., 0.)),
+    go.Point( v, depthSort=True),
+    go.Line( v, scalars=v[:,1]),
+    go.Text( "label", 0., 0., 0.),
+    animation.Animation( go.TriangleSet( v, f), [v, v+0.1, v+0.2]),
+    pointcloud.PointTiles( str(tmp_path), url="http://localhost:1"),
+    volume.Volume( rng.random( (8,8,8))),
+  ]
+  script = tmp_path/"page.js"
+  script.write_text( streamPage( geoObjs, 1 << 10) + """
+    var left = scene.children.filter( function( o) {
+      return o instanceof THREE.Line && o.mode === THREE.LinePieces &&
+             o.material.color.getHex() === 0x888888;
+    });
+    console.log( JSON.stringify( { children : scene.children.length,
+                                   boxes : left.length }));
+  """)
+  result = subprocess.run( [node, str(script)], capture_output=True,
+                           text=True)
+  assert result.returncode == 0, result.stderr[-2000:]
+  out = json.loads( result.stdout.strip().splitlines()[-1])
+  assert out["boxes"] == 0
+  assert out["children"] > len(geoObjs)
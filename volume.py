@@ -0,0 +1,366 @@
+import json
+import math
+
+import numpy as np
+
+import GeoObjects as go
+
+# Volume rendering
+#
+# A Volume draws a 3-D array of samples, the first axis along x, by ray
+# marching through it on the page. The values are quantized to uint8
+# or uint16 steps over colorRange and cut into bricks of brickSize
+# cells, whose samples on the planes between them are in both bricks,
+# so the bricks interpolate alike where they meet. WebGL 1 has no 3-D
+# textures, so a brick is sent as a 2-D atlas of its slices along z,
+# laid out in rows of tiles, that the shader samples two slices of at a
+# time. The bricks are read a slab of brickSize+1 planes at a time, so
+# the array may be memory mapped and larger than memory.
+#
+# Every brick is drawn as its box, whose back faces march the ray from
+# the camera front to back, looking the samples up in a transfer
+# function of the colormap and the opacity. The opacity is that of a
+# voxel, the smallest of the spacings, and is corrected for the step
+# length. The bricks test depth but do not write it, and are drawn back
+# to front as three.js sorts transparent objects, after the opaque
+# ones. The test is made at the back face, where the ray starts, so an
+# opaque object hides what is behind it, and, where it lies inside a
+# brick, the part of the brick in front of it as well.
+
+_vDefaultDict = {
+  "spacing" : (1., 1., 1.),
+  "origin" : (0., 0., 0.),
+  "colormap" : "viridis",
+  "colorRange" : None,
+  "opacity" : None,
+  "bits" : 8,
+  "brickSize" : 128,
+  "samplingRate" : 2.,
+  "maxTextureSize" : 4096
+}
+
+def slabPlanes( shape, planes=None):
+  """The planes along the first axis of a volume of shape read at once"""
+  return planes or max( 1, go.chunkSize//max( 1, shape[1]*shape[2]))
+
+def volumeRange( values):
+  """The minimum and maximum of the finite values of a 3-D array, read
+  a slab at a time, or None"""
+  lo, hi = np.inf, -np.inf
+  for sl in go.chunks( len(values), slabPlanes( values.shape)):
+    r = go.finiteRange( np.asarray( values[sl]).reshape(-1))
+    if r is not None:
+      lo, hi = min( lo, r[0]), max( hi, r[1])
+  return (lo, hi) if lo <= hi else None
+
+def quantize( values, lo, hi, bits):
+  """values as uint8 or uint16 steps over lo to hi, clamped, with NaN
+  at the bottom step"""
+  top = (1 << bits) - 1
+  scale = top/(hi-lo) if hi > lo else 0.
+  t = (np.asarray( values, dtype=np.float32) - np.float32(lo))*np.float32(scale)
+  t = np.nan_to_num( t, nan=0., posinf=top, neginf=0.)
+  np.clip( t, 0, top, out=t)
+  return np.rint( t).astype( np.uint8 if bits == 8 else np.uint16)
+
+def brickStarts( n, size):
+  """The first samples of the bricks of size cells along an axis of n
+  samples"""
+  return range( 0, max( n-1, 1), size)
+
+def atlasColumns( shape, maxTextureSize):
+  """The tiles in a row of the atlas of a brick of shape, about as many
+  as there are rows"""
+  nx, ny, nz = shape
+  cols = min( nz, max( 1, maxTextureSize//nx),
+              max( 1, int( math.ceil( math.sqrt( nz*ny/float(nx))))))
+  if nx > maxTextureSize or -(-nz//cols)*ny > maxTextureSize:
+    raise ValueError( "a brick of {} samples does not fit a texture of "
+                      "{} texels, use a smaller brickSize".format(
+                        shape, maxTextureSize))
+  return cols
+
+def packAtlas( brick, cols):
+  """The (rows*ny, cols*nx) atlas of the z slices of an (nx,ny,nz)
+  brick, slice k in row k//cols and column k%cols"""
+  nx, ny, nz = brick.shape
+  rows = -(-nz//cols)
+  slices = np.zeros( (rows*cols, ny, nx), dtype=brick.dtype)
+  slices[:nz] = brick.transpose( 2, 1, 0)
+  return np.ascontiguousarray(
+    slices.reshape( rows, cols, ny, nx).transpose( 0, 2, 1, 3)
+  ).reshape( rows*ny, cols*nx)
+
+class Volume(go.GeoVertObj):
+  """A 3-D array of scalar samples drawn by ray marching.
+
+  values may be any 3-D array, including a memory mapped one, with
+  sample (i,j,k) at origin + spacing*(i,j,k). The values over
+  colorRange, their finite range if it is None, are quantized to bits,
+  8 or 16, and colored through colormap. opacity is a list of (value,
+  alpha) points that the opacity of a voxel is interpolated between,
+  by default rising from 0 to 1 over colorRange. samplingRate is the
+  number of samples the rays take per voxel.
+
+  Opaque objects hide the volume behind them. The rays are not cut
+  short at them, so an opaque object inside the volume is drawn
+  without the volume in front of it."""
+
+  def __init__(self, values, **kwargs):
+    if np.ndim( values) != 3 or min( np.shape( values)) < 2:
+      raise ValueError( "a Volume needs a 3-D array of at least 2 "
+                        "samples along each axis")
+    self.values = values if isinstance( values, np.ndarray) else \
+                  np.asarray( values)
+    for attr in _vDefaultDict:
+      if attr in kwargs:
+        setattr( self, attr, kwargs[attr])
+      else:
+        setattr( self, attr, _vDefaultDict[attr])
+    if self.bits not in (8, 16):
+      raise ValueError( "bits must be 8 or 16")
+
+  @go.styleVersioned
+  def boundingBox(self):
+    """The bounding box given as two Vector3's that hold the minimum
+    and maximum x, y, and z coordinates."""
+    a = np.asarray( self.origin, dtype=np.float64)
+    b = a + np.asarray( self.spacing, dtype=np.float64)*(
+          np.array( self.values.shape) - 1)
+    return (go.Vector3( np.minimum( a, b)), go.Vector3( np.maximum( a, b)))
+
+  @go.styleVersioned
+  def stats(self):
+    """The center of the box weighted by its surface area, as a Box
+    would have it"""
+    vmin, vmax = self.boundingBox()
+    w = np.array( (vmax-vmin).v)
+    area = 2.*(w[0]*w[1] + w[1]*w[2] + w[2]*w[0])
+    return (0.5*(vmin+vmax)*area, area)
+
+  @go.versioned
+  def dataRange(self):
+    """The range of the finite values"""
+    return volumeRange( self.values)
+
+  def valueRange(self):
+    """The range the values are quantized and colored over"""
+    if self.colorRange is not None:
+      return (float( self.colorRange[0]), float( self.colorRange[1]))
+    return self.dataRange() or (0., 1.)
+
+  def bricks(self):
+    """Iterate over the bricks as (start, shape, atlas, cols), the first
+    sample and the shape of the brick, and its atlas of cols tiles a
+    row. The values are read and quantized a slab of bricks at a
+    time."""
+    values = self.values
+    n = values.shape
+    size = self.brickSize
+    lo, hi = self.valueRange()
+    for i0 in brickStarts( n[0], size):
+      i1 = min( i0+size, n[0]-1)
+      slab = quantize( values[i0:i1+1], lo, hi, self.bits)
+      for j0 in brickStarts( n[1], size):
+        j1 = min( j0+size, n[1]-1)
+        for k0 in brickStarts( n[2], size):
+          k1 = min( k0+size, n[2]-1)
+          brick = slab[:, j0:j1+1, k0:k1+1]
+          cols = atlasColumns( brick.shape, self.maxTextureSize)
+          yield ((i0, j0, k0), brick.shape, packAtlas( brick, cols), cols)
+
+  def transferTable(self):
+    """The (256,4) uint8 RGBA transfer function over the value range"""
+    table = np.empty( (256,4), dtype=np.uint8)
+    table[:,:3] = go.colormapTable( self.colormap)
+    lo, hi = self.valueRange()
+    if self.opacity is None:
+      alpha = np.linspace( 0., 1., 256)
+    else:
+      points = sorted( (float(v), float(a)) for v, a in self.opacity)
+      alpha = np.interp( np.linspace( lo, hi, 256),
+                         [v for v, a in points], [a for v, a in points])
+    table[:,3] = np.rint( 255.*np.clip( alpha, 0., 1.))
+    return table
+
+  def encodedBricks(self):
+    """The brick scripts, cached until the values, or how they are
+    quantized and cut, change"""
+    def compute():
+      dtype = "|u1" if self.bits == 8 else "<u2"
+      spacing = np.abs( np.asarray( self.spacing, dtype=np.float64))
+      origin = np.asarray( self.origin, dtype=np.float64)
+      parts = []
+      for start, shape, atlas, cols in self.bricks():
+        size = spacing*(np.array( shape) - 1)
+        center = origin + np.asarray( self.spacing)*(
+                   np.array( start) + 0.5*(np.array( shape) - 1))
+        parts.append( self.vBrick.format(
+          DATA = go.encodeArray( atlas, dtype),
+          SHAPE = ", ".join( "{}".format(x) for x in shape),
+          COLS = cols,
+          CENTER = ", ".join( "{}".format(x) for x in center),
+          SIZE = ", ".join( "{}".format(x) for x in size)))
+      return parts
+    return self.cached( "encoded bricks", compute, ("version",),
+                        (self.bits, self.brickSize, self.maxTextureSize,
+                         tuple( self.spacing), tuple( self.origin))
+                        + self.valueRange())
+
+  vVertex = """\
+varying vec3 vPosition;
+varying vec3 vEye;
+
+mat3 inverse3( mat3 m) {
+  vec3 r0 = cross( m[1], m[2]);
+  vec3 r1 = cross( m[2], m[0]);
+  vec3 r2 = cross( m[0], m[1]);
+  return mat3( r0.x, r1.x, r2.x, r0.y, r1.y, r2.y, r0.z, r1.z, r2.z)/
+         dot( m[0], r0);
+}
+
+void main() {
+  mat3 m = mat3( modelMatrix[0].xyz, modelMatrix[1].xyz, modelMatrix[2].xyz);
+  vPosition = position;
+  vEye = inverse3( m)*(cameraPosition - modelMatrix[3].xyz);
+  gl_Position = projectionMatrix*modelViewMatrix*vec4( position, 1.0);
+}
+"""
+
+  vFragment = """\
+uniform sampler2D atlas;
+uniform sampler2D transfer;
+uniform vec3 shape;
+uniform vec2 tiles;
+uniform vec3 halfSize;
+uniform float stepLength;
+uniform float unitLength;
+varying vec3 vPosition;
+varying vec3 vEye;
+
+float slice( vec2 xy, float k) {
+  float row = floor( (k + 0.5)/tiles.x);
+  vec2 tile = vec2( k - row*tiles.x, row);
+  vec4 texel = texture2D( atlas, (tile*shape.xy + xy + 0.5)/(tiles*shape.xy));
+#if BITS == 16
+  return (texel.a*65280.0 + texel.r*255.0)/65535.0;
+#else
+  return texel.r;
+#endif
+}
+
+float sampleAt( vec3 p) {
+  float k = floor( p.z);
+  return mix( slice( p.xy, k), slice( p.xy, min( k + 1.0, shape.z - 1.0)),
+              p.z - k);
+}
+
+void main() {
+  vec3 dir = normalize( vPosition - vEye);
+  dir += vec3( equal( dir, vec3( 0.0)))*1e-7;
+  vec3 t0 = (-halfSize - vEye)/dir;
+  vec3 t1 = (halfSize - vEye)/dir;
+  vec3 tmin = min( t0, t1);
+  vec3 tmax = max( t0, t1);
+  float near = max( max( max( tmin.x, tmin.y), tmin.z), 0.0);
+  float far = min( min( tmax.x, tmax.y), tmax.z);
+  float n = ceil( (far - near)/stepLength);
+  vec4 sum = vec4( 0.0);
+  for (int i = 0; i < MAX_STEPS; i++) {
+    if (float(i) >= n || sum.a > 0.99) {
+      break;
+    }
+    vec3 p = vEye + dir*min( near + (float(i) + 0.5)*stepLength, far);
+    vec3 voxel = clamp( (0.5*p/halfSize + 0.5)*(shape - 1.0), 0.0,
+                        shape - 1.0);
+    vec4 c = texture2D( transfer, vec2( (sampleAt( voxel)*255.0 + 0.5)/256.0,
+                                        0.5));
+    float a = 1.0 - pow( 1.0 - c.a, stepLength/unitLength);
+    sum.rgb += (1.0 - sum.a)*a*c.rgb;
+    sum.a += (1.0 - sum.a)*a;
+  }
+  if (sum.a <= 0.0) {
+    discard;
+  }
+  gl_FragColor = vec4( sum.rgb/sum.a, sum.a);
+}
+"""
+
+  vScene = """\
+  (function() {{
+    function dataTexture( data, width, height, format) {{
+      var texture = new THREE.DataTexture(
+        new Uint8Array( data.buffer, data.byteOffset, data.byteLength),
+        width, height, format, THREE.UnsignedByteType, undefined,
+        THREE.ClampToEdgeWrapping, THREE.ClampToEdgeWrapping,
+        THREE.LinearFilter, THREE.LinearFilter);
+      texture.generateMipmaps = false;
+      texture.flipY = false;
+      texture.unpackAlignment = 1;
+      texture.needsUpdate = true;
+      return texture;
+    }}
+    var transfer = dataTexture( {TRANSFER}, 256, 1, THREE.RGBAFormat);
+    var vertexShader = {VERTEX};
+    var fragmentShader = {FRAGMENT};
+    function brick( key, data, shape, cols, center, size) {{
+      var rows = Math.ceil( shape[2]/cols);
+      var atlas = pyplot3d.geometry( key, function() {{
+        return dataTexture( data(), cols*shape[0], rows*shape[1],
+                            {FORMAT});
+      }});
+      var material = new THREE.ShaderMaterial({{
+        uniforms : {{
+          atlas : {{ type : 't', value : atlas }},
+          transfer : {{ type : 't', value : transfer }},
+          shape : {{ type : 'v3', value : new THREE.Vector3(
+                     shape[0], shape[1], shape[2]) }},
+          tiles : {{ type : 'v2', value : new THREE.Vector2( cols, rows) }},
+          halfSize : {{ type : 'v3', value : new THREE.Vector3(
+                        size[0]/2, size[1]/2, size[2]/2) }},
+          stepLength : {{ type : 'f', value : {STEP} }},
+          unitLength : {{ type : 'f', value : {UNIT} }}
+        }},
+        defines : {{ BITS : {BITS}, MAX_STEPS : {MAX_STEPS} }},
+        vertexShader : vertexShader,
+        fragmentShader : fragmentShader,
+        side : THREE.BackSide,
+        transparent : true,
+        depthWrite : false,
+        depthTest : true
+      }});
+      var mesh = new THREE.Mesh(
+        new THREE.BoxGeometry( size[0], size[1], size[2]), material);
+      mesh.position.set( center[0], center[1], center[2]);
+      scene.add( mesh);
+    }}
+{BRICKS}
+  }})();
+  """
+
+  vBrick = """\
+    brick( "{{KEY}}", function() {{{{ return {DATA}; }}}},
+           [{SHAPE}], {COLS}, [{CENTER}], [{SIZE}]);
+"""
+
+  def render(self, shared=True):
+    """The script that adds the bricks to the scene, see
+    TriangleSet.render for shared"""
+    spacing = np.abs( np.asarray( self.spacing, dtype=np.float64))
+    unit = float( spacing.min())
+    step = unit/self.samplingRate
+    size = spacing*np.minimum( self.brickSize,
+                               np.array( self.values.shape) - 1)
+    bricks = [part.format( KEY = go.geometryKey( part) if shared else "")
+              for part in self.encodedBricks()]
+    return self.vScene.format(
+      TRANSFER = go.encodeArray( self.transferTable().reshape(-1), "|u1"),
+      VERTEX = json.dumps( self.vVertex),
+      FRAGMENT = json.dumps( self.vFragment),
+      FORMAT = ("THREE.LuminanceFormat" if self.bits == 8 else
+                "THREE.LuminanceAlphaFormat"),
+      STEP = step,
+      UNIT = unit,
+      BITS = self.bits,
+      MAX_STEPS = int( math.ceil( np.linalg.norm( size)/step)) + 1,
+      BRICKS = "".join( bricks))